@@ -0,0 +1,27 @@
+from django.db import models
+from django_filters.rest_framework import FilterSet, IsoDateTimeFilter
+
+from datasets.models import MessageLog
+
+
+class MessageLogFilter(FilterSet):
+    """
+    Filter the message log, e.g. unsent signals for a handler since some time:
+
+        ?is_sent=false&handler_name=sigmax&t_entered__gte=2018-10-01T00:00:00
+    """
+    class Meta:
+        model = MessageLog
+        fields = {
+            'is_sent': ['exact'],
+            'is_parked': ['exact'],
+            'state': ['exact'],
+            'handler_name': ['exact'],
+            'status': ['exact'],
+            'fault_code': ['exact'],
+            't_entered': ['gte', 'lt'],
+            't_sent': ['gte', 'lt'],
+        }
+        filter_overrides = {
+            models.DateTimeField: {'filter_class': IsoDateTimeFilter},
+        }
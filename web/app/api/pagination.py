@@ -0,0 +1,58 @@
+from collections import OrderedDict
+
+from rest_framework import pagination
+from rest_framework.response import Response
+from datapunt_api.rest import HALPagination
+
+
+class HALCursorPagination(pagination.CursorPagination):
+    """
+    Cursor (keyset) pagination with HAL style links, pages have no count.
+    """
+    page_size_query_param = 'page_size'
+
+    def get_paginated_response(self, data):
+        self_link = self.base_url
+        if self_link.endswith(".api"):
+            self_link = self_link[:-4]
+
+        return Response(OrderedDict([
+            ('_links', OrderedDict([
+                ('self', dict(href=self_link)),
+                ('next', dict(href=self.get_next_link())),
+                ('previous', dict(href=self.get_previous_link())),
+            ])),
+            ('results', data)
+        ]))
+
+
+class MessageLogPagination(HALPagination):
+    """
+    HAL pagination by page number, or by cursor if a cursor is requested.
+
+    Page numbers need a COUNT(*) and an OFFSET scan per page, both get slower
+    as the table grows. Requests with a cursor parameter (start with an empty
+    one: ?cursor=) are paginated on the ordering (-signal_id, which is
+    indexed) instead and take the same time at any depth.
+    """
+    cursor_query_param = 'cursor'
+    ordering = '-signal_id'
+
+    def __init__(self):
+        self.cursor_pagination = None
+
+    def paginate_queryset(self, queryset, request, view=None):
+        if self.cursor_query_param not in request.query_params:
+            return super().paginate_queryset(queryset, request, view=view)
+
+        self.cursor_pagination = HALCursorPagination()
+        self.cursor_pagination.cursor_query_param = self.cursor_query_param
+        self.cursor_pagination.ordering = self.ordering
+        self.cursor_pagination.page_size = self.page_size
+        self.cursor_pagination.max_page_size = self.max_page_size
+        return self.cursor_pagination.paginate_queryset(queryset, request, view=view)
+
+    def get_paginated_response(self, data):
+        if self.cursor_pagination is not None:
+            return self.cursor_pagination.get_paginated_response(data)
+        return super().get_paginated_response(data)
@@ -1,3 +1,6 @@
+from collections import OrderedDict
+
+from django.utils import timezone
 from rest_framework import serializers
 
 from datasets import models
@@ -9,3 +12,76 @@ class MessageLogSerializer(serializers.ModelSerializer):
     class Meta:
         model = models.MessageLog
         fields = '__all__'
+
+
+class MessageLogValuesSerializer():
+    """
+    Represent MessageLog .values() rows the way MessageLogSerializer does.
+
+    Only datetimes need converting (to ISO 8601 in the current time zone, as
+    DRF does), other values are passed on as they are. This skips creating a
+    model instance and running a serializer per row, which dominates the cost
+    of large pages.
+    """
+    def __init__(self, fields=None):
+        serializer_fields = MessageLogSerializer().fields
+        if fields is None:
+            fields = list(serializer_fields.keys())
+        unknown = [name for name in fields if name not in serializer_fields]
+        if unknown:
+            raise serializers.ValidationError(
+                {'fields': 'Unknown field(s): {}.'.format(', '.join(unknown))})
+
+        self.fields = fields
+        self._datetime_fields = [
+            name for name in fields
+            if isinstance(serializer_fields[name], serializers.DateTimeField)
+        ]
+
+    def to_representation(self, rows):
+        tz = timezone.get_current_timezone()
+        fields = self.fields
+        datetime_fields = self._datetime_fields
+
+        data = []
+        for row in rows:
+            item = OrderedDict((name, row[name]) for name in fields)
+            for name in datetime_fields:
+                value = item[name]
+                if value is not None:
+                    value = value.astimezone(tz).isoformat()
+                    if value.endswith('+00:00'):
+                        value = value[:-6] + 'Z'
+                    item[name] = value
+            data.append(item)
+        return data
+
+
+class _AddressSerializer(serializers.Serializer):
+    openbare_ruimte = serializers.CharField()
+    huisnummer = serializers.CharField()
+    postcode = serializers.CharField()
+
+
+class _GeometrieSerializer(serializers.Serializer):
+    coordinates = serializers.ListField(
+        child=serializers.FloatField(), min_length=2, max_length=2)
+
+
+class _LocationSerializer(serializers.Serializer):
+    address = _AddressSerializer()
+    geometrie = _GeometrieSerializer()
+
+
+class SignalIngestSerializer(serializers.Serializer):
+    """
+    Signal pushed by the Signals backend.
+
+    Only the fields the handlers read (see sigmax._build_stuf_message) are
+    validated, the signal is queued as it was posted.
+    """
+    signal_id = serializers.CharField(max_length=255)
+    created_at = serializers.DateTimeField()
+    incident_date_start = serializers.DateTimeField()
+    incident_date_end = serializers.DateTimeField()
+    location = _LocationSerializer()
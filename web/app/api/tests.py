@@ -1,6 +1,14 @@
+import json
+from datetime import timedelta
+
 from django.test import TestCase
+from django.utils import timezone
+
+from rest_framework.test import APIRequestFactory, APITestCase
 
-from rest_framework.test import APITestCase
+from api.serializers import MessageLogSerializer
+from api.views import SignalIngestView
+from datasets.models import MessageLog, Outbox
 # from . import factories
 
 
@@ -70,3 +78,201 @@ class BrowseDatasetsTestCase(APITestCase):
             self.assertIn(
                 "count", response.data, "No count attribute in {}".format(url)
             )
+
+
+class MessageLogPaginationTestCase(APITestCase):
+    url = "/signals_export/messagelog/"
+
+    def setUp(self):
+        MessageLog.objects.bulk_create([
+            MessageLog(signal_id="{:03d}".format(i), t_entered=timezone.now())
+            for i in range(25)
+        ])
+
+    def test_page_numbers(self):
+        response = self.client.get(self.url, {"page_size": 10, "page": 2})
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data["count"], 25)
+        self.assertEqual(
+            [r["signal_id"] for r in response.data["results"]],
+            ["{:03d}".format(i) for i in range(14, 4, -1)])
+
+    def test_cursor(self):
+        signal_ids = []
+        url, params = self.url, {"cursor": "", "page_size": 10}
+        while url:
+            response = self.client.get(url, params)
+            self.assertEqual(response.status_code, 200)
+            self.assertNotIn("count", response.data)
+            signal_ids.extend(r["signal_id"] for r in response.data["results"])
+            url, params = response.data["_links"]["next"]["href"], None
+
+        self.assertEqual(signal_ids, ["{:03d}".format(i) for i in range(24, -1, -1)])
+
+    def test_cursor_previous(self):
+        response = self.client.get(self.url, {"cursor": "", "page_size": 10})
+        response = self.client.get(response.data["_links"]["next"]["href"])
+        response = self.client.get(response.data["_links"]["previous"]["href"])
+
+        self.assertEqual(response.data["results"][0]["signal_id"], "024")
+        self.assertIsNone(response.data["_links"]["previous"]["href"])
+
+
+class MessageLogListTestCase(APITestCase):
+    url = "/signals_export/messagelog/"
+
+    def setUp(self):
+        t = timezone.now()
+        self.t = t
+        MessageLog.objects.create(
+            signal_id="1", t_entered=t - timedelta(days=2), t_sent=t - timedelta(days=2),
+            handler_name="sigmax", status="Sent", is_sent=True, attempts=1)
+        MessageLog.objects.create(
+            signal_id="2", t_entered=t - timedelta(days=1), handler_name="sigmax",
+            status="Error", attempts=2, last_error="Timeout", next_attempt_at=t)
+        MessageLog.objects.create(
+            signal_id="3", t_entered=t, handler_name="local-log-only")
+
+    def _signal_ids(self, params):
+        response = self.client.get(self.url, params)
+        self.assertEqual(response.status_code, 200)
+        return [r["signal_id"] for r in response.data["results"]]
+
+    def test_same_output_as_serializer(self):
+        response = self.client.get(self.url)
+
+        expected = MessageLogSerializer(
+            MessageLog.objects.order_by("-signal_id"), many=True).data
+        self.assertEqual(response.json()["results"], json.loads(json.dumps(expected)))
+
+    def test_filters(self):
+        self.assertEqual(self._signal_ids({"is_sent": "false"}), ["3", "2"])
+        self.assertEqual(
+            self._signal_ids({"is_sent": "false", "handler_name": "sigmax"}), ["2"])
+        self.assertEqual(self._signal_ids({"status": "Sent"}), ["1"])
+
+        since = (self.t - timedelta(hours=36)).isoformat()
+        self.assertEqual(self._signal_ids({"t_entered__gte": since}), ["3", "2"])
+        self.assertEqual(self._signal_ids({"t_entered__lt": since}), ["1"])
+        self.assertEqual(self._signal_ids({"t_sent__lt": self.t.isoformat()}), ["1"])
+
+    def test_fields(self):
+        response = self.client.get(self.url, {"fields": "status,signal_id"})
+
+        self.assertEqual(
+            response.json()["results"][0], {"status": "", "signal_id": "3"})
+        self.assertEqual(list(response.data["results"][0].keys()), ["status", "signal_id"])
+
+    def test_fields_with_cursor(self):
+        response = self.client.get(
+            self.url, {"fields": "status", "cursor": "", "page_size": 2})
+
+        self.assertEqual(response.data["results"], [{"status": ""}, {"status": "Error"}])
+        response = self.client.get(response.data["_links"]["next"]["href"])
+        self.assertEqual(response.data["results"], [{"status": "Sent"}])
+
+    def test_unknown_field(self):
+        response = self.client.get(self.url, {"fields": "signal_id,password"})
+
+        self.assertEqual(response.status_code, 400)
+
+
+def _signal(signal_id, **fields):
+    signal = {
+        "signal_id": signal_id,
+        "text": "Afval",
+        "created_at": "2018-06-27T09:13:15.277401Z",
+        "incident_date_start": "2018-06-27T09:13:15.277349Z",
+        "incident_date_end": "2018-06-27T06:47:12.423000Z",
+        "location": {
+            "address": {"openbare_ruimte": "Dam", "huisnummer": "1", "postcode": "1012JS"},
+            "geometrie": {"type": "Point", "coordinates": [135, 45]},
+        },
+    }
+    signal.update(fields)
+    return signal
+
+
+class SignalIngestTestCase(APITestCase):
+    url = "/signals_export/signals/"
+
+    def test_post_signal(self):
+        response = self.client.post(self.url, _signal("1"), format="json")
+
+        self.assertEqual(response.status_code, 202)
+        self.assertEqual(response.data, {"queued": 1, "skipped": 0})
+        self.assertEqual(Outbox.objects.get().signal_id, "1")
+        # nothing is sent during the request
+        self.assertEqual(MessageLog.objects.count(), 0)
+
+    def test_post_batch(self):
+        MessageLog.objects.create(
+            signal_id="2", t_entered=timezone.now(), is_sent=True)
+        signals = [_signal("1"), _signal("2"), _signal("1")]
+
+        response = self.client.post(self.url, signals, format="json")
+
+        self.assertEqual(response.status_code, 202)
+        self.assertEqual(response.data, {"queued": 1, "skipped": 2})
+        self.assertEqual(Outbox.objects.count(), 1)
+
+    def test_invalid_signal(self):
+        no_address = _signal("1")
+        del no_address["location"]["address"]
+        for data in [
+                {"text": "no signal_id"},
+                [_signal("1"), "not a signal"],
+                {"signal_id": "1"},
+                [_signal("1"), _signal("2", created_at="yesterday")],
+                _signal("1", incident_date_start=None),
+                no_address,
+                _signal("1", location={"address": {}, "geometrie": {"coordinates": [1]}}),
+        ]:
+            response = self.client.post(self.url, data, format="json")
+            self.assertEqual(response.status_code, 400, data)
+
+        self.assertEqual(Outbox.objects.count(), 0)
+
+    def test_batch_too_large(self):
+        signals = [_signal(str(i)) for i in range(1001)]
+
+        response = self.client.post(self.url, signals, format="json")
+
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(Outbox.objects.count(), 0)
+
+
+class SignalIngestAuthorizationTestCase(APITestCase):
+    """
+    Posting signals with the authorization checks enabled (ALWAYS_OK is on
+    for the other tests when running locally).
+
+    The view is called the way the authorization middleware passes requests
+    on, with is_authorized_for telling which scopes the token grants.
+    """
+    url = "/signals_export/signals/"
+
+    def _post(self, scopes=None):
+        request = APIRequestFactory().post(self.url, _signal("1"), format="json")
+        if scopes is not None:
+            request.is_authorized_for = lambda *needed: set(needed) <= set(scopes)
+        return SignalIngestView.as_view()(request)
+
+    def test_no_authorization(self):
+        response = self._post()
+
+        self.assertEqual(response.status_code, 403)
+        self.assertEqual(Outbox.objects.count(), 0)
+
+    def test_without_scope(self):
+        response = self._post(scopes=["SIG/READ"])
+
+        self.assertEqual(response.status_code, 403)
+        self.assertEqual(Outbox.objects.count(), 0)
+
+    def test_with_scope(self):
+        response = self._post(scopes=["SIG/ALL"])
+
+        self.assertEqual(response.status_code, 202)
+        self.assertEqual(Outbox.objects.count(), 1)
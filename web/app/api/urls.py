@@ -6,5 +6,6 @@ router.register(
     'messagelog', views.MessageLogViewSet, base_name='messagelog')
 
 urlpatterns = [
+    url(r'^signals/$', views.SignalIngestView.as_view(), name='signals-ingest'),
     url(r'^', include(router.urls)),
 ]
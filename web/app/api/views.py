@@ -2,10 +2,20 @@ from django.shortcuts import render
 
 from rest_framework import viewsets
 from rest_framework import routers
+from rest_framework import permissions
+from rest_framework import status
+from rest_framework.exceptions import ValidationError
+from rest_framework.parsers import JSONParser
+from rest_framework.response import Response
+from rest_framework.views import APIView
 from datapunt_api.rest import DatapuntViewSet, HALPagination
 
-from api.serializers import MessageLogSerializer
+from api.filters import MessageLogFilter
+from api.pagination import MessageLogPagination
+from api.serializers import (
+    MessageLogSerializer, MessageLogValuesSerializer, SignalIngestSerializer)
 from datasets.models import MessageLog
+from datasets.outbox import enqueue_signals
 
 
 # --- general ---
@@ -20,10 +30,74 @@ class SignalsExportAPIRouter(routers.DefaultRouter):
     APIRootView = SignalsExportAPIView
 
 
+class IsAuthorizedForSignals(permissions.BasePermission):
+    """
+    Allow requests with the SIG/ALL scope (checked by authorization_django).
+    """
+    scope = 'SIG/ALL'
+
+    def has_permission(self, request, view):
+        is_authorized_for = getattr(request, 'is_authorized_for', None)
+        return is_authorized_for is not None and is_authorized_for(self.scope)
+
+
 # --- specific ---
 
 class MessageLogViewSet(DatapuntViewSet):
+    """
+    Signals handled by the export service, newest signal_id first.
+
+    Add ?cursor= to page through large result sets, follow the next links.
+    Filter with e.g. ?is_sent=false&handler_name=sigmax&t_entered__gte=...,
+    select fields with ?fields=signal_id,status.
+    """
+    pagination_class = MessageLogPagination
+    filter_class = MessageLogFilter
     serializer_class = MessageLogSerializer
     serializer_detail_class = MessageLogSerializer
 
     queryset = MessageLog.objects.order_by('-signal_id').all()
+
+    def list(self, request, *args, **kwargs):
+        fields = request.query_params.get('fields')
+        if fields:
+            fields = [name.strip() for name in fields.split(',') if name.strip()]
+        serializer = MessageLogValuesSerializer(fields or None)
+
+        # Rows are read as dictionaries, the cursor pagination needs signal_id.
+        queryset = self.filter_queryset(self.get_queryset())
+        queryset = queryset.values(*set(serializer.fields) | {'signal_id'})
+
+        page = self.paginate_queryset(queryset)
+        if page is not None:
+            return self.get_paginated_response(serializer.to_representation(page))
+        return Response(serializer.to_representation(queryset))
+
+
+class SignalIngestView(APIView):
+    """
+    Queue one signal or a list of signals for sending to external APIs.
+
+    Signals that were sent or queued before are skipped. Sending is done by
+    the export workers, this endpoint answers 202 as soon as the signals are
+    queued.
+    """
+    permission_classes = (IsAuthorizedForSignals,)
+    parser_classes = (JSONParser,)
+    max_batch_size = 1000
+
+    def post(self, request):
+        many = isinstance(request.data, list)
+        signals = request.data if many else [request.data]
+        if len(signals) > self.max_batch_size:
+            raise ValidationError(
+                'At most {} signals can be posted at once.'.format(self.max_batch_size))
+
+        serializer = SignalIngestSerializer(data=request.data, many=many)
+        serializer.is_valid(raise_exception=True)
+
+        n_queued = enqueue_signals(signals)
+        return Response(
+            {'queued': n_queued, 'skipped': len(signals) - n_queued},
+            status=status.HTTP_202_ACCEPTED
+        )
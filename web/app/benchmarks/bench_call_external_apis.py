@@ -0,0 +1,157 @@
+"""
+Benchmark the MessageLog bookkeeping done by _call_external_apis.
+
+Compares the number of database queries per page of the current page-level
+implementation with the earlier per-signal implementation, and times the
+bookkeeping for pages of new, already sent and failed signals (using a stub
+handler). Run with:
+
+    python manage.py test benchmarks/bench_call_external_apis.py
+
+(Benchmarks are not picked up by the normal test run, their file names do not
+start with test_.)
+"""
+import logging
+
+from django.db import connection
+from django.test import TestCase
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+
+from benchmarks.utils import SIZES, make_signals, measure, record
+from datasets import handle_signals
+from datasets.models import MessageLog
+from datasets.external.base import (
+    BaseAPIHandler, get_handler, register_handler, reset_handlers
+)
+
+logger = logging.getLogger(__name__)
+
+PAGE_SIZES = [1, 10, 100]  # the per signal baseline is too slow for larger pages
+
+
+class StubHandler(BaseAPIHandler):
+    """
+    Handler that sends nothing, only the bookkeeping is measured.
+    """
+    name = 'stub'
+    success = True
+
+    def handle(self, signal):
+        return self.success, 'Sent' if self.success else 'Error'
+
+    def can_handle(self, signal):
+        return True
+
+
+def _call_external_apis_per_signal(signals):
+    """
+    Baseline: the per-signal bookkeeping _call_external_apis used to do.
+    """
+    for signal in signals:
+        try:
+            entry = MessageLog.objects.get(signal_id=signal['signal_id'])
+        except MessageLog.DoesNotExist:
+            entry = MessageLog(
+                signal_id=signal['signal_id'],
+                t_entered=timezone.now()
+            )
+            entry.save()
+        else:
+            if entry.is_sent:
+                continue
+
+        handler = get_handler(signal)
+        success, status = handler.handle(signal)
+
+        entry.is_sent = success
+        entry.status = status
+        entry.t_sent = timezone.now()
+        entry.handler_name = handler.name
+
+        entry.save()
+
+
+def _count_queries(function, signals):
+    with CaptureQueriesContext(connection) as context:
+        function(signals)
+    return len(context.captured_queries)
+
+
+class BenchQueriesPerPage(TestCase):
+    def setUp(self):
+        reset_handlers()
+        logging.getLogger('datasets').setLevel(logging.WARNING)
+
+    def tearDown(self):
+        logging.getLogger('datasets').setLevel(logging.NOTSET)
+
+    def test_queries_per_page(self):
+        rows = []
+        for size in PAGE_SIZES:
+            results = {}
+            for label, function in [
+                    ('before', _call_external_apis_per_signal),
+                    ('after', handle_signals._call_external_apis)]:
+                signals = [
+                    {'signal_id': '{}-{}-{}'.format(label, size, i)}
+                    for i in range(size)
+                ]
+                # first pass creates and sends, second pass only skips
+                results[label] = (
+                    _count_queries(function, signals),
+                    _count_queries(function, signals),
+                )
+            rows.append((size, results['before'], results['after']))
+
+        logger.warning('page size | before (new, seen) | after (new, seen)')
+        for size, before, after in rows:
+            logger.warning('%9s | %18s | %17s', size, before, after)
+
+        # The page-level implementation needs a fixed number of queries.
+        after_counts = set(after for _, _, after in rows)
+        self.assertEqual(len(after_counts), 1)
+
+
+class BenchBookkeeping(TestCase):
+    def setUp(self):
+        reset_handlers()
+        register_handler(StubHandler)
+        logging.getLogger('datasets').setLevel(logging.WARNING)
+
+    def tearDown(self):
+        StubHandler.success = True
+        reset_handlers()
+        logging.getLogger('datasets').setLevel(logging.NOTSET)
+
+    def _clear(self):
+        MessageLog.objects.all().delete()
+
+    def _failed_before(self, signals):
+        def setup():
+            self._clear()
+            MessageLog.objects.bulk_create([
+                MessageLog(signal_id=signal['signal_id'], t_entered=timezone.now())
+                for signal in signals
+            ])
+        return setup
+
+    def test_bookkeeping_per_page(self):
+        for size in SIZES:
+            signals = make_signals(size)
+
+            def call():
+                handle_signals._call_external_apis(signals)
+
+            t_new = measure(call, repeat=3, setup=self._clear)
+            t_sent = measure(call, repeat=3)  # rows from the last run are sent
+            t_retry = measure(call, repeat=3, setup=self._failed_before(signals))
+            self.assertEqual(MessageLog.objects.filter(is_sent=True).count(), size)
+
+            record('call_external_apis.new', size, t_new)
+            record('call_external_apis.sent_before', size, t_sent)
+            record('call_external_apis.retry', size, t_retry)
+
+            logger.warning(
+                '%d signals: new %.1f ms, sent before %.1f ms, retry %.1f ms',
+                size, t_new * 1000, t_sent * 1000, t_retry * 1000)
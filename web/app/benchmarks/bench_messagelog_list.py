@@ -0,0 +1,61 @@
+"""
+Benchmark building a page of the MessageLog list endpoint.
+
+Compares serializing model instances with MessageLogSerializer (the earlier
+list path) to representing .values() rows with MessageLogValuesSerializer.
+Run with:
+
+    python manage.py test benchmarks/bench_messagelog_list.py
+
+(Benchmarks are not picked up by the normal test run, their file names do not
+start with test_.)
+"""
+import logging
+
+from django.test import TestCase
+from django.utils import timezone
+
+from benchmarks.utils import measure, record
+from api.serializers import MessageLogSerializer, MessageLogValuesSerializer
+from datasets.models import MessageLog
+
+logger = logging.getLogger(__name__)
+
+PAGE_SIZES = [100, 1000, 5000]
+
+
+class BenchListPage(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        now = timezone.now()
+        MessageLog.objects.bulk_create([
+            MessageLog(
+                signal_id='{:06d}'.format(i), t_entered=now, t_sent=now,
+                handler_name='sigmax', status='Sent', is_sent=True, attempts=1)
+            for i in range(max(PAGE_SIZES))
+        ])
+
+    def test_page_serialization(self):
+        queryset = MessageLog.objects.order_by('-signal_id')
+        values_serializer = MessageLogValuesSerializer()
+
+        rows = []
+        for size in PAGE_SIZES:
+            before = measure(
+                lambda: MessageLogSerializer(list(queryset[:size]), many=True).data)
+            after = measure(
+                lambda: values_serializer.to_representation(list(queryset.values()[:size])))
+            rows.append((size, before, after))
+            record('messagelog_list.instances', size, before)
+            record('messagelog_list.values', size, after)
+
+            # same output
+            self.assertEqual(
+                [dict(item) for item in MessageLogSerializer(queryset[:size], many=True).data],
+                [dict(item) for item in values_serializer.to_representation(
+                    queryset.values()[:size])])
+
+        logger.warning('page size | instances (ms) | values (ms) | speedup')
+        for size, before, after in rows:
+            logger.warning(
+                '%9s | %14.1f | %11.1f | %6.1fx', size, before * 1000, after * 1000, before / after)
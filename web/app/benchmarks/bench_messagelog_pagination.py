@@ -0,0 +1,95 @@
+"""
+Benchmark paging through the MessageLog API at increasing depths.
+
+Compares page number (COUNT + OFFSET) pagination with cursor pagination on a
+table of BENCH_MESSAGELOG_ROWS rows (default one million, filling the table
+takes a while). Run with:
+
+    python manage.py test benchmarks/bench_messagelog_pagination.py
+
+(Benchmarks are not picked up by the normal test run, their file names do not
+start with test_.)
+"""
+import os
+import time
+import logging
+
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from rest_framework.pagination import Cursor
+from rest_framework.test import APITestCase
+
+from api.pagination import HALCursorPagination
+from benchmarks.utils import record
+from datasets.models import MessageLog
+
+logger = logging.getLogger(__name__)
+
+N_ROWS = int(os.getenv('BENCH_MESSAGELOG_ROWS', 1000000))
+PAGE_SIZE = 100
+DEPTHS = [0.0, 0.1, 0.5, 0.9]
+REPEAT = 5
+URL = '/signals_export/messagelog/'
+
+
+def _signal_id(i):
+    return '{:09d}'.format(i)
+
+
+def _cursor_url(position):
+    """
+    URL of the cursor page that starts after the given signal_id.
+    """
+    paginator = HALCursorPagination()
+    paginator.base_url = 'http://testserver{}?page_size={}'.format(URL, PAGE_SIZE)
+    return paginator.encode_cursor(Cursor(offset=0, reverse=False, position=position))
+
+
+class BenchPagination(APITestCase):
+    @classmethod
+    def setUpTestData(cls):
+        now = timezone.now()
+        batch_size = 10000
+        for start in range(0, N_ROWS, batch_size):
+            MessageLog.objects.bulk_create([
+                MessageLog(signal_id=_signal_id(i), t_entered=now)
+                for i in range(start, min(start + batch_size, N_ROWS))
+            ])
+
+    def _timed_get(self, url, params=None):
+        best = None
+        for i in range(REPEAT):
+            started = time.perf_counter()
+            with CaptureQueriesContext(connection) as context:
+                response = self.client.get(url, params)
+            elapsed = time.perf_counter() - started
+            best = elapsed if best is None else min(best, elapsed)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(response.data['results']), PAGE_SIZE)
+        return best, [q['sql'] for q in context.captured_queries]
+
+    def test_page_latency(self):
+        rows = []
+        for depth in DEPTHS:
+            n_skipped = int(N_ROWS * depth)
+            page = n_skipped // PAGE_SIZE + 1
+            offset_time, _ = self._timed_get(URL, {'page_size': PAGE_SIZE, 'page': page})
+
+            # rows are ordered by -signal_id, start after the skipped ones
+            position = _signal_id(N_ROWS - n_skipped)
+            cursor_time, queries = self._timed_get(_cursor_url(position))
+            rows.append((depth, offset_time, cursor_time))
+            record('messagelog_pagination.page_number', n_skipped, offset_time, rows=N_ROWS)
+            record('messagelog_pagination.cursor', n_skipped, cursor_time, rows=N_ROWS)
+
+            # a cursor page is one indexed range query, no COUNT, no OFFSET
+            self.assertEqual(len(queries), 1)
+            self.assertNotIn('COUNT(', queries[0].upper())
+            self.assertNotIn('OFFSET', queries[0].upper())
+
+        logger.warning('%d rows, page size %d', N_ROWS, PAGE_SIZE)
+        logger.warning('depth | page number (ms) | cursor (ms)')
+        for depth, offset_time, cursor_time in rows:
+            logger.warning(
+                '%4.0f%% | %16.1f | %11.1f', depth * 100, offset_time * 1000, cursor_time * 1000)
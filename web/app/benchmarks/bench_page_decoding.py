@@ -0,0 +1,93 @@
+"""
+Benchmark decoding pages of signals as received from the Signals API.
+
+Decoding the whole page (response.json) is compared with decoding it while
+it is received (SIGNALS_STREAM_PAGES), in time and in peak memory use.
+
+Run with:
+
+    python manage.py test benchmarks/bench_page_decoding.py
+"""
+import json
+import logging
+import tracemalloc
+
+import requests
+from django.test import SimpleTestCase
+
+from benchmarks.utils import SIZES, make_page, make_signals, measure, record
+from datasets.handle_signals import SIGNALS_STREAM_CHUNK_SIZE, _PageStream
+
+
+logger = logging.getLogger(__name__)
+
+BATCH_SIZE = 100
+
+
+def _peak_memory(function):
+    """
+    Peak memory allocated while running function, in bytes.
+    """
+    tracemalloc.start()
+    try:
+        function()
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+def _stream(body):
+    """
+    Decode body in chunks, handing signals over in batches (like _batch_signals).
+    """
+    chunks = (body[i:i + SIGNALS_STREAM_CHUNK_SIZE]
+              for i in range(0, len(body), SIGNALS_STREAM_CHUNK_SIZE))
+    page = _PageStream(chunks)
+    n, batch = 0, []
+    for signal in page.signals():
+        batch.append(signal)
+        if len(batch) >= BATCH_SIZE:
+            n, batch = n + len(batch), []
+    return n + len(batch)
+
+
+class BenchPageDecoding(SimpleTestCase):
+    def test_decode_page(self):
+        for size in SIZES:
+            body = json.dumps(make_page(make_signals(size))).encode('utf-8')
+
+            response = requests.Response()
+            response._content = body
+            response.encoding = 'utf-8'
+
+            self.assertEqual(len(response.json()['results']), size)
+
+            t_loads = measure(lambda: json.loads(body.decode('utf-8')))
+            t_response = measure(response.json)
+            record('page_decoding.json_loads', size, t_loads, bytes=len(body))
+            record('page_decoding.response_json', size, t_response, bytes=len(body))
+
+            logger.warning(
+                '%d signals (%d kB): json.loads %.2f ms, response.json %.2f ms',
+                size, len(body) // 1024, t_loads * 1000, t_response * 1000)
+
+    def test_stream_page(self):
+        for size in SIZES:
+            body = json.dumps(make_page(make_signals(size))).encode('utf-8')
+            self.assertEqual(_stream(body), size)
+
+            response = requests.Response()
+            response._content = body
+            response.encoding = 'utf-8'
+
+            t_whole = measure(response.json)
+            t_stream = measure(lambda: _stream(body))
+            m_whole = _peak_memory(response.json)
+            m_stream = _peak_memory(lambda: _stream(body))
+            record('page_decoding.stream', size, t_stream, bytes=len(body),
+                   peak_memory=m_stream, peak_memory_response_json=m_whole)
+
+            logger.warning(
+                '%d signals (%d kB): response.json %.2f ms, %d kB; stream %.2f ms, %d kB',
+                size, len(body) // 1024, t_whole * 1000, m_whole // 1024,
+                t_stream * 1000, m_stream // 1024)
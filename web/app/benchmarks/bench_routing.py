@@ -0,0 +1,66 @@
+"""
+Benchmark routing signals to handlers with get_handler.
+
+Many handlers are registered: most of them route on the sub category, some
+only implement can_handle. Routing is measured with an empty routing cache
+(cold) and with the routing decisions memoized (warm). Run with:
+
+    python manage.py test benchmarks/bench_routing.py
+"""
+import logging
+
+from django.test import SimpleTestCase
+
+from benchmarks.utils import SIZES, make_signals, measure, record
+from datasets.external import base
+
+logger = logging.getLogger(__name__)
+
+N_ROUTED_HANDLERS = 50
+N_UNROUTED_HANDLERS = 5
+
+
+def _make_handlers():
+    handlers = []
+    for i in range(N_UNROUTED_HANDLERS):
+        handlers.append(type('UnroutedHandler{}'.format(i), (base.BaseAPIHandler,), {
+            'name': 'unrouted-{}'.format(i),
+            'handle': lambda self, signal: (True, 'Sent'),
+            'can_handle': (
+                lambda self, signal, i=i: signal['location']['stadsdeel'] == 'X{}'.format(i)),
+        }))
+    for i in range(N_ROUTED_HANDLERS):
+        handlers.append(type('RoutedHandler{}'.format(i), (base.BaseAPIHandler,), {
+            'name': 'routed-{}'.format(i),
+            'routes': (('category.sub', 'Sub {}'.format(i)),),
+            'handle': lambda self, signal: (True, 'Sent'),
+        }))
+    return handlers
+
+
+class BenchGetHandler(SimpleTestCase):
+    def setUp(self):
+        base.reset_handlers()
+        for handler in _make_handlers():
+            base.register_handler(handler)
+
+    def tearDown(self):
+        base.reset_handlers()
+
+    def test_get_handler(self):
+        for size in SIZES:
+            signals = make_signals(size)
+            for i, signal in enumerate(signals):
+                signal['category']['sub'] = 'Sub {}'.format(i % (N_ROUTED_HANDLERS + 10))
+
+            def route():
+                return [base.get_handler(signal) for signal in signals]
+
+            t_cold = measure(route, setup=base._ROUTING_CACHE.clear)
+            t_warm = measure(route)
+            record('get_handler.cold', size, t_cold)
+            record('get_handler.warm', size, t_warm)
+
+            logger.warning(
+                '%d signals: cold %.2f us/signal, warm %.2f us/signal',
+                size, t_cold / size * 1e6, t_warm / size * 1e6)
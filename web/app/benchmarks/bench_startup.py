@@ -0,0 +1,114 @@
+"""
+Benchmark starting a management command with the web and worker settings.
+
+`manage.py check` boots Django and runs the system checks (which import the
+ROOT_URLCONF), like every command does before it is run, without connecting
+to the database or the Signals API. It is run in a new interpreter
+with -X importtime, once with signalsexport.settings and once with
+signalsexport.settings_worker; the wall time, the time spent importing and
+the slowest top-level imports are reported. Run with:
+
+    python manage.py test benchmarks/bench_startup.py
+
+(Benchmarks are not picked up by the normal test run, their file names do not
+start with test_.)
+"""
+import os
+import sys
+import time
+import logging
+import subprocess
+
+from django.conf import settings
+from django.test import SimpleTestCase
+
+from benchmarks.utils import record
+
+logger = logging.getLogger(__name__)
+
+SETTINGS_MODULES = ['signalsexport.settings', 'signalsexport.settings_worker']
+COMMAND = ['manage.py', 'check']
+REPEAT = 5
+SLOWEST = 10
+
+# The worker does not need these, they should not be imported at all
+NOT_IMPORTED = [
+    'rest_framework', 'rest_framework_gis', 'drf_yasg', 'corsheaders', 'datapunt_api',
+    'debug_toolbar', 'django_filters', 'django.contrib.gis', 'jsonschema', 'health',
+]
+
+
+def _parse_importtime(stderr):
+    """
+    Parse -X importtime output, return ({top-level module: cumulative seconds}, all modules).
+    """
+    top_level, modules = {}, set()
+    for line in stderr.splitlines():
+        if not line.startswith('import time:'):
+            continue
+        _, cumulative, name = line.split('|')
+        if not cumulative.strip().isdigit():
+            continue  # the header
+        modules.add(name.strip())
+        if not name.startswith('  '):  # not imported by another module
+            top_level[name.strip()] = int(cumulative) / 1e6
+    return top_level, modules
+
+
+def _imported(modules, package):
+    return any(name == package or name.startswith(package + '.') for name in modules)
+
+
+def _start(settings_module):
+    """
+    Start the command, return (wall time in seconds, top-level imports, all modules).
+
+    Returns None if the command does not start.
+    """
+    env = dict(os.environ, DJANGO_SETTINGS_MODULE=settings_module)
+    started = time.perf_counter()
+    process = subprocess.run(
+        [sys.executable, '-X', 'importtime'] + COMMAND, cwd=settings.BASE_DIR, env=env,
+        stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, universal_newlines=True)
+    elapsed = time.perf_counter() - started
+    if process.returncode != 0:
+        errors = [line for line in process.stderr.splitlines()
+                  if line and not line.startswith('import time:')]
+        logger.warning('%s does not start here: %s', settings_module, errors[-1])
+        return None
+    return (elapsed,) + _parse_importtime(process.stderr)
+
+
+class BenchStartup(SimpleTestCase):
+    def test_startup(self):
+        rows = []
+        for settings_module in SETTINGS_MODULES:
+            best = None
+            for i in range(REPEAT):
+                started = _start(settings_module)
+                if started is None:
+                    break
+                if best is None or started[0] < best[0]:
+                    best = started
+            if best is None:
+                continue  # e.g. GDAL is not installed, which the worker does not need
+
+            elapsed, imports, modules = best
+            import_time = sum(imports.values())
+            rows.append((settings_module, elapsed, import_time, imports, modules))
+            record('startup.' + settings_module.rpartition('.')[2], 1, elapsed,
+                   import_seconds=import_time)
+
+        self.assertEqual(rows[-1][0], 'signalsexport.settings_worker')
+        worker_modules = rows[-1][4]
+        for package in NOT_IMPORTED:
+            self.assertFalse(_imported(worker_modules, package), package)
+
+        logger.warning('settings | wall time (ms) | imports (ms)')
+        for settings_module, elapsed, import_time, _, _ in rows:
+            logger.warning(
+                '%-29s | %14.1f | %12.1f', settings_module, elapsed * 1000, import_time * 1000)
+        for settings_module, _, _, imports, _ in rows:
+            logger.warning('slowest top-level imports with %s:', settings_module)
+            for name, seconds in sorted(imports.items(), key=lambda item: -item[1])[:SLOWEST]:
+                logger.warning('%10.1f ms  %s', seconds * 1000, name)
@@ -0,0 +1,46 @@
+"""
+Benchmark STUF message generation for Sigmax.
+
+Compares _generate_stuf_message (str.format over the template, dateutil and
+a separate UTF-8 encoding step) with the precompiled _build_stuf_message. Run
+with:
+
+    python manage.py test benchmarks/bench_stuf_message.py
+"""
+import logging
+
+from django.test import SimpleTestCase
+
+from benchmarks.utils import SIZES, make_signals, measure, record
+from datasets.external import sigmax
+
+logger = logging.getLogger(__name__)
+
+
+class BenchStufMessage(SimpleTestCase):
+    def setUp(self):
+        logging.getLogger('datasets').setLevel(logging.WARNING)
+
+    def tearDown(self):
+        logging.getLogger('datasets').setLevel(logging.NOTSET)
+
+    def test_generate_vs_build(self):
+        for size in SIZES:
+            signals = make_signals(size)
+
+            def generate():
+                return [sigmax._generate_stuf_message(s).encode('utf-8') for s in signals]
+
+            def build():
+                return sigmax._build_stuf_messages(signals)
+
+            self.assertEqual(generate(), build())
+
+            t_generate = measure(generate)
+            t_build = measure(build)
+            record('stuf_message.generate', size, t_generate)
+            record('stuf_message.build', size, t_build)
+
+            logger.warning(
+                '%d messages: generate %.1f us/msg, build %.1f us/msg (%.1fx)',
+                size, t_generate / size * 1e6, t_build / size * 1e6, t_generate / t_build)
@@ -0,0 +1,65 @@
+"""
+Compare two benchmark result files (see benchmarks/conftest.py).
+
+    python benchmarks/compare.py OLD.json NEW.json [--threshold 0.2]
+
+Exits with status 1 if any benchmark got slower by more than the threshold
+(a fraction, default 0.2 = 20%).
+"""
+import sys
+import json
+import argparse
+
+
+def _load(file_name):
+    with open(file_name, 'r') as f:
+        data = json.load(f)
+    results = {}
+    for result in data['results']:
+        results[result['benchmark'], result['size']] = result['seconds']
+    return data.get('commit'), results
+
+
+def compare(old, new, threshold):
+    """
+    Return rows of (benchmark, size, old seconds, new seconds, ratio, regressed).
+    """
+    rows = []
+    for key in sorted(set(old) | set(new), key=lambda k: (k[0], k[1])):
+        old_seconds, new_seconds = old.get(key), new.get(key)
+        ratio = None
+        if old_seconds and new_seconds is not None:
+            ratio = new_seconds / old_seconds
+        regressed = ratio is not None and ratio > 1 + threshold
+        rows.append(key + (old_seconds, new_seconds, ratio, regressed))
+    return rows
+
+
+def _format_seconds(seconds):
+    return '-' if seconds is None else '{:.3f} ms'.format(seconds * 1000)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Compare two benchmark result files.')
+    parser.add_argument('old')
+    parser.add_argument('new')
+    parser.add_argument('--threshold', type=float, default=0.2)
+    args = parser.parse_args(argv)
+
+    old_commit, old = _load(args.old)
+    new_commit, new = _load(args.new)
+    rows = compare(old, new, args.threshold)
+
+    print('{} -> {}'.format(old_commit, new_commit))
+    print('{:<40} {:>6} {:>14} {:>14} {:>7}'.format('benchmark', 'size', 'old', 'new', 'ratio'))
+    for benchmark, size, old_seconds, new_seconds, ratio, regressed in rows:
+        print('{:<40} {:>6} {:>14} {:>14} {:>7}{}'.format(
+            benchmark, size, _format_seconds(old_seconds), _format_seconds(new_seconds),
+            '-' if ratio is None else '{:.2f}x'.format(ratio),
+            '  SLOWER' if regressed else ''))
+
+    return 1 if any(row[-1] for row in rows) else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
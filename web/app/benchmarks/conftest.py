@@ -0,0 +1,50 @@
+"""
+Write the benchmark results to a JSON file at the end of a benchmark run.
+
+The file is BENCHMARK_RESULTS if set, otherwise benchmarks/results/<commit>.json.
+Compare two runs with:
+
+    python benchmarks/compare.py benchmarks/results/<old>.json benchmarks/results/<new>.json
+"""
+import os
+import sys
+import json
+import platform
+import datetime
+import subprocess
+
+from benchmarks.utils import get_results
+
+RESULTS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'results')
+
+
+def _get_commit():
+    try:
+        commit = subprocess.check_output(
+            ['git', 'rev-parse', 'HEAD'], stderr=subprocess.DEVNULL,
+            cwd=os.path.dirname(os.path.abspath(__file__)))
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    return commit.decode('ascii').strip()
+
+
+def pytest_sessionfinish(session, exitstatus):
+    results = get_results()
+    if not results:
+        return
+
+    commit = _get_commit()
+    file_name = os.getenv('BENCHMARK_RESULTS')
+    if not file_name:
+        os.makedirs(RESULTS_DIR, exist_ok=True)
+        file_name = os.path.join(RESULTS_DIR, '{}.json'.format((commit or 'unknown')[:12]))
+
+    with open(file_name, 'w') as f:
+        json.dump({
+            'commit': commit,
+            'created_at': datetime.datetime.utcnow().isoformat() + 'Z',
+            'python': sys.version.split()[0],
+            'platform': platform.platform(),
+            'results': results,
+        }, f, indent=2)
+    sys.stdout.write('\nBenchmark results written to {}\n'.format(file_name))
@@ -0,0 +1,109 @@
+"""
+Helpers shared by the benchmarks: synthetic signals, timing and results.
+"""
+import os
+import copy
+import json
+import random
+import timeit
+import datetime
+
+from django.conf import settings
+
+# Number of signals (page sizes, batch sizes) the benchmarks are run with.
+SIZES = [1, 100, 10000]
+
+_RESULTS = []
+
+_CATEGORIES = [
+    ('Afval', 'Grofvuil'), ('Afval', 'Container is vol'),
+    ('Wegen, verkeer, straatmeubilair', 'Straatverlichting'),
+    ('Overlast Bedrijven en Horeca', 'Geluidsoverlast muziek'),
+    ('Openbaar groen en water', 'Boom'),
+]
+_STADSDELEN = ['A', 'B', 'E', 'F', 'K', 'M', 'N', 'T']
+
+
+def _load_example_signal():
+    fixture_file = os.path.join(
+        settings.FIXTURES_DIR, 'datasets', 'internal', 'auth_signal.json')
+    with open(fixture_file, 'r') as f:
+        return json.load(f)['results'][0]
+
+
+def make_signals(n, seed=0):
+    """
+    Generate n signals based on the auth_signal.json fixture.
+
+    Identifiers, texts, categories, locations and timestamps vary per signal
+    (reproducibly, given the seed) so that caches and string handling are
+    exercised like they are by real pages of signals.
+    """
+    example = _load_example_signal()
+    rng = random.Random(seed)
+    start = datetime.datetime(2018, 6, 1, tzinfo=datetime.timezone.utc)
+
+    signals = []
+    for i in range(n):
+        signal = copy.deepcopy(example)
+        created_at = start + datetime.timedelta(seconds=rng.randint(0, 90 * 24 * 3600))
+        main, sub = rng.choice(_CATEGORIES)
+
+        signal['id'] = i
+        signal['signal_id'] = 'bench-{}-{:08d}'.format(seed, i)
+        signal['text'] = 'Melding {} & "{}" <{}>'.format(i, sub, main)
+        signal['category']['main'] = main
+        signal['category']['sub'] = sub
+        signal['location']['stadsdeel'] = rng.choice(_STADSDELEN)
+        signal['location']['address']['huisnummer'] = str(rng.randint(1, 500))
+        signal['location']['geometrie']['coordinates'] = [
+            4.85 + rng.random() * 0.1, 52.33 + rng.random() * 0.07]
+        signal['created_at'] = created_at.isoformat().replace('+00:00', 'Z')
+        signal['updated_at'] = (created_at + datetime.timedelta(hours=1)).isoformat()
+        signal['incident_date_start'] = created_at.isoformat()
+        signals.append(signal)
+    return signals
+
+
+def make_page(signals, next_page=None):
+    """
+    Wrap signals in a page like the Signals API returns them.
+    """
+    return {
+        '_links': {
+            'self': {'href': 'https://acc.api.data.amsterdam.nl/signals/auth/signal/'},
+            'next': {'href': next_page},
+            'previous': {'href': None},
+        },
+        'count': len(signals),
+        'results': signals,
+    }
+
+
+def measure(function, repeat=5, setup=None):
+    """
+    Time a function, return the best of repeat runs (in seconds).
+
+    The optional setup function is called before every run, its time is not
+    measured.
+    """
+    best = None
+    for i in range(repeat):
+        if setup is not None:
+            setup()
+        elapsed = timeit.timeit(function, number=1)
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def record(benchmark, size, seconds, **extra):
+    """
+    Record a benchmark result, written to a JSON file when the run ends.
+    """
+    result = {'benchmark': benchmark, 'size': size, 'seconds': seconds}
+    result.update(extra)
+    _RESULTS.append(result)
+
+
+def get_results():
+    return list(_RESULTS)
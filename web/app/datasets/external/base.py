@@ -7,26 +7,96 @@ Assumptions:
 2) Each API handler catches any errors raised/caused by an external API in its
    handle method and returns a tuple of a Boolean False and a string description
    of the error if any.
+
+Routing: handlers either declare routes, (key, value) pairs that are matched
+against a signal (e.g. ('category.main', 'Afval') matches signals with
+signal['category']['main'] == 'Afval'), or implement can_handle. Routes are
+looked up in a table that is rebuilt on registration, and routing decisions
+are memoized per combination of route key values. Handlers that only
+implement can_handle are still asked one by one, but only those that take
+precedence over the handler found through the routing table.
 """
+import os
+import time
 import logging
+import threading
 from collections import OrderedDict
 
-LOG_FORMAT = '%(asctime)-15s - %(name)s - %(message)s'
-logging.basicConfig(format=LOG_FORMAT, level=logging.DEBUG)
+from datasets import metrics
+
 logger = logging.getLogger(__name__)
 
 # -- Keep the available handlers organized using a module global --
 _HANDLERS = OrderedDict()  # we want to keep the order of registration
 
+# -- Routing table, derived from _HANDLERS on registration --
+_ROUTES = {}  # (key, value) -> (precedence, handler)
+_ROUTE_KEYS = ()  # all keys that are used in routes
+_UNROUTED = []  # (precedence, handler) for handlers without routes
+_ROUTING_CACHE = {}  # tuple of values for _ROUTE_KEYS -> (precedence, handler) or None
+_ROUTING_CACHE_SIZE = 10000
+
+# -- Circuit breakers, one per handler name --
+CIRCUIT_BREAKER_THRESHOLD = int(os.getenv('CIRCUIT_BREAKER_THRESHOLD', 5))
+CIRCUIT_BREAKER_COOLDOWN = float(os.getenv('CIRCUIT_BREAKER_COOLDOWN', 60))
+_CIRCUIT_BREAKERS = {}
+_CIRCUIT_BREAKERS_LOCK = threading.Lock()
+
+# -- Rate limiters, one per handler name --
+RATE_LIMIT_MIN_FRACTION = float(os.getenv('RATE_LIMIT_MIN_FRACTION', 0.05))
+RATE_LIMIT_INCREASE = float(os.getenv('RATE_LIMIT_INCREASE', 0.1))
+RATE_LIMIT_DECREASE = float(os.getenv('RATE_LIMIT_DECREASE', 0.5))
+RATE_LIMIT_LATENCY_FACTOR = float(os.getenv('RATE_LIMIT_LATENCY_FACTOR', 3))
+_RATE_LIMITERS = {}
+_RATE_LIMITERS_LOCK = threading.Lock()
+
+
+class HandlerResult(tuple):
+    """
+    Outcome of handling a signal, a (success, status) tuple.
+
+    A failure is either transient (the signal is sent again later) or
+    permanent (the external API rejected the signal, sending it again would
+    fail again). The fault_code is the error code given by the external API.
+    """
+    def __new__(cls, success, status, permanent=False, fault_code=''):
+        result = super().__new__(cls, (success, status))
+        result.permanent = bool(permanent) and not success
+        result.fault_code = fault_code
+        return result
+
+    @property
+    def success(self):
+        return self[0]
+
+    @property
+    def status(self):
+        return self[1]
+
+    def __repr__(self):
+        return 'HandlerResult(success={!r}, status={!r}, permanent={!r}, fault_code={!r})'.format(
+            self.success, self.status, self.permanent, self.fault_code)
+
 
 class BaseAPIHandler():
     name = None
+    # Maximum number of calls to handle that may be in flight at the same time,
+    # handlers that allow more than one are called from a thread pool.
+    max_concurrency = 1
+    # Signals matching any of these (key, value) pairs are sent to this handler,
+    # handlers without routes are asked whether they can_handle each signal.
+    routes = ()
+    # Maximum number of calls to handle per second and the number of calls that
+    # may be made at once after a quiet period, None means no rate limit.
+    rate_limit = None
+    rate_burst = None
 
     def handle(self, signal):
         """
         Given a signal call out to an external API.
         """
-        # Expected return value a tuple of (success, status)
+        # Expected return value a tuple of (success, status), or a HandlerResult
+        # to tell permanent failures apart from transient ones.
         # Make sure that any Exceptions caused by the interactions with external
         # APIs are silenced.
         raise NotImplementedError(
@@ -39,6 +109,16 @@ class BaseAPIHandler():
         raise NotImplementedError(
             'Subclass {} to provide an implementation.'.format(self.__class__))
 
+    def is_overloaded(self, success, status):
+        """
+        Check whether the result of handle indicates an overloaded external API.
+
+        Note: by default every failure counts, override this to tell signals
+        that were rejected (e.g. invalid data) apart from server errors.
+        Permanent failures (see HandlerResult) never count.
+        """
+        return not success
+
 
 def register_handler(handler):
     """
@@ -49,18 +129,74 @@ def register_handler(handler):
     h = handler()
 
     if not isinstance(h, BaseAPIHandler):
-        logger.error('API handler must subclass {}'.format(BaseAPIHandler.__class__))
+        logger.error('API handler must subclass %s', BaseAPIHandler.__class__)
         raise TypeError
 
     if h.name is None:
-        logging.error('API handler must have a name attribute.')
+        logger.error('API handler must have a name attribute.')
         raise ValueError
 
     if type(h.name) != type(''):
-        logging.error('API handler name must be a string.')
+        logger.error('API handler name must be a string.')
         raise ValueError
 
     _HANDLERS[h.name] = h
+    _build_routing_table()
+
+
+def _build_routing_table():
+    """
+    Rebuild the routing table from the registered handlers.
+
+    Note: the precedence of a handler is its position in the registration
+    order, handlers that are registered later take precedence.
+    """
+    global _ROUTES, _ROUTE_KEYS, _UNROUTED, _ROUTING_CACHE
+
+    routes = {}
+    route_keys = []
+    unrouted = []
+    for precedence, handler in enumerate(_HANDLERS.values()):
+        if not handler.routes:
+            unrouted.append((precedence, handler))
+            continue
+
+        for key, value in handler.routes:
+            routes[(key, value)] = (precedence, handler)
+            if key not in route_keys:
+                route_keys.append(key)
+
+    _ROUTES = routes
+    _ROUTE_KEYS = tuple(route_keys)
+    _UNROUTED = unrouted
+    _ROUTING_CACHE = {}
+
+
+def _get_route_value(signal, key):
+    """
+    Look up a dotted key (like 'category.main') in a signal.
+    """
+    value = signal
+    for part in key.split('.'):
+        if not isinstance(value, dict):
+            return None
+        value = value.get(part)
+    return value
+
+
+def _route(values):
+    """
+    Find the routed handler with the highest precedence for route key values.
+    """
+    best = None
+    for key, value in zip(_ROUTE_KEYS, values):
+        try:
+            match = _ROUTES.get((key, value))
+        except TypeError:
+            continue  # unhashable value, cannot be routed on
+        if match is not None and (best is None or match[0] > best[0]):
+            best = match
+    return best
 
 
 def reset_handlers():
@@ -70,23 +206,249 @@ def reset_handlers():
     global _HANDLERS
 
     _HANDLERS = OrderedDict()
-    register_handler(LogOnlyHandler)
+    with _CIRCUIT_BREAKERS_LOCK:
+        _CIRCUIT_BREAKERS.clear()
+    with _RATE_LIMITERS_LOCK:
+        _RATE_LIMITERS.clear()
+    register_handler(LogOnlyHandler)  # also resets the routing table
 
 
 def get_handler(signal):
     """
     Choose the correct API handler for a signal.
     """
-    # We use an OrderedDict to keep our handler instances (to keep order). We
-    # reverse the iteration order over the values because the handler that was
-    # added last has precedence of those that were added earlier.
-    for handler in reversed(_HANDLERS.values()):
+    values = tuple(_get_route_value(signal, key) for key in _ROUTE_KEYS)
+    try:
+        routed = _ROUTING_CACHE[values]
+    except KeyError:
+        routed = _route(values)
+        if len(_ROUTING_CACHE) >= _ROUTING_CACHE_SIZE:
+            _ROUTING_CACHE.clear()
+        _ROUTING_CACHE[values] = routed
+    except TypeError:
+        routed = _route(values)  # unhashable values, not memoized
+
+    # Handlers without routes that were added after the routed handler (if any)
+    # take precedence, we iterate over them in reverse registration order.
+    for precedence, handler in reversed(_UNROUTED):
+        if routed is not None and precedence < routed[0]:
+            break
         try:
             if handler.can_handle(signal):
                 return handler
         except NotImplementedError:
             pass  # handler is not fully implemented
 
+    if routed is not None:
+        return routed[1]
+
+
+# -- Calling handlers --
+
+class CircuitOpen(Exception):
+    """
+    Raised instead of calling a handler whose circuit breaker is open.
+    """
+    pass
+
+
+class CircuitBreaker():
+    """
+    Stop calling an external API after a number of consecutive failures.
+
+    After failure_threshold consecutive failures the circuit opens and calls
+    are refused. Once cooldown seconds have passed a single call is let through
+    as a probe: if it succeeds the circuit closes again, if it fails the circuit
+    stays open for another cooldown period.
+    """
+    def __init__(self, failure_threshold=CIRCUIT_BREAKER_THRESHOLD,
+                 cooldown=CIRCUIT_BREAKER_COOLDOWN):
+        self.failure_threshold = failure_threshold
+        self.cooldown = cooldown
+
+        self.failures = 0
+        self.opened_at = None
+        self._probing = False
+        self._lock = threading.Lock()
+
+    @property
+    def is_open(self):
+        return self.opened_at is not None
+
+    def allow(self):
+        """
+        Check whether a call may be made now.
+        """
+        with self._lock:
+            if self.opened_at is None:
+                return True
+            if self._probing or time.monotonic() - self.opened_at < self.cooldown:
+                return False
+            self._probing = True
+            return True
+
+    def record_success(self):
+        with self._lock:
+            self.failures = 0
+            self.opened_at = None
+            self._probing = False
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            if self._probing or self.failures >= self.failure_threshold:
+                if self.opened_at is None:
+                    logger.warning('Circuit opened after %d consecutive failures.', self.failures)
+                self.opened_at = time.monotonic()
+            self._probing = False
+
+
+def get_circuit_breaker(name):
+    """
+    Get the circuit breaker for a handler (by name), create it if needed.
+    """
+    with _CIRCUIT_BREAKERS_LOCK:
+        if name not in _CIRCUIT_BREAKERS:
+            _CIRCUIT_BREAKERS[name] = CircuitBreaker()
+        return _CIRCUIT_BREAKERS[name]
+
+
+class RateLimiter():
+    """
+    Token bucket whose rate adapts to the health of an external API (AIMD).
+
+    Calls take a token from a bucket that holds at most burst tokens and is
+    refilled at the current rate. The rate starts at max_rate. When the
+    external API is overloaded (failures, exceptions or latency well above
+    the average) the rate is multiplied by decrease, at most once per second
+    so that calls in flight at the same time count as one event. Every
+    healthy response adds increase (calls per second) until max_rate is
+    reached again.
+    """
+    def __init__(self, max_rate, burst=None, min_rate=None,
+                 increase=RATE_LIMIT_INCREASE, decrease=RATE_LIMIT_DECREASE,
+                 latency_factor=RATE_LIMIT_LATENCY_FACTOR):
+        self.max_rate = float(max_rate)
+        self.burst = float(burst if burst is not None else max(max_rate, 1))
+        self.min_rate = float(
+            min_rate if min_rate is not None else self.max_rate * RATE_LIMIT_MIN_FRACTION)
+        self.increase = increase
+        self.decrease = decrease
+        self.latency_factor = latency_factor
+
+        self.rate = self.max_rate
+        self.avg_latency = None
+        self._tokens = self.burst
+        self._updated_at = time.monotonic()
+        self._decreased_at = None
+        self._lock = threading.Lock()
+
+    def _refill(self, now):
+        elapsed = max(now - self._updated_at, 0)
+        self._tokens = min(self._tokens + elapsed * self.rate, self.burst)
+        self._updated_at = now
+
+    def acquire(self):
+        """
+        Take a token, wait for one if the bucket is empty.
+        """
+        while True:
+            with self._lock:
+                self._refill(time.monotonic())
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                wait = (1 - self._tokens) / self.rate
+            time.sleep(wait)
+
+    def record(self, latency, overloaded):
+        """
+        Adapt the rate to the outcome and latency (in seconds) of a call.
+        """
+        with self._lock:
+            if self.avg_latency is not None and \
+                    latency > self.avg_latency * self.latency_factor:
+                overloaded = True
+
+            if overloaded:
+                now = time.monotonic()
+                if self._decreased_at is None or now - self._decreased_at >= 1:
+                    self._refill(now)
+                    self.rate = max(self.rate * self.decrease, self.min_rate)
+                    self._decreased_at = now
+                    logger.warning('Rate lowered to %.2f calls per second.', self.rate)
+            else:
+                self._refill(time.monotonic())
+                self.rate = min(self.rate + self.increase, self.max_rate)
+                # Only healthy calls count towards the average latency, slow
+                # calls would otherwise raise the bar for what is slow.
+                if self.avg_latency is None:
+                    self.avg_latency = latency
+                else:
+                    self.avg_latency = 0.9 * self.avg_latency + 0.1 * latency
+
+
+def get_rate_limiter(handler):
+    """
+    Get the rate limiter for a handler, None if the handler has no rate limit.
+    """
+    if handler.rate_limit is None:
+        return None
+    with _RATE_LIMITERS_LOCK:
+        if handler.name not in _RATE_LIMITERS:
+            _RATE_LIMITERS[handler.name] = RateLimiter(handler.rate_limit, handler.rate_burst)
+        return _RATE_LIMITERS[handler.name]
+
+
+def call_handler(handler, signal):
+    """
+    Send a signal using a handler, return a HandlerResult.
+
+    Raises CircuitOpen (without calling the handler) while the circuit breaker
+    of the handler is open. Failures, including exceptions raised by the
+    handler (which are re-raised), are counted by the circuit breaker, except
+    permanent failures (the external API did answer). Calls wait for the rate
+    limiter of the handler (if any), which is told about the outcome and
+    latency of each call.
+    """
+    breaker = get_circuit_breaker(handler.name)
+    if not breaker.allow():
+        raise CircuitOpen('Calls to {} are suspended.'.format(handler.name))
+
+    limiter = get_rate_limiter(handler)
+    if limiter is not None:
+        limiter.acquire()
+
+    started = time.monotonic()
+    try:
+        result = handler.handle(signal)
+    except Exception:
+        latency = time.monotonic() - started
+        metrics.HANDLE_SECONDS.labels(handler.name).observe(latency)
+        breaker.record_failure()
+        if limiter is not None:
+            limiter.record(latency, True)
+        raise
+
+    latency = time.monotonic() - started
+    metrics.HANDLE_SECONDS.labels(handler.name).observe(latency)
+    if not isinstance(result, HandlerResult):
+        result = HandlerResult(*result)
+    if logger.isEnabledFor(logging.DEBUG):  # skip building the extra fields
+        logger.debug(
+            'Handler %s handled signal %s in %.3f seconds: %s',
+            handler.name, signal['signal_id'], latency, result.status,
+            extra={'signal_id': signal['signal_id'], 'handler': handler.name,
+                   'seconds': latency, 'success': result.success})
+    if result.success or result.permanent:
+        breaker.record_success()
+    else:
+        breaker.record_failure()
+    if limiter is not None:
+        overloaded = not result.permanent and handler.is_overloaded(*result)
+        limiter.record(latency, overloaded)
+    return result
+
 
 # -- Initialize the available API handlers list with a default handler that only logs --
 
@@ -97,7 +459,9 @@ class LogOnlyHandler(BaseAPIHandler):
     name = 'local-log-only'
 
     def handle(self, signal):
-        logger.info('Signal {} will only be logged'.format(signal['signal_id']))
+        logger.info(
+            'Signal %s will only be logged', signal['signal_id'],
+            extra={'signal_id': signal['signal_id'], 'handler': self.name})
         return True, 'Only logged'
 
     def can_handle(self, signal):
@@ -3,19 +3,34 @@ Send messages to the external Sigmax API.
 
 Minimal implementation based on work by Maarten Sukel.
 """
+import io
 import os
+import re
+import string
 import logging
 import datetime
+import threading
 import requests
+from contextlib import closing
+from requests.adapters import HTTPAdapter
 from dateutil.parser import parse
+from lxml import etree
 from xml.sax.saxutils import escape
 
-from datasets.external.base import BaseAPIHandler
+from datasets import metrics
+from datasets.external.base import BaseAPIHandler, HandlerResult
 
-LOG_FORMAT = '%(asctime)-15s - %(name)s - %(message)s'
-logging.basicConfig(format=LOG_FORMAT, level=logging.DEBUG)
 logger = logging.getLogger(__name__)
 
+# -- connection settings --
+SIGMAX_MAX_CONCURRENCY = int(os.getenv('SIGMAX_MAX_CONCURRENCY', 4))
+SIGMAX_POOL_SIZE = int(os.getenv('SIGMAX_POOL_SIZE', SIGMAX_MAX_CONCURRENCY))
+SIGMAX_KEEP_ALIVE = os.getenv('SIGMAX_KEEP_ALIVE', '1') == '1'
+SIGMAX_CONNECT_TIMEOUT = float(os.getenv('SIGMAX_CONNECT_TIMEOUT', 5))
+SIGMAX_READ_TIMEOUT = float(os.getenv('SIGMAX_READ_TIMEOUT', 30))
+SIGMAX_RATE_LIMIT = float(os.getenv('SIGMAX_RATE_LIMIT', 10))
+SIGMAX_RATE_BURST = float(os.getenv('SIGMAX_RATE_BURST', SIGMAX_RATE_LIMIT))
+
 # -- format string for message generation --
 
 PLACEHOLDER_STRING = ''
@@ -88,6 +103,54 @@ def _format_date(dt):
     return dt.strftime('%Y%m%d')
 
 
+# Timestamps as provided by the Signals API, e.g. 2018-06-27T09:13:15.277401Z
+_ISO_8601 = re.compile(
+    r'(\d{4})-(\d{2})-(\d{2})T(\d{2}):(\d{2}):(\d{2})(?:\.\d+)?(?:Z|[+-]\d{2}:?\d{2})?$')
+
+
+def _format_timestamp(value):
+    """
+    Format an ISO8601 timestamp string as a tuple (YYYYMMDD, YYYYMMDDHHMMSS).
+
+    Note: timestamps in the format the Signals API uses are not converted to
+    datetime objects, anything else is parsed with dateutil.
+    """
+    match = _ISO_8601.match(value)
+    if match:
+        year, month, day, hour, minute, second = match.groups()
+        try:
+            datetime.datetime(int(year), int(month), int(day),
+                              int(hour), int(minute), int(second))
+        except ValueError:
+            pass  # not a valid date, let dateutil decide what to do with it
+        else:
+            if year >= '1000':
+                date = year + month + day
+                return date, date + hour + minute + second
+
+    dt = parse(value)
+    return _format_date(dt), _format_datetime(dt)
+
+
+def _compile_template(template):
+    """
+    Split a format string in UTF-8 encoded static chunks and field names.
+
+    Returns a list of chunks and a list of field names, the message is the
+    chunks with the field values in between.
+    """
+    chunks = []
+    field_names = []
+    for literal, field_name, _, _ in string.Formatter().parse(template):
+        chunks.append(literal.encode('utf-8'))
+        if field_name is not None:
+            field_names.append(field_name)
+
+    if len(chunks) == len(field_names):
+        chunks.append(b'')  # template ends with a field
+    return chunks, field_names
+
+
 class ServiceNotConfigured(Exception):
     pass
 
@@ -98,8 +161,8 @@ def _generate_stuf_message(signal):
     """
     Generate the XML needed for Sigmax.
     """
-    logger.debug('Openbare ruimte naam in signal: "{}"'.format(
-        signal['location']['address']['openbare_ruimte']))
+    logger.debug(
+        'Openbare ruimte naam in signal: "%s"', signal['location']['address']['openbare_ruimte'])
 
     # convert the ISO8601 datetime strings (from JSON data) to datetime objects
     created_at = parse(signal['created_at'])
@@ -121,41 +184,179 @@ def _generate_stuf_message(signal):
     })
 
 
-def _send_stuf_message(stuf_msg):
+class SigmaxClient():
     """
-    Send a STUF message to the server that is configured.
+    Connection to the Sigmax server, keeps connections open between messages.
+
+    Server and credentials are read from the environment when the client is
+    created (assumption, these are set for either testing or production ---
+    not configurable at run time). The client may be shared between threads,
+    at most pool_size connections are used at the same time.
+    """
+    def __init__(self, server=None, auth_token=None, pool_size=SIGMAX_POOL_SIZE,
+                 keep_alive=SIGMAX_KEEP_ALIVE,
+                 timeout=(SIGMAX_CONNECT_TIMEOUT, SIGMAX_READ_TIMEOUT)):
+        self.server = server or os.getenv('SIGMAX_SERVER', None)
+        self.auth_token = auth_token or os.getenv('SIGMAX_AUTH_TOKEN', None)
+        logger.debug('SIGMAX_SERVER: %s', self.server)
+
+        if not self.auth_token or not self.server:
+            msg = 'SIGMAX_AUTH_TOKEN or SIGMAX_SERVER not configured.'
+            raise ServiceNotConfigured(msg)
+
+        self.timeout = timeout
+        self.headers = {
+            'SOAPAction': 'http://www.egem.nl/StUF/sector/zkn/0310/CreeerZaak_Lk01',
+            'Content-Type': 'text/xml; charset=UTF-8',
+            'Authorization': 'Basic ' + self.auth_token,
+        }
+        if not keep_alive:
+            self.headers['Connection'] = 'close'
+
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size, pool_block=True)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+
+    def send(self, stuf_msg):
+        """
+        Send a STUF message (str or UTF-8 encoded bytes), return the response.
+        """
+        encoded = stuf_msg.encode('utf-8') if isinstance(stuf_msg, str) else stuf_msg
+        headers = dict(self.headers)
+        headers['Content-Length'] = str(len(encoded))
+
+        return self.session.post(
+            url=self.server,
+            headers=headers,
+            data=encoded,
+            timeout=self.timeout,
+            verify=False
+        )
+
+    def close(self):
+        self.session.close()
+
+
+_TEMPLATE_CHUNKS, _TEMPLATE_FIELD_NAMES = _compile_template(TEMPLATE)
+_OMSCHRIJVING = escape('Dit is een test bericht').encode('utf-8')
+
+
+def _build_stuf_message(signal):
+    """
+    Generate the XML needed for Sigmax as UTF-8 encoded bytes.
+
+    Produces the same message as _generate_stuf_message, using the template
+    split up in advance.
     """
-    # Grab credentials from environment (assumption, these are set for
-    # either testing or production --- not configurable at run time).
-    SIGMAX_AUTH_TOKEN = os.getenv('SIGMAX_AUTH_TOKEN', None)
-    SIGMAX_SERVER = os.getenv('SIGMAX_SERVER', None)
-    logger.debug('SIGMAX_SERVER: {}'.format(SIGMAX_SERVER))
-    logger.debug('SIGMAX_AUTH_TOKEN: {}'.format(SIGMAX_AUTH_TOKEN))
-
-    if not SIGMAX_AUTH_TOKEN or not SIGMAX_SERVER:
-        msg = 'SIGMAX_AUTH_TOKEN or SIGMAX_SERVER not configured.'
-        raise ServiceNotConfigured(msg)
-
-    # Prepare our request to Sigmax
-    encoded = stuf_msg.encode('utf-8')
-    headers = {
-        'SOAPAction': 'http://www.egem.nl/StUF/sector/zkn/0310/CreeerZaak_Lk01',
-        'Content-Type': 'text/xml; charset=UTF-8',
-        'Authorization': 'Basic ' + SIGMAX_AUTH_TOKEN,
-        'Content-Length': bytes(len(encoded))
+    address = signal['location']['address']
+    coordinates = signal['location']['geometrie']['coordinates']
+    registratiedatum, tijdstipbericht = _format_timestamp(signal['created_at'])
+    startdatum, _ = _format_timestamp(signal['incident_date_start'])
+    einddatumgepland, _ = _format_timestamp(signal['incident_date_end'])
+
+    values = {
+        'PRIMARY_KEY': escape(signal['signal_id']).encode('utf-8'),
+        'OMSCHRIJVING': _OMSCHRIJVING,
+        'TIJDSTIPBERICHT': tijdstipbericht.encode('ascii'),
+        'STARTDATUM': startdatum.encode('ascii'),
+        'REGISTRATIEDATUM': registratiedatum.encode('ascii'),
+        'EINDDATUMGEPLAND': einddatumgepland.encode('ascii'),
+        'OPENBARERUIMTENAAM': escape(address['openbare_ruimte']).encode('utf-8'),
+        'HUISNUMMER': escape(address['huisnummer']).encode('utf-8'),
+        'POSTCODE': escape(address['postcode']).encode('utf-8'),
+        'X': escape(str(coordinates[0])).encode('utf-8'),
+        'Y': escape(str(coordinates[1])).encode('utf-8'),
     }
 
-    # Send our message to Sigmax
-    response = requests.post(
-        url=SIGMAX_SERVER,
-        headers=headers,
-        data=encoded,
-        verify=False
-    )
+    buffer = bytearray(_TEMPLATE_CHUNKS[0])
+    for field_name, chunk in zip(_TEMPLATE_FIELD_NAMES, _TEMPLATE_CHUNKS[1:]):
+        buffer += values[field_name]
+        buffer += chunk
+    return bytes(buffer)
+
+
+def _build_stuf_messages(signals):
+    """
+    Generate the XML needed for Sigmax for a page of signals.
+    """
+    return [_build_stuf_message(signal) for signal in signals]
+
 
+def _send_stuf_message(stuf_msg, client=None):
+    """
+    Send a STUF message to the server that is configured.
+
+    Note: without a client a new connection is set up for this message only,
+    it is closed when the response was received.
+    """
     # We return the response object so that we can check the response from
     # the external API handler.
-    return response
+    if client is not None:
+        return client.send(stuf_msg)
+    with closing(SigmaxClient()) as client:
+        return client.send(stuf_msg)
+
+
+# HTTP statusses that mean the message itself was rejected (the others,
+# server errors, "too many requests" and authorization problems, are
+# expected to go away).
+_PERMANENT_HTTP_STATUSSES = {400, 404, 405, 409, 410, 413, 415, 422}
+_FAULT_BERICHT = re.compile(r'^Fo\d\dBericht$')
+
+
+def _read_fault(content):
+    """
+    Find the fault in a SOAP response, return (fault_code, description, permanent).
+
+    StUF foutberichten (Fo01, Fo02, Fo03 ...) take precedence over the SOAP
+    Fault they are wrapped in, their plek tells whether the client (the
+    message, permanent) or the server (transient) is at fault. For a bare
+    SOAP Fault the faultcode (Client or Server) tells. The response is parsed
+    incrementally and parsing stops at the first acknowledgement (Bv0x) or
+    fault. Returns None when there is no fault (or the response is no XML).
+    """
+    if not content:
+        return None
+    events = etree.iterparse(
+        io.BytesIO(content), events=('end',), resolve_entities=False, no_network=True)
+    try:
+        for _, element in events:
+            if not isinstance(element.tag, str):
+                continue  # comment or processing instruction
+            name = etree.QName(element).localname
+            if _FAULT_BERICHT.match(name):
+                code = element.findtext('.//{*}code') or name
+                plek = (element.findtext('.//{*}plek') or '').strip()
+                description = element.findtext('.//{*}omschrijving') or ''
+                return code.strip(), description.strip(), plek != 'server'
+            if name == 'Fault':
+                code = (element.findtext('faultcode') or element.findtext('{*}faultcode') or '')
+                description = (
+                    element.findtext('faultstring') or element.findtext('{*}faultstring') or '')
+                code = code.strip()
+                return code, description.strip(), code.rpartition(':')[2] == 'Client'
+            if name.startswith('Bv') and name.endswith('Bericht'):
+                return None
+    except etree.XMLSyntaxError:
+        pass
+    return None
+
+
+def _classify_response(response):
+    """
+    Tell success, transient and permanent failures apart, return a HandlerResult.
+    """
+    status = 'HTTP {}'.format(response.status_code)
+    fault = _read_fault(response.content)
+    if fault is not None:
+        fault_code, description, permanent = fault
+        status = '{} {}: {}'.format(status, fault_code, description)[:255]
+        return HandlerResult(False, status, permanent=permanent, fault_code=fault_code)
+    if response.status_code == 200:
+        return HandlerResult(True, status)
+    return HandlerResult(
+        False, status, permanent=response.status_code in _PERMANENT_HTTP_STATUSSES)
 
 
 # -- Sigmax API Handler --
@@ -164,6 +365,35 @@ def _send_stuf_message(stuf_msg):
 # TODO: implement can_handle method on SigmaxHandler
 
 class SigmaxHandler(BaseAPIHandler):
+    name = 'sigmax'
+    max_concurrency = SIGMAX_MAX_CONCURRENCY
+    rate_limit = SIGMAX_RATE_LIMIT
+    rate_burst = SIGMAX_RATE_BURST
+
+    def __init__(self):
+        self._client = None
+        self._client_lock = threading.Lock()
+
+    @property
+    def client(self):
+        """
+        Client shared by all messages sent by this handler (created when needed).
+        """
+        with self._client_lock:
+            if self._client is None:
+                self._client = SigmaxClient()
+            return self._client
+
     def handle(self, signal):
-        msg = _generate_stuf_message(signal)
-        _send_stuf_message(msg)
+        try:
+            with metrics.MESSAGE_GENERATION_SECONDS.labels(self.name).time():
+                msg = _build_stuf_message(signal)
+        except (KeyError, IndexError, TypeError, ValueError, OverflowError, AttributeError) as e:
+            # fields missing or malformed, sending it again would fail again
+            return HandlerResult(
+                False, 'Invalid signal: {}: {}'.format(e.__class__.__name__, e), permanent=True)
+        try:
+            response = _send_stuf_message(msg, client=self.client)
+        except requests.RequestException as e:
+            return HandlerResult(False, 'Sigmax not reachable: {}'.format(e.__class__.__name__))
+        return _classify_response(response)
@@ -1,3 +1,5 @@
+from unittest import mock
+
 from django.test import TestCase
 
 from datasets.external import base
@@ -23,11 +25,36 @@ class CannotHandler(base.BaseAPIHandler):
         return False
 
 
+class AfvalHandler(base.BaseAPIHandler):
+    name = 'afval'
+    routes = (('category.main', 'Afval'), ('status.target_api', 'afval-api'))
+
+    def handle(self, signal):
+        return True, 'afval'
+
+
+class GrofvuilHandler(base.BaseAPIHandler):
+    name = 'grofvuil'
+    routes = (('category.sub', 'Grofvuil'),)
+
+    def handle(self, signal):
+        return True, 'grofvuil'
+
+
+def _signal(main=None, sub=None, target_api=None):
+    return {
+        'signal_id': 'Does not matter',
+        'category': {'main': main, 'sub': sub},
+        'status': {'target_api': target_api},
+    }
+
+
 class TestBaseAPIHandler(TestCase):
     def test_notimplemented(self):
         handler = base.BaseAPIHandler()
 
         self.assertEquals(handler.name, None)
+        self.assertEquals(handler.max_concurrency, 1)
 
         with self.assertRaises(NotImplementedError):
             handler.handle(None)
@@ -63,6 +90,280 @@ class TestRegistration(TestCase):
         self.assertIsInstance(h, APITestHandler)
 
 
+class TestRouting(TestCase):
+    def setUp(self):
+        base.reset_handlers()
+
+    def test_route(self):
+        base.register_handler(AfvalHandler)
+
+        self.assertIsInstance(base.get_handler(_signal(main='Afval')), AfvalHandler)
+        self.assertIsInstance(base.get_handler(_signal(target_api='afval-api')), AfvalHandler)
+        self.assertIsInstance(base.get_handler(_signal(main='Overlast')), base.LogOnlyHandler)
+
+    def test_missing_keys(self):
+        base.register_handler(AfvalHandler)
+
+        self.assertIsInstance(base.get_handler({'signal_id': '1'}), base.LogOnlyHandler)
+        self.assertIsInstance(
+            base.get_handler({'signal_id': '1', 'category': 'Afval'}), base.LogOnlyHandler)
+        self.assertIsInstance(
+            base.get_handler({'signal_id': '1', 'category': {'main': ['Afval']}}),
+            base.LogOnlyHandler)
+
+    def test_routed_precedence(self):
+        """Check that later registered routed handlers take precedence."""
+        base.register_handler(AfvalHandler)
+        base.register_handler(GrofvuilHandler)
+
+        h = base.get_handler(_signal(main='Afval', sub='Grofvuil'))
+        self.assertIsInstance(h, GrofvuilHandler)
+
+    def test_unrouted_handler_registered_later(self):
+        base.register_handler(AfvalHandler)
+        base.register_handler(APITestHandler)
+
+        self.assertIsInstance(base.get_handler(_signal(main='Afval')), APITestHandler)
+
+    def test_routed_handler_registered_later(self):
+        base.register_handler(APITestHandler)
+        base.register_handler(AfvalHandler)
+
+        self.assertIsInstance(base.get_handler(_signal(main='Afval')), AfvalHandler)
+        self.assertIsInstance(base.get_handler(_signal(main='Overlast')), APITestHandler)
+
+    def test_routing_is_memoized(self):
+        base.register_handler(AfvalHandler)
+
+        with mock.patch('datasets.external.base._route', wraps=base._route) as route:
+            base.get_handler(_signal(main='Afval'))
+            base.get_handler(_signal(main='Afval'))
+            base.get_handler(_signal(main='Overlast'))
+
+        self.assertEqual(route.call_count, 2)
+
+    def test_registration_clears_memoized_routes(self):
+        base.register_handler(AfvalHandler)
+        self.assertIsInstance(base.get_handler(_signal(main='Afval')), AfvalHandler)
+
+        base.register_handler(APITestHandler)
+        self.assertIsInstance(base.get_handler(_signal(main='Afval')), APITestHandler)
+
+        base.reset_handlers()
+        self.assertIsInstance(base.get_handler(_signal(main='Afval')), base.LogOnlyHandler)
+
+
+class FailingHandler(base.BaseAPIHandler):
+    name = 'failing'
+
+    def handle(self, signal):
+        return False, 'always fails'
+
+    def can_handle(self, signal):
+        return True
+
+
+class TestCircuitBreaker(TestCase):
+    def test_opens_after_consecutive_failures(self):
+        breaker = base.CircuitBreaker(failure_threshold=3, cooldown=60)
+
+        breaker.record_failure()
+        breaker.record_failure()
+        breaker.record_success()
+        breaker.record_failure()
+        breaker.record_failure()
+        self.assertTrue(breaker.allow())
+
+        breaker.record_failure()
+        self.assertTrue(breaker.is_open)
+        self.assertFalse(breaker.allow())
+
+    def test_probe_after_cooldown(self):
+        breaker = base.CircuitBreaker(failure_threshold=1, cooldown=60)
+        breaker.record_failure()
+
+        with mock.patch('time.monotonic', return_value=breaker.opened_at + 61):
+            self.assertTrue(breaker.allow())
+            self.assertFalse(breaker.allow())  # only one probe at a time
+
+            breaker.record_failure()
+            self.assertFalse(breaker.allow())
+
+        with mock.patch('time.monotonic', return_value=breaker.opened_at + 61):
+            self.assertTrue(breaker.allow())
+            breaker.record_success()
+
+        self.assertFalse(breaker.is_open)
+        self.assertTrue(breaker.allow())
+
+    def test_call_handler(self):
+        base.reset_handlers()
+        handler = FailingHandler()
+
+        for i in range(base.CIRCUIT_BREAKER_THRESHOLD):
+            self.assertEqual(base.call_handler(handler, {'signal_id': '1'}), (False, 'always fails'))
+
+        with self.assertRaises(base.CircuitOpen):
+            base.call_handler(handler, {'signal_id': '1'})
+
+        # other handlers have their own circuit breaker
+        self.assertEqual(
+            base.call_handler(APITestHandler(), {'signal_id': '1'}), (True, 'test always works'))
+
+    def test_call_handler_exception(self):
+        base.reset_handlers()
+        handler = APITestHandler()
+
+        with mock.patch.object(handler, 'handle', side_effect=RuntimeError):
+            with self.assertRaises(RuntimeError):
+                base.call_handler(handler, {'signal_id': '1'})
+
+        self.assertEqual(base.get_circuit_breaker('test').failures, 1)
+
+
+    def test_permanent_failures_are_not_counted(self):
+        base.reset_handlers()
+        handler = FailingHandler()
+        rejected = base.HandlerResult(False, 'invalid message', permanent=True, fault_code='E1')
+
+        with mock.patch.object(handler, 'handle', return_value=rejected):
+            for i in range(base.CIRCUIT_BREAKER_THRESHOLD + 1):
+                result = base.call_handler(handler, {'signal_id': '1'})
+
+        self.assertEqual(result, (False, 'invalid message'))
+        self.assertTrue(result.permanent)
+        self.assertEqual(result.fault_code, 'E1')
+        self.assertFalse(base.get_circuit_breaker('failing').is_open)
+
+
+class TestHandlerResult(TestCase):
+    def test_tuple(self):
+        result = base.HandlerResult(True, 'Sent')
+        success, status = result
+
+        self.assertEqual((success, status), (True, 'Sent'))
+        self.assertEqual(result, (True, 'Sent'))
+        self.assertFalse(result.permanent)
+        self.assertEqual(result.fault_code, '')
+
+    def test_success_is_never_permanent(self):
+        self.assertFalse(base.HandlerResult(True, 'Sent', permanent=True).permanent)
+
+
+class FakeClock():
+    def __init__(self):
+        self.now = 1000.0
+        self.slept = []
+
+    def monotonic(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.slept.append(seconds)
+        self.now += seconds
+
+
+class RateLimitedHandler(APITestHandler):
+    name = 'rate-limited'
+    rate_limit = 2
+    rate_burst = 3
+
+
+class TestRateLimiter(TestCase):
+    def setUp(self):
+        self.clock = FakeClock()
+        patchers = [
+            mock.patch('time.monotonic', self.clock.monotonic),
+            mock.patch('time.sleep', self.clock.sleep),
+        ]
+        for patcher in patchers:
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def test_token_bucket(self):
+        limiter = base.RateLimiter(max_rate=2, burst=3)
+
+        for i in range(3):
+            limiter.acquire()
+        self.assertEqual(self.clock.slept, [])
+
+        limiter.acquire()
+        self.assertEqual(self.clock.slept, [0.5])
+
+        # the bucket does not fill beyond burst
+        self.clock.now += 60
+        for i in range(4):
+            limiter.acquire()
+        self.assertEqual(self.clock.slept, [0.5, 0.5])
+
+    def test_decrease_on_overload(self):
+        limiter = base.RateLimiter(max_rate=10, min_rate=1)
+
+        limiter.record(0.1, True)
+        self.assertEqual(limiter.rate, 5)
+
+        # calls that were in flight together count as one event
+        limiter.record(0.1, True)
+        self.assertEqual(limiter.rate, 5)
+
+        for i in range(5):
+            self.clock.now += 1
+            limiter.record(0.1, True)
+        self.assertEqual(limiter.rate, 1)
+
+    def test_increase_when_healthy(self):
+        limiter = base.RateLimiter(max_rate=10, increase=1)
+        limiter.record(0.1, True)
+
+        for i in range(3):
+            limiter.record(0.1, False)
+        self.assertEqual(limiter.rate, 8)
+
+        for i in range(10):
+            limiter.record(0.1, False)
+        self.assertEqual(limiter.rate, 10)
+
+    def test_decrease_on_rising_latency(self):
+        limiter = base.RateLimiter(max_rate=10, latency_factor=3)
+        for i in range(10):
+            limiter.record(0.1, False)
+        self.assertEqual(limiter.rate, 10)
+
+        limiter.record(0.2, False)
+        self.assertEqual(limiter.rate, 10)
+
+        limiter.record(1.0, False)
+        self.assertEqual(limiter.rate, 5)
+
+    def test_call_handler(self):
+        base.reset_handlers()
+        handler = RateLimitedHandler()
+
+        for i in range(5):
+            base.call_handler(handler, {'signal_id': '1'})
+        self.assertEqual(self.clock.slept, [0.5, 0.5])
+        self.assertIs(base.get_rate_limiter(handler), base.get_rate_limiter(RateLimitedHandler()))
+
+        with mock.patch.object(handler, 'handle', side_effect=RuntimeError):
+            with self.assertRaises(RuntimeError):
+                base.call_handler(handler, {'signal_id': '1'})
+        self.assertEqual(base.get_rate_limiter(handler).rate, 1)
+
+    def test_rejections_do_not_lower_the_rate(self):
+        base.reset_handlers()
+        handler = RateLimitedHandler()
+        rejected = base.HandlerResult(False, 'invalid message', permanent=True)
+
+        with mock.patch.object(handler, 'handle', return_value=rejected):
+            base.call_handler(handler, {'signal_id': '1'})
+        self.assertEqual(base.get_rate_limiter(handler).rate, 2)
+
+    def test_no_rate_limit(self):
+        self.assertIsNone(base.get_rate_limiter(APITestHandler()))
+        self.assertFalse(APITestHandler().is_overloaded(True, 'OK'))
+        self.assertTrue(APITestHandler().is_overloaded(False, 'Error'))
+
+
 class TestLogOnlyHandler(TestCase):
     def test_will_handle_any_signal(self):
         handler = base.LogOnlyHandler()
@@ -9,6 +9,7 @@ import copy
 import datetime
 from unittest import mock
 
+import requests
 from lxml import etree
 from dateutil.parser import parse
 
@@ -18,8 +19,6 @@ from django.conf import settings
 from datasets.external import sigmax
 
 
-LOG_FORMAT = '%(asctime)-15s - %(name)s - %(message)s'
-logging.basicConfig(format=LOG_FORMAT, level=logging.DEBUG)
 logging.disable(logging.NOTSET)
 logger = logging.getLogger(__name__)
 
@@ -156,6 +155,86 @@ class TestGenerateStufMessage(TestCase):
         self.assertEquals(len(NEED_TO_FIND), 0)
 
 
+class TestBuildStufMessage(TestCase):
+    @classmethod
+    def setUpClass(cls):
+        fixture_file = os.path.join(
+            settings.FIXTURES_DIR, 'datasets', 'internal', 'auth_signal.json')
+
+        with open(fixture_file, 'r') as f:
+            test_data = json.load(f)
+        cls._example_signal = test_data['results'][0]
+
+    @classmethod
+    def tearDownClass(cls):
+        pass
+
+    def assertSameMessage(self, signal):
+        self.assertEqual(
+            sigmax._build_stuf_message(signal),
+            sigmax._generate_stuf_message(signal).encode('utf-8')
+        )
+
+    def test_identical_to_generated_message(self):
+        self.assertSameMessage(copy.deepcopy(self._example_signal))
+
+    def test_escaping(self):
+        poison = copy.deepcopy(self._example_signal)
+        poison.update({'signal_id': '<poison>tastes nice</poison> & more'})
+        poison['location']['address']['openbare_ruimte'] = '"Dam" & <Rokin>'
+        self.assertSameMessage(poison)
+
+    def test_non_ascii(self):
+        signal = copy.deepcopy(self._example_signal)
+        signal['location']['address']['openbare_ruimte'] = 'Tweede Rozendwarsstraat ë ß €'
+        signal['location']['geometrie']['coordinates'] = [4.8952, 52.3702]
+        self.assertSameMessage(signal)
+
+    def test_timestamp_formats(self):
+        for timestamp in [
+                '2018-06-27T09:13:15Z',
+                '2018-06-27T23:59:59.999999+02:00',
+                '2018-06-27T00:00:00-0130',
+                '2018-06-27 09:13:15',  # not the API format, dateutil is used
+                '27 June 2018 09:13:15']:
+            signal = copy.deepcopy(self._example_signal)
+            signal['created_at'] = timestamp
+            signal['incident_date_start'] = timestamp
+            signal['incident_date_end'] = timestamp
+            self.assertSameMessage(signal)
+
+    def test_invalid_timestamp(self):
+        signal = copy.deepcopy(self._example_signal)
+        signal['created_at'] = '2018-13-45T09:13:15Z'
+        with self.assertRaises(ValueError):
+            sigmax._build_stuf_message(signal)
+
+    def test_format_timestamp(self):
+        self.assertEqual(
+            sigmax._format_timestamp('2018-07-09T22:00:30.123+02:00'),
+            ('20180709', '20180709220030')
+        )
+
+    def test_batch(self):
+        signals = []
+        for i in range(3):
+            signal = copy.deepcopy(self._example_signal)
+            signal['signal_id'] = str(i)
+            signals.append(signal)
+
+        messages = sigmax._build_stuf_messages(signals)
+        self.assertEqual(messages, [sigmax._build_stuf_message(s) for s in signals])
+
+    def test_compile_template(self):
+        chunks, field_names = sigmax._compile_template('<a>{A}</a><b>{B}</b>')
+        self.assertEqual(chunks, [b'<a>', b'</a><b>', b'</b>'])
+        self.assertEqual(field_names, ['A', 'B'])
+
+        chunks, field_names = sigmax._compile_template('{A}')
+        self.assertEqual(chunks, [b'', b''])
+        self.assertEqual(field_names, ['A'])
+
+
 def show_args_kwargs(*args, **kwargs):
     return args, kwargs
 
@@ -171,7 +250,7 @@ class TestSendStufMessage(TestCase):
                 sigmax._send_stuf_message('TEST BERICHT')
 
 
-    @mock.patch('requests.post', side_effect=show_args_kwargs)
+    @mock.patch('requests.Session.post', side_effect=show_args_kwargs)
     def test_send_message(self, request_post_mock):
         # Check that headers are set correctly when sending an STUF message.
         message = 'TEST BERICHT'
@@ -198,9 +277,180 @@ class TestSendStufMessage(TestCase):
                 'text/xml; charset=UTF-8'
             )
             self.assertEquals(
-                bytes(len(message)),
+                str(len(message)),
                 kwargs['headers']['Content-Length']
             )
+            self.assertEquals(
+                kwargs['timeout'],
+                (sigmax.SIGMAX_CONNECT_TIMEOUT, sigmax.SIGMAX_READ_TIMEOUT)
+            )
+
+
+    @mock.patch('requests.Session.close')
+    @mock.patch('requests.Session.post', side_effect=ConnectionError)
+    def test_connection_closed(self, request_post_mock, session_close_mock):
+        env_override = {'SIGMAX_AUTH_TOKEN': 'SLEUTEL', 'SIGMAX_SERVER': 'TESTSERVER'}
+
+        with mock.patch.dict('os.environ', env_override):
+            with self.assertRaises(ConnectionError):
+                sigmax._send_stuf_message('TEST BERICHT')
+        self.assertEquals(session_close_mock.call_count, 1)
+
+        # but not that of a client that is given
+        client = sigmax.SigmaxClient(server='TESTSERVER', auth_token='SLEUTEL')
+        with self.assertRaises(ConnectionError):
+            sigmax._send_stuf_message('TEST BERICHT', client=client)
+        self.assertEquals(session_close_mock.call_count, 1)
+
+
+class TestSigmaxClient(TestCase):
+    def test_configuration_read_once(self):
+        env_override = {'SIGMAX_AUTH_TOKEN': 'SLEUTEL', 'SIGMAX_SERVER': 'TESTSERVER'}
+        with mock.patch.dict('os.environ', env_override):
+            client = sigmax.SigmaxClient()
+
+        with mock.patch.dict('os.environ', {'SIGMAX_AUTH_TOKEN': '', 'SIGMAX_SERVER': ''}):
+            with mock.patch('requests.Session.post', side_effect=show_args_kwargs):
+                args, kwargs = client.send('TEST BERICHT')
 
+        self.assertEquals(kwargs['url'], 'TESTSERVER')
+        self.assertEquals(kwargs['headers']['Authorization'], 'Basic SLEUTEL')
 
+    def test_session_is_reused(self):
+        client = sigmax.SigmaxClient(server='TESTSERVER', auth_token='SLEUTEL')
 
+        with mock.patch.object(client.session, 'post') as post_mock:
+            client.send('EEN')
+            client.send(b'TWEE')
+
+        self.assertEquals(post_mock.call_count, 2)
+        self.assertEquals(post_mock.call_args[1]['data'], b'TWEE')
+
+    def test_pool_size(self):
+        client = sigmax.SigmaxClient(server='TESTSERVER', auth_token='SLEUTEL', pool_size=7)
+        adapter = client.session.get_adapter('https://sigmax.example')
+        self.assertEquals(adapter._pool_maxsize, 7)
+
+    def test_keep_alive(self):
+        client = sigmax.SigmaxClient(server='TESTSERVER', auth_token='SLEUTEL', keep_alive=False)
+        self.assertEquals(client.headers['Connection'], 'close')
+
+    def test_auth_token_not_logged(self):
+        with self.assertLogs('datasets.external.sigmax', level='DEBUG') as logs:
+            sigmax.SigmaxClient(server='TESTSERVER', auth_token='SLEUTEL')
+
+        self.assertFalse(any('SLEUTEL' in line for line in logs.output))
+
+
+class TestSigmaxHandler(TestCase):
+    def test_client_is_shared(self):
+        env_override = {'SIGMAX_AUTH_TOKEN': 'SLEUTEL', 'SIGMAX_SERVER': 'TESTSERVER'}
+        handler = sigmax.SigmaxHandler()
+
+        with mock.patch.dict('os.environ', env_override):
+            self.assertIs(handler.client, handler.client)
+
+    @mock.patch('datasets.external.sigmax._build_stuf_message', return_value=b'<message/>')
+    @mock.patch('datasets.external.sigmax._send_stuf_message')
+    def test_handle(self, patched_send, patched_build):
+        handler = sigmax.SigmaxHandler()
+        handler._client = mock.Mock()
+        signal = {'signal_id': '1'}
+
+        patched_send.return_value.status_code = 200
+        patched_send.return_value.content = _BV03
+        self.assertEqual(handler.handle(signal), (True, 'HTTP 200'))
+
+        patched_send.return_value.status_code = 500
+        patched_send.return_value.content = b''
+        self.assertEqual(handler.handle(signal), (False, 'HTTP 500'))
+
+        patched_send.side_effect = requests.ConnectionError
+        self.assertEqual(
+            handler.handle(signal), (False, 'Sigmax not reachable: ConnectionError'))
+
+    @mock.patch('datasets.external.sigmax._send_stuf_message')
+    def test_invalid_signal(self, patched_send):
+        handler = sigmax.SigmaxHandler()
+        handler._client = mock.Mock()
+
+        result = handler.handle({'signal_id': '1'})
+
+        self.assertEqual(result, (False, "Invalid signal: KeyError: 'location'"))
+        self.assertTrue(result.permanent)
+        self.assertEqual(patched_send.call_count, 0)
+
+
+_BV03 = b"""<?xml version="1.0" encoding="UTF-8"?>
+<soap:Envelope xmlns:soap="http://schemas.xmlsoap.org/soap/envelope/"><soap:Body>
+<StUF:Bv03Bericht xmlns:StUF="http://www.egem.nl/StUF/StUF0301">
+<StUF:stuurgegevens><StUF:berichtcode>Bv03</StUF:berichtcode></StUF:stuurgegevens>
+</StUF:Bv03Bericht></soap:Body></soap:Envelope>"""
+
+_SOAP_FAULT = """<?xml version="1.0" encoding="UTF-8"?>
+<soap:Envelope xmlns:soap="http://schemas.xmlsoap.org/soap/envelope/"><soap:Body>
+<soap:Fault><faultcode>soap:{}</faultcode><faultstring>Er ging iets mis</faultstring>
+</soap:Fault></soap:Body></soap:Envelope>"""
+
+_STUF_FAULT = """<?xml version="1.0" encoding="UTF-8"?>
+<soap:Envelope xmlns:soap="http://schemas.xmlsoap.org/soap/envelope/"><soap:Body>
+<soap:Fault><faultcode>soap:Server</faultcode><faultstring>Fout</faultstring><detail>
+<StUF:{bericht} xmlns:StUF="http://www.egem.nl/StUF/StUF0301">
+<StUF:stuurgegevens><StUF:berichtcode>Fo02</StUF:berichtcode></StUF:stuurgegevens>
+<StUF:body><StUF:code>{code}</StUF:code><StUF:plek>{plek}</StUF:plek>
+<StUF:omschrijving>{omschrijving}</StUF:omschrijving></StUF:body>
+</StUF:{bericht}></detail></soap:Fault></soap:Body></soap:Envelope>"""
+
+
+class TestClassifyResponse(TestCase):
+    def _classify(self, status_code, content):
+        response = mock.Mock(status_code=status_code, content=content)
+        return sigmax._classify_response(response)
+
+    def test_success(self):
+        result = self._classify(200, _BV03)
+        self.assertEqual(result, (True, 'HTTP 200'))
+        self.assertEqual(result.fault_code, '')
+
+    def test_soap_fault(self):
+        result = self._classify(500, _SOAP_FAULT.format('Server').encode('utf-8'))
+        self.assertEqual(result, (False, 'HTTP 500 soap:Server: Er ging iets mis'))
+        self.assertFalse(result.permanent)
+        self.assertEqual(result.fault_code, 'soap:Server')
+
+        result = self._classify(500, _SOAP_FAULT.format('Client').encode('utf-8'))
+        self.assertTrue(result.permanent)
+
+    def test_stuf_fault(self):
+        content = _STUF_FAULT.format(
+            bericht='Fo02Bericht', code='StUF058', plek='client', omschrijving='Zaak bestaat al')
+        result = self._classify(500, content.encode('utf-8'))
+        self.assertEqual(result, (False, 'HTTP 500 StUF058: Zaak bestaat al'))
+        self.assertTrue(result.permanent)
+        self.assertEqual(result.fault_code, 'StUF058')
+
+        # busy, or other problems on the side of Sigmax
+        content = _STUF_FAULT.format(
+            bericht='Fo03Bericht', code='StUF045', plek='server', omschrijving='Bezet')
+        result = self._classify(500, content.encode('utf-8'))
+        self.assertFalse(result.permanent)
+        self.assertEqual(result.fault_code, 'StUF045')
+
+    def test_no_soap_response(self):
+        for status_code, permanent in [(400, True), (422, True), (429, False),
+                                       (500, False), (503, False), (401, False)]:
+            result = self._classify(status_code, b'<html><body>Error</body></html>')
+            self.assertEqual(result, (False, 'HTTP {}'.format(status_code)))
+            self.assertEqual(result.permanent, permanent, status_code)
+
+        self.assertEqual(self._classify(502, b'Bad Gateway'), (False, 'HTTP 502'))
+        self.assertEqual(self._classify(200, b''), (True, 'HTTP 200'))
+
+    def test_no_entities_resolved(self):
+        content = b"""<?xml version="1.0"?>
+<!DOCTYPE foo [<!ENTITY xxe SYSTEM "file:///etc/passwd">]>
+<soap:Envelope xmlns:soap="http://schemas.xmlsoap.org/soap/envelope/"><soap:Body>
+<soap:Fault><faultcode>soap:Client</faultcode><faultstring>&xxe;</faultstring>
+</soap:Fault></soap:Body></soap:Envelope>"""
+        result = self._classify(500, content)
+        self.assertNotIn('root', result.status)
@@ -8,10 +8,13 @@ Version 1:
     - send signal if needed, update status in DB
 - all this is controlled by Jenkins (so this program will be a manage.py command)
 
+Version 2 (optional): with enqueue the signals are only added to an outbox,
+that is processed by any number of export workers (see datasets/outbox.py).
+The signal API can also post signals to the outbox itself (see
+api.views.SignalIngestView).
+
 Possible upgrades:
 - provide a convenient endpoint for the signal API to check which messages were sent
-- allow signal API to post a message to process
-- add a proper task queue (like Celery)
 """
 # Assumptions:
 # 1) Each signal will be sent to 1 API at most (underlies both table design and
@@ -19,33 +22,97 @@ Possible upgrades:
 
 
 import os
+import json
+import time
+import zlib
+import codecs
+import random
+import socket
 import datetime
 import logging
+import threading
+import multiprocessing
+from collections import OrderedDict, defaultdict, deque
+from contextlib import closing
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from queue import Queue, Full
+from urllib.parse import parse_qsl, urlencode, urlparse
 from urllib3.util import Retry
 
 import requests
 from requests.adapters import HTTPAdapter
-import jsonschema
 from django.conf import settings
+from django.db import IntegrityError, connection, connections, transaction
+from django.db.models import Case, Q, Value, When
 from django.utils import timezone
+from django.utils.dateparse import parse_datetime
 
-from datasets.models import MessageLog
-from datasets.internal.get_auth_token import GetAccessToken
-from datasets.external.base import get_handler
+from datasets import metrics
+from datasets.models import MessageLog, SyncState
+from datasets.internal.get_auth_token import AccessTokenManager
+from datasets.external.base import get_handler, call_handler, CircuitOpen, HandlerResult
 
 # -- setup logging --
-LOG_FORMAT = '%(asctime)-15s - %(name)s - %(message)s'
-logging.basicConfig(format=LOG_FORMAT, level=logging.DEBUG)
 logger = logging.getLogger(__name__)
 
 # -- Datapunt internal Signalen in Amsterdam API endpoints --
 #    note: should be set by Ansible or docker-compose.yml
 SIGNALS_API_BASE = os.getenv('SIGNALS_API_BASE', 'https://acc.api.data.amsterdam.nl')
 
+# -- Optional file to keep the access token in between runs --
+SIGNALS_TOKEN_CACHE_FILE = os.getenv('SIGNALS_TOKEN_CACHE_FILE', None)
+
+# -- Number of pages of signals that are fetched while earlier pages are sent --
+SIGNALS_PREFETCH_PAGES = int(os.getenv('SIGNALS_PREFETCH_PAGES', 2))
+
+# -- Pages fetched concurrently during a full crawl (1: follow the next links) --
+SIGNALS_FETCH_CONCURRENCY = int(os.getenv('SIGNALS_FETCH_CONCURRENCY', 1))
+
+# -- Page size requested from the Signals API (default: the API's page size) --
+SIGNALS_PAGE_SIZE = os.getenv('SIGNALS_PAGE_SIZE', None)
+
+# -- Decode pages incrementally from the response, in batches of signals --
+#    (so that large pages do not have to be held in memory completely).
+SIGNALS_STREAM_PAGES = os.getenv('SIGNALS_STREAM_PAGES', '0') == '1'
+SIGNALS_STREAM_BATCH_SIZE = int(os.getenv('SIGNALS_STREAM_BATCH_SIZE', 100))
+SIGNALS_STREAM_CHUNK_SIZE = 64 * 1024
+
+# -- Incremental synchronization: only signals updated since the watermark --
+#    (minus an overlap window, to catch signals updated during the last run)
+#    are requested from the Signals API.
+SYNC_NAME = 'signals-api'
+SIGNALS_WATERMARK_FIELD = 'updated_at'
+SIGNALS_WATERMARK_PARAMETER = os.getenv('SIGNALS_WATERMARK_PARAMETER', 'updated_at__gte')
+SIGNALS_SYNC_OVERLAP = datetime.timedelta(
+    seconds=int(os.getenv('SIGNALS_SYNC_OVERLAP', 600)))
+
+# -- Signals that could not be sent are retried with exponential backoff --
+RETRY_BASE_DELAY = int(os.getenv('RETRY_BASE_DELAY', 60))
+RETRY_MAX_DELAY = int(os.getenv('RETRY_MAX_DELAY', 6 * 3600))
+#    after this many failed attempts the signal is parked (given up on).
+RETRY_MAX_ATTEMPTS = int(os.getenv('RETRY_MAX_ATTEMPTS', 20))
+
+# -- Signals are claimed before they are sent, a claim that was not released --
+#    within the lease (the runner died) is taken over by the next run.
+SIGNALS_CLAIM_LEASE = datetime.timedelta(seconds=int(os.getenv('SIGNALS_CLAIM_LEASE', 900)))
 
-def _get_session_with_retries():
+# -- Outcomes of the signals sent are saved at least every this many seconds --
+#    while a page is being sent (so at most these are lost when a run dies).
+SIGNALS_SAVE_INTERVAL = float(os.getenv('SIGNALS_SAVE_INTERVAL', 1))
+
+# -- Daemon mode: the poll interval is kept between these bounds (seconds) --
+#    and a heartbeat is written at least every DAEMON_HEARTBEAT_INTERVAL.
+DAEMON_MIN_INTERVAL = float(os.getenv('DAEMON_MIN_INTERVAL', 5))
+DAEMON_MAX_INTERVAL = float(os.getenv('DAEMON_MAX_INTERVAL', 300))
+DAEMON_HEARTBEAT_INTERVAL = float(os.getenv('DAEMON_HEARTBEAT_INTERVAL', 60))
+
+
+def _get_session_with_retries(pool_size=None):
     """
     Get a requests Session that will retry 5 times on a number of HTTP 500 statusses.
+
+    Note: pool_size is the number of connections kept per host, set it to the
+    number of threads that share the session.
     """
     session = requests.Session()
 
@@ -55,7 +122,10 @@ def _get_session_with_retries():
         status_forcelist=[500, 502, 503, 504],
         raise_on_status=True
     )
-    adapter = HTTPAdapter(max_retries=retries)
+    if pool_size:
+        adapter = HTTPAdapter(max_retries=retries, pool_connections=pool_size, pool_maxsize=pool_size)
+    else:
+        adapter = HTTPAdapter(max_retries=retries)
     session.mount('https://', adapter)
     session.mount('http://', adapter)
 
@@ -68,6 +138,8 @@ def _validate_signal_api_data(data):
     """
     # Note: currently using placeholder schema (until consumed API definition
     # is settled).
+    import jsonschema  # slow to import and only needed here
+
     jsonschema.validate(data, {
         '$schema': 'http://json-schema.org/schema#',
         'type': 'object'
@@ -75,77 +147,1026 @@ def _validate_signal_api_data(data):
 
 
 # TODO: move to datasets/internal/signal.py
-def _batch_signals(access_token):
+def _get_page(session, url, access_token, params, stream=False):
+    """
+    Request a page of signals, retry once with a new token after a 403.
+    """
+    token_manager = access_token if isinstance(access_token, AccessTokenManager) else None
+
+    for attempt in range(2):
+        headers = token_manager.get_headers() if token_manager else access_token
+        if not headers:
+            raise Exception('No access token available, cannot access data.')
+
+        result = session.get(url, headers=headers, params=params, stream=stream)
+        if result.status_code != 403:
+            return result
+        result.close()
+
+        if token_manager is None or attempt > 0:
+            break
+        logger.info('Access token was refused, requesting a new one.')
+        token_manager.invalidate(headers['Authorization'][len('Bearer '):])
+
+    raise Exception('Wrong or expired access token, cannot access data.')
+
+
+class _PageStream():
+    """
+    Incrementally decode a page of the Signals API from chunks of its body.
+
+    The signals in the results array are decoded one at a time (see
+    signals()), the other top-level fields of the page (_links, count) are
+    kept in fields. Only the part of the body that is not decoded yet is
+    held in memory, the order of the fields does not matter.
+    """
+    _decoder = json.JSONDecoder()
+
+    def __init__(self, chunks):
+        self._chunks = iter(chunks)
+        self._text = codecs.getincrementaldecoder('utf-8')()
+        self._buffer = ''
+        self._position = 0
+        self._exhausted = False
+        self.fields = {}
+
+    def _read(self):
+        """
+        Add the next chunk to the buffer, False when the body is exhausted.
+        """
+        if self._exhausted:
+            return False
+        chunk = next(self._chunks, None)
+        if chunk is None:
+            self._exhausted = True
+            text = self._text.decode(b'', final=True)
+        else:
+            text = self._text.decode(chunk)
+        self._buffer = self._buffer[self._position:] + text
+        self._position = 0
+        return True
+
+    def _peek(self):
+        """
+        Skip whitespace, return the next character (None at the end of the body).
+        """
+        while True:
+            while self._position < len(self._buffer):
+                if self._buffer[self._position] not in ' \t\n\r':
+                    return self._buffer[self._position]
+                self._position += 1
+            if not self._read():
+                return None
+
+    def _expect(self, characters):
+        character = self._peek()
+        if character is None or character not in characters:
+            raise ValueError('Invalid page of signals: expected one of {!r} at {!r}.'.format(
+                characters, self._buffer[self._position:self._position + 20]))
+        self._position += 1
+        return character
+
+    def _value(self):
+        """
+        Decode the next complete JSON value, reading chunks as needed.
+        """
+        first = self._peek()
+        while True:
+            try:
+                value, end = self._decoder.raw_decode(self._buffer, self._position)
+            except json.JSONDecodeError:
+                if not self._read():
+                    raise
+                continue
+            # a number (or literal) at the end of the buffer may be incomplete
+            if first not in '{["' and end == len(self._buffer) and self._read():
+                continue
+            self._position = end
+            return value
+
+    def signals(self):
+        """
+        Generate the signals in the results array, fill in the other fields.
+        """
+        self._expect('{')
+        if self._peek() == '}':
+            return
+        while True:
+            key = self._value()
+            if not isinstance(key, str):
+                raise ValueError('Invalid page of signals: key {!r}.'.format(key))
+            self._expect(':')
+            if key == 'results':
+                self._expect('[')
+                if self._peek() == ']':
+                    self._position += 1
+                else:
+                    while True:
+                        yield self._value()
+                        if self._expect(',]') == ']':
+                            break
+            else:
+                self.fields[key] = self._value()
+            if self._expect(',}') == '}':
+                return
+
+
+def _stream_batches(result, batch_size):
+    """
+    Generate batches of signals while decoding the response, then its fields.
+    """
+    page = _PageStream(result.iter_content(chunk_size=SIGNALS_STREAM_CHUNK_SIZE))
+    with closing(result):
+        batch = []
+        for signal in page.signals():
+            batch.append(signal)
+            if len(batch) >= batch_size:
+                metrics.SIGNALS_FETCHED.inc(len(batch))
+                yield batch
+                batch = []
+        if batch:
+            metrics.SIGNALS_FETCHED.inc(len(batch))
+            yield batch
+    return page.fields
+
+
+def _fetch_pages(session, access_token, next_page, params):
+    """
+    Follow the next links from next_page on, generate the pages of signals.
+    """
+    while True:
+        if SIGNALS_STREAM_PAGES:
+            with metrics.PAGE_FETCH_SECONDS.time():
+                result = _get_page(session, next_page, access_token, params, stream=True)
+            params = None  # the next page links include the query parameters
+
+            api_data = yield from _stream_batches(result, SIGNALS_STREAM_BATCH_SIZE)
+            next_page = api_data['_links']['next']['href']
+        else:
+            with metrics.PAGE_FETCH_SECONDS.time():
+                result = _get_page(session, next_page, access_token, params)
+                api_data = result.json()
+            params = None  # the next page links include the query parameters
+
+            metrics.SIGNALS_FETCHED.inc(len(api_data['results']))
+            # _validate_signal_api_data(api_data)
+            next_page = api_data['_links']['next']['href']
+            yield api_data['results']
+        if next_page is None:
+            return
+
+
+def _fetch_page(session, url, access_token, params=None):
+    with metrics.PAGE_FETCH_SECONDS.time():
+        return _get_page(session, url, access_token, params).json()
+
+
+def _page_url(url, number):
+    """
+    Link to page number, given the link to another page.
+    """
+    parts = urlparse(url)
+    query = [(key, value) for key, value in parse_qsl(parts.query, keep_blank_values=True)
+             if key != 'page']
+    query.append(('page', number))
+    return parts._replace(query=urlencode(query)).geturl()
+
+
+def _fetch_pages_in_parallel(session, access_token, first_page, params, concurrency):
+    """
+    Generate the pages of signals in order, fetching up to concurrency pages at a time.
+
+    The page links are worked out from the count and page size of the first
+    page. Pages are fetched with a bounded window (at most concurrency pages
+    are fetched or waiting) and yielded in page order. When a page shows that
+    the pages shifted since the first one (signals were added or removed, the
+    count or size of the page is off) the crawl is not trusted any more: the
+    link of that page is returned, to continue by following the next links
+    (like a sequential crawl). Otherwise the next link of the last page is
+    returned (None, unless pages were added at the end).
+    """
+    api_data = _fetch_page(session, first_page, access_token, params)
+    metrics.SIGNALS_FETCHED.inc(len(api_data['results']))
+    yield api_data['results']
+
+    next_page = api_data['_links']['next']['href']
+    count, page_size = api_data.get('count'), len(api_data['results'])
+    if next_page is None or not count or not page_size or \
+            'page' not in dict(parse_qsl(urlparse(next_page).query)):
+        return next_page  # not page number pagination, follow the next links
+
+    n_pages = -(-count // page_size)
+    urls = iter([(number, _page_url(next_page, number)) for number in range(2, n_pages + 1)])
+    pending = deque()
+
+    with ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix='signals-fetch') as pool:
+        def submit():
+            for number, url in urls:
+                pending.append((number, url, pool.submit(_fetch_page, session, url, access_token)))
+                return
+
+        try:
+            for _ in range(concurrency):
+                submit()
+            while pending:
+                number, url, future = pending.popleft()
+                api_data = future.result()
+                submit()
+
+                expected = page_size if number < n_pages else count - (n_pages - 1) * page_size
+                if api_data.get('count') != count or len(api_data['results']) != expected:
+                    logger.warning(
+                        'Pages of signals shifted during the crawl (count %s -> %s), '
+                        'following the next links from page %d.',
+                        count, api_data.get('count'), number)
+                    metrics.PAGE_DRIFT.inc()
+                    return url
+
+                metrics.SIGNALS_FETCHED.inc(len(api_data['results']))
+                yield api_data['results']
+            return api_data['_links']['next']['href']
+        finally:
+            for _, _, future in pending:
+                future.cancel()
+
+
+def _batch_signals(access_token, since=None, concurrency=1, session=None):
     """
     Access the Signalen in Amsterdam API, retrieve signals.
+
+    Note: access_token is either the authorization headers or an
+    AccessTokenManager (which refreshes the token when it expires). If since
+    is provided only signals updated since then are requested. With
+    SIGNALS_STREAM_PAGES the pages are decoded while they are received and
+    yielded in batches of SIGNALS_STREAM_BATCH_SIZE signals. With a
+    concurrency above 1 pages are fetched in parallel (and not streamed).
+    A session (see _get_session_with_retries) is used when given, otherwise
+    one is set up for this crawl.
     """
     next_page = SIGNALS_API_BASE + '/signals/auth/signal/'
+    params = {}
+    if since:
+        params[SIGNALS_WATERMARK_PARAMETER] = since.isoformat()
+    if SIGNALS_PAGE_SIZE:
+        params['page_size'] = SIGNALS_PAGE_SIZE
+    params = params or None
 
     if not access_token:
         raise Exception('No access token available, cannot access data.')
-    with _get_session_with_retries() as session:
+    own_session = session is None
+    if own_session:
+        session = _get_session_with_retries(pool_size=concurrency)
+    try:
+        if concurrency > 1:
+            next_page = yield from _fetch_pages_in_parallel(
+                session, access_token, next_page, params, concurrency)
+            params = None
+        if next_page is not None:
+            yield from _fetch_pages(session, access_token, next_page, params)
+    finally:
+        if own_session:
+            session.close()
+
+
+_END_OF_PAGES = object()
+
+
+def _prefetch_pages(pages, max_pages_ahead):
+    """
+    Iterate over pages of signals while the next pages are fetched in the background.
+
+    A fetcher thread consumes the pages iterable and hands the pages over using
+    a bounded queue, so that at most max_pages_ahead pages are waiting for the
+    dispatcher (the fetcher blocks until there is room). When fetching fails
+    the pages fetched up to that point are yielded first, then the exception
+    is re-raised. When the dispatcher stops early (or raises) the fetcher is
+    stopped and joined, no threads are left behind.
+    """
+    if max_pages_ahead < 1:
+        yield from pages
+        return
+
+    queue = Queue(maxsize=max_pages_ahead)
+    stop = threading.Event()
+
+    def put(item):
+        while not stop.is_set():
+            try:
+                queue.put(item, timeout=0.1)
+            except Full:
+                continue
+            return True
+        return False
+
+    def fetch():
+        try:
+            for page in pages:
+                if not put((page, None)):
+                    break
+            else:
+                put((_END_OF_PAGES, None))
+        except Exception as e:
+            put((_END_OF_PAGES, e))
+        finally:
+            if hasattr(pages, 'close'):
+                pages.close()
+
+    fetcher = threading.Thread(target=fetch, name='signals-prefetch', daemon=True)
+    fetcher.start()
+    try:
         while True:
-            result = session.get(
-                next_page,
-                headers=access_token
-            )
-            if result.status_code == 403:
-                raise Exception('Wrong or expired access token, cannot access data.')
-
-            api_data = result.json()
-            # _validate_signal_api_data(api_data)
-            next_page = api_data['_links']['next']['href']
-            yield api_data['results']
-            if next_page == None:
-                raise StopIteration
+            page, error = queue.get()
+            if page is _END_OF_PAGES:
+                if error is not None:
+                    raise error
+                return
+            yield page
+    finally:
+        stop.set()
+        fetcher.join()
+
+
+# Fields of a MessageLog entry that change when a signal is handled.
+_OUTCOME_FIELDS = [
+    'is_sent', 'status', 't_sent', 'handler_name',
+    'attempts', 'last_error', 'next_attempt_at', 'is_parked', 'fault_code',
+    'state', 'claimed_by', 'lease_expires_at',
+]
+
+
+def _next_attempt_at(attempts, now):
+    """
+    Schedule the next attempt after a number of failed attempts.
+
+    The delay doubles with every attempt (up to RETRY_MAX_DELAY), half of it
+    is random so that signals that failed together are not retried together.
+    """
+    delay = min(RETRY_BASE_DELAY * 2 ** (attempts - 1), RETRY_MAX_DELAY)
+    return now + datetime.timedelta(seconds=delay / 2 + random.uniform(0, delay / 2))
+
+
+def _send(handler, signal):
+    """
+    Send a signal, return a tuple of (result, error), result is a HandlerResult.
+
+    Error is the name of the exception the handler raised, or the status if
+    the handler reported a failure. Returns None when the signal was not sent
+    because the circuit breaker of the handler is open.
+    """
+    try:
+        result = call_handler(handler, signal)
+    except CircuitOpen:
+        return None
+    except Exception as e:
+        logger.exception(
+            'Handler %s failed for signal %s.', handler.name, signal['signal_id'],
+            extra={'signal_id': signal['signal_id'], 'handler': handler.name})
+        return HandlerResult(False, str(e)[:255]), e.__class__.__name__
+
+    return result, '' if result.success else result.status
+
+
+def _bulk_update_entries(entries, fields, batch_size=500, **filters):
+    """
+    Update fields on several existing MessageLog entries using few queries.
+
+    Only rows that also match the filters are updated, returns the number of
+    rows that were updated.
+
+    Note: QuerySet.bulk_update only exists from Django 2.2 onwards, this builds
+    the same CASE WHEN update statements, batch_size entries per statement
+    (fewer if the database limits the number of query parameters).
+    """
+    if not entries:
+        return 0
+
+    max_query_params = connection.features.max_query_params
+    if max_query_params:
+        # each entry takes two parameters per field and one in the IN clause
+        batch_size = min(batch_size, max_query_params // (2 * len(fields) + 1))
+
+    n_updated = 0
+    for start in range(0, len(entries), batch_size):
+        batch = entries[start:start + batch_size]
+        updates = {}
+        for field_name in fields:
+            field = MessageLog._meta.get_field(field_name)
+            whens = [
+                When(signal_id=entry.signal_id,
+                     then=Value(getattr(entry, field_name), output_field=field))
+                for entry in batch
+            ]
+            updates[field_name] = Case(*whens, output_field=field)
+
+        n_updated += MessageLog.objects.filter(
+            signal_id__in=[entry.signal_id for entry in batch], **filters
+        ).update(**updates)
+    return n_updated
+
+
+def _worker_id():
+    """
+    Identify this runner in claims (host name and process id).
+    """
+    return '{}:{}'.format(socket.gethostname(), os.getpid())[:255]
+
+
+def _claimable(now):
+    """
+    Entries that may be claimed: not done, due, and not claimed (or the lease expired).
+    """
+    due = Q(next_attempt_at__isnull=True) | Q(next_attempt_at__lte=now)
+    return Q(is_sent=False, is_parked=False) & (
+        Q(state__in=[MessageLog.PENDING, MessageLog.FAILED]) & due |
+        Q(state=MessageLog.CLAIMED, lease_expires_at__lte=now)
+    )
+
+
+def _insert_entries(new_entries):
+    """
+    Insert new MessageLog entries, return those that another runner inserted first.
+    """
+    try:
+        with transaction.atomic():
+            MessageLog.objects.bulk_create(new_entries)
+        return []
+    except IntegrityError:
+        pass
+
+    taken = []
+    for entry in new_entries:
+        try:
+            with transaction.atomic():
+                entry.save(force_insert=True)
+        except IntegrityError:
+            taken.append(entry)
+    return taken
+
+
+def _claim_entries(new_entries, signal_ids, worker_id, now):
+    """
+    Claim MessageLog entries for sending, return the entries that were claimed.
+
+    New entries are inserted claimed, the unique signal_id makes sure only one
+    runner inserts (and so claims) an entry. The existing entries (signal_ids,
+    and new entries that another runner inserted first) are claimed using a
+    single conditional UPDATE, only the claimable ones (see _claimable) are
+    updated, so concurrent runners never claim the same entry. The claimed
+    entries are read back afterwards.
+    """
+    lease_expires_at = now + SIGNALS_CLAIM_LEASE
+    for entry in new_entries:
+        entry.state = MessageLog.CLAIMED
+        entry.claimed_by = worker_id
+        entry.lease_expires_at = lease_expires_at
+
+    claimed = []
+    if new_entries:
+        taken = _insert_entries(new_entries)
+        taken_ids = set(entry.signal_id for entry in taken)
+        claimed = [entry for entry in new_entries if entry.signal_id not in taken_ids]
+        signal_ids = list(signal_ids) + list(taken_ids)
+
+    if signal_ids:
+        n_claimed = MessageLog.objects.filter(
+            _claimable(now), signal_id__in=signal_ids
+        ).update(state=MessageLog.CLAIMED, claimed_by=worker_id, lease_expires_at=lease_expires_at)
+        if n_claimed:
+            claimed.extend(MessageLog.objects.filter(
+                signal_id__in=signal_ids,
+                state=MessageLog.CLAIMED,
+                claimed_by=worker_id,
+                lease_expires_at=lease_expires_at,
+            ))
+    return claimed
+
+
+def _renew_claims(worker_id):
+    """
+    Extend the lease on the MessageLog entries this runner claimed.
+
+    Sending a page can take longer than the lease (a low rate limit, a large
+    page), its entries stay claimed until their outcomes are saved.
+    """
+    return MessageLog.objects.filter(
+        state=MessageLog.CLAIMED, claimed_by=worker_id
+    ).update(lease_expires_at=timezone.now() + SIGNALS_CLAIM_LEASE)
+
+
+def _release(entry, state):
+    entry.state = state
+    entry.claimed_by = ''
+    entry.lease_expires_at = None
+
+
+def _save_entries(entries, worker_id):
+    """
+    Write the outcomes of claimed MessageLog entries and release the claims.
+
+    Entries that were taken over by another runner in the meantime (the lease
+    expired) are left alone.
+    """
+    if not entries:
+        return
+
+    with transaction.atomic():
+        n_saved = _bulk_update_entries(
+            entries, _OUTCOME_FIELDS, state=MessageLog.CLAIMED, claimed_by=worker_id)
+    if n_saved < len(entries):
+        logger.warning(
+            'Lost the claim on %d signals, their outcome was not saved.', len(entries) - n_saved)
+
+
+def _dispatch(jobs):
+    """
+    Send signals to their handlers, yield (entry, handler, result) tuples.
+
+    Jobs are (entry, signal, handler) tuples, results are the return values
+    of _send. Signals for handlers that allow concurrent calls are sent from a
+    thread pool (one per handler, bounded by handler.max_concurrency) and their
+    results are yielded as they complete, the others are sent one at a time in
+    the meantime. Should sending raise anyway (handler exceptions are part of
+    the result), no new calls are started, the results of the calls that were
+    already in flight are yielded and the exception is re-raised.
+
+    Note: only the handlers run in the worker threads, all database access
+    stays on the calling thread.
+    """
+    jobs_per_handler = OrderedDict()
+    for job in jobs:
+        jobs_per_handler.setdefault(job[2].name, []).append(job)
+
+    sequential = []
+    futures = {}
+    executors = []
+    try:
+        for handler_jobs in jobs_per_handler.values():
+            handler = handler_jobs[0][2]
+            if handler.max_concurrency > 1 and len(handler_jobs) > 1:
+                executor = ThreadPoolExecutor(
+                    max_workers=min(handler.max_concurrency, len(handler_jobs)))
+                executors.append(executor)
+                for job in handler_jobs:
+                    futures[executor.submit(_send, handler, job[1])] = job
+            else:
+                sequential.extend(handler_jobs)
+
+        error = None
+        for entry, signal, handler in sequential:
+            try:
+                result = _send(handler, signal)
+            except Exception as e:
+                error = e
+                break
+            yield entry, handler, result
+
+        if error is not None:
+            for future in futures:
+                future.cancel()
+
+        for future in as_completed(futures):
+            entry, signal, handler = futures[future]
+            if future.cancelled():
+                continue
+            if future.exception() is not None:
+                if error is None:
+                    error = future.exception()
+                    for pending in futures:
+                        pending.cancel()
+                continue
+            yield entry, handler, future.result()
+
+        if error is not None:
+            raise error
+    finally:
+        for future in futures:
+            future.cancel()
+        for executor in executors:
+            executor.shutdown(wait=True)
 
 
 def _call_external_apis(signals):
     """
     Call external APIs for each of the signals.
 
-    Note signals are expected as dictionaries, not objects.
+    Note signals are expected as dictionaries, not objects. The local database
+    is queried once for the whole page, the signals that need sending are
+    claimed (see _claim_entries) and the outcomes are written as they come in,
+    at least every SIGNALS_SAVE_INTERVAL seconds and when the page is done
+    (the claims are renewed while sending takes long). Signals that
+    could not be sent are scheduled for a later attempt, they are skipped
+    until then, unless the failure was permanent or the signal failed
+    RETRY_MAX_ATTEMPTS times: those are parked (not sent again, so that they
+    no longer hold back the watermark). Returns the set of signal ids that were not
+    sent (failed, not due yet, not attempted or claimed by another runner),
+    parked signals excluded.
     """
-    for signal in signals:
-        # Check local database to see whether this signal was alreay sent to
-        # the relevant external API (if so skip, else update local database).
-        try:
-            entry = MessageLog.objects.get(signal_id=signal['signal_id'])
-        except MessageLog.DoesNotExist:
-            logger.debug('Creating entry for {}.'.format(signal['signal_id']))
-            entry = MessageLog(
-                signal_id=signal['signal_id'],
-                t_entered=timezone.now()
-            )
-            entry.save()
+    signal_ids = [str(signal['signal_id']) for signal in signals]
+    failed = set()
+    if not signal_ids:
+        return failed
+
+    # Check local database to see which of these signals were already sent to
+    # the relevant external API (those are skipped, the others are claimed).
+    entries = MessageLog.objects.in_bulk(signal_ids, field_name='signal_id')
+    now = timezone.now()
+    worker_id = _worker_id()
+
+    new_entries = []
+    candidates = OrderedDict()  # signal_id -> signal, for the signals to claim
+    counts = defaultdict(int)  # (metric, handler name) -> number of signals
+    routing_time = 0
+    for signal_id, signal in zip(signal_ids, signals):
+        if signal_id in candidates:
+            continue  # signal occurs more than once in this page
+
+        entry = entries.get(signal_id)
+        if entry is None:
+            logger.debug('Creating entry for %s.', signal_id)
+            new_entries.append(MessageLog(signal_id=signal_id, t_entered=timezone.now()))
         else:
-            logger.debug('Retrieved entry for {}.'.format(signal['signal_id']))
-            if entry.is_sent:
+            logger.debug('Retrieved entry for %s.', signal_id)
+            if entry.is_sent or entry.is_parked:
+                counts[metrics.SIGNALS_SKIPPED, entry.handler_name] += 1
+                continue
+            if entry.next_attempt_at is not None and entry.next_attempt_at > now:
+                failed.add(signal_id)  # not due yet
+                continue
+        candidates[signal_id] = signal
+
+    claimed = []
+    jobs = []
+    handled = set()
+    unsaved = []  # entries handled since the outcomes were last saved
+    try:
+        if candidates:
+            existing_ids = [signal_id for signal_id in candidates if signal_id in entries]
+            claimed = _claim_entries(new_entries, existing_ids, worker_id, now)
+
+        claimed_entries = {entry.signal_id: entry for entry in claimed}
+        for signal_id, signal in candidates.items():
+            entry = claimed_entries.get(signal_id)
+            if entry is None:
+                failed.add(signal_id)  # claimed by another runner
+                continue
+
+            started = time.perf_counter()
+            handler = get_handler(signal)
+            routing_time += time.perf_counter() - started
+            jobs.append((entry, signal, handler))
+
+        # Send the signals to the correct APIs, saving the outcomes so far
+        # and renewing the claims well before they expire.
+        renew_every = SIGNALS_CLAIM_LEASE.total_seconds() / 3
+        renew_at = time.monotonic() + renew_every
+        save_at = time.monotonic() + SIGNALS_SAVE_INTERVAL
+        for entry, handler, sent in _dispatch(jobs):
+            if unsaved and time.monotonic() >= save_at:
+                _save_entries(unsaved, worker_id)
+                unsaved = []
+                save_at = time.monotonic() + SIGNALS_SAVE_INTERVAL
+            if time.monotonic() >= renew_at:
+                _renew_claims(worker_id)
+                renew_at = time.monotonic() + renew_every
+            handled.add(entry.signal_id)
+            unsaved.append(entry)
+            if sent is None:
+                failed.add(entry.signal_id)  # circuit breaker open, not sent
+                counts[metrics.SIGNALS_FAILED, handler.name] += 1
+                _release(entry, MessageLog.FAILED if entry.attempts else MessageLog.PENDING)
                 continue
 
-        # Send the signal to the correct API.
-        handler = get_handler(signal)
-        success, status = handler.handle(signal)
+            # Keep the status, it is saved to our local database below.
+            result, error = sent
+            entry.is_sent = result.success
+            entry.status = result.status[:255]
+            entry.t_sent = timezone.now()
+            entry.handler_name = handler.name
+            entry.attempts += 1
+            entry.last_error = error[:255]
+            entry.fault_code = result.fault_code[:255]
+            if result.success:
+                entry.next_attempt_at = None
+                _release(entry, MessageLog.SENT)
+                counts[metrics.SIGNALS_SENT, handler.name] += 1
+            elif result.permanent or entry.attempts >= RETRY_MAX_ATTEMPTS:
+                if not result.permanent:
+                    logger.warning(
+                        'Giving up on signal %s after %d attempts: %s',
+                        entry.signal_id, entry.attempts, entry.status,
+                        extra={'signal_id': entry.signal_id, 'handler': handler.name,
+                               'attempts': entry.attempts})
+                entry.is_parked = True
+                entry.next_attempt_at = None
+                _release(entry, MessageLog.PARKED)
+                counts[metrics.SIGNALS_PARKED, handler.name] += 1
+            else:
+                entry.next_attempt_at = _next_attempt_at(entry.attempts, entry.t_sent)
+                _release(entry, MessageLog.FAILED)
+                failed.add(entry.signal_id)
+                counts[metrics.SIGNALS_FAILED, handler.name] += 1
+    finally:
+        # Claims on signals that were not sent (sending raised) are released.
+        for entry in claimed:
+            if entry.signal_id not in handled:
+                _release(entry, MessageLog.FAILED if entry.attempts else MessageLog.PENDING)
+                unsaved.append(entry)
+        _save_entries(unsaved, worker_id)
 
-        # Save the status to our local database.
-        entry.is_sent = success
-        entry.status = status
-        entry.t_sent = timezone.now()
-        entry.handler_name = handler.name
+        # Metrics are updated once per page, keeping the per signal cost low.
+        metrics.ROUTING_SECONDS.observe(routing_time)
+        for (metric, handler_name), count in counts.items():
+            metric.labels(handler_name).inc(count)
 
-        entry.save()
+    return failed
 
 
-def handle_signals():
+def _get_watermark(signal):
     """
-    Entry point (called via manage.py), retrieve and handle signals.
+    Get the timestamp that the synchronization watermark is based on.
+    """
+    value = signal.get(SIGNALS_WATERMARK_FIELD)
+    return parse_datetime(value) if value else None
+
+
+def _next_watermark(signals, failed, max_seen, min_failed):
+    """
+    Update the highest timestamp seen and lowest timestamp of a failed signal.
+    """
+    for signal in signals:
+        timestamp = _get_watermark(signal)
+        if timestamp is None:
+            continue
+        if max_seen is None or timestamp > max_seen:
+            max_seen = timestamp
+        if str(signal['signal_id']) in failed:
+            if min_failed is None or timestamp < min_failed:
+                min_failed = timestamp
+    return max_seen, min_failed
+
+
+def parse_shard(value):
+    """
+    Parse a shard given as "i/n" (the i-th of n shards, counting from 1).
+
+    Returns a tuple of (index, count), the index counts from 0.
     """
+    try:
+        number, count = (int(part) for part in value.split('/'))
+    except ValueError:
+        raise ValueError('Shard should be given as i/n, not {!r}.'.format(value))
+    if count < 1 or not 1 <= number <= count:
+        raise ValueError('Shard {!r} does not exist (i should be from 1 to n).'.format(value))
+    return number - 1, count
+
+
+def _in_shard(signal, shard):
+    """
+    Check whether a signal belongs to a shard, based on a stable hash of its id.
+    """
+    if shard is None:
+        return True
+    index, count = shard
+    return zlib.crc32(str(signal['signal_id']).encode('utf-8')) % count == index
+
+
+def _sync_name(shard):
+    """
+    Name of the synchronization state, each shard keeps its own watermark.
+    """
+    if shard is None:
+        return SYNC_NAME
+    return '{}:{}/{}'.format(SYNC_NAME, shard[0] + 1, shard[1])
+
+
+def _get_token_manager():
     # FIXME: for now only acceptance is supported (and hardcoded below)
     acceptance = True
     email = os.getenv('SIGNALS_USER', 'signals.admin@amsterdam.nl')
     password = os.getenv('SIGNALS_PASSWORD', 'insecure')
 
-    access_token = GetAccessToken().getAccessToken(email, password, acceptance)
-    for signals in _batch_signals(access_token):
-        logger.debug(signals)
-        _call_external_apis(signals)
+    return AccessTokenManager(email, password, acceptance, cache_file=SIGNALS_TOKEN_CACHE_FILE)
+
+
+def _count_new(signals, watermark):
+    """
+    Count the signals that were updated after the watermark.
+    """
+    if watermark is None:
+        return len(signals)
+    n_new = 0
+    for signal in signals:
+        timestamp = _get_watermark(signal)
+        if timestamp is None or timestamp > watermark:
+            n_new += 1
+    return n_new
+
+
+def handle_signals(full=False, enqueue=False, fetch_concurrency=None, shard=None,
+                   should_stop=None, token_manager=None, session=None):
+    """
+    Entry point (called via manage.py), retrieve and handle signals.
+
+    Only the signals that were updated since the last successful run are
+    requested, unless full is set (a complete crawl, to reconcile). The
+    watermark is only moved after a complete crawl, and never past a signal
+    that could not be sent, so that it is retried in the next run. With
+    enqueue the signals are added to the outbox instead of being sent. A full
+    crawl fetches fetch_concurrency (default SIGNALS_FETCH_CONCURRENCY) pages
+    at a time. With a shard (see parse_shard) only the signals in that shard
+    are handled (so only their MessageLog entries are read and written), the
+    shard keeps its own watermark. Returns a summary: the number of signals
+    handled, updated since the last run (new) and not sent (failed), and the
+    new watermark.
+
+    Note: should_stop is called after each page, when it returns True the
+    crawl stops there (the watermark is not moved, the crawl was not
+    complete). A token_manager and session can be passed in to reuse them
+    between runs.
+    """
+    from datasets.outbox import enqueue_signals  # outbox imports this module
+
+    started = time.monotonic()
+    state, _ = SyncState.objects.get_or_create(name=_sync_name(shard))
+    since = None
+    if not full and state.watermark is not None:
+        since = state.watermark - SIGNALS_SYNC_OVERLAP
+    logger.debug('Requesting signals updated since: %s', since)
+
+    max_seen, min_failed = None, None
+    n_signals, n_new, n_failed = 0, 0, 0
+    complete = True
+    if token_manager is None:
+        token_manager = _get_token_manager()
+    if not token_manager.get_headers():  # log in before crawling
+        raise Exception('No access token available, cannot access data.')
+
+    concurrency = 1
+    if full:
+        concurrency = fetch_concurrency or SIGNALS_FETCH_CONCURRENCY
+    pages = _prefetch_pages(
+        _batch_signals(token_manager, since=since, concurrency=concurrency, session=session),
+        SIGNALS_PREFETCH_PAGES)
+    with closing(pages):  # stops the fetcher when sending fails
+        for signals in pages:
+            if shard is not None:
+                signals = [signal for signal in signals if _in_shard(signal, shard)]
+            logger.debug('Handling %d signals.', len(signals))
+            if enqueue:
+                enqueue_signals(signals)
+                failed = set()  # queued signals stay in the outbox until sent or parked
+            else:
+                failed = _call_external_apis(signals)
+            max_seen, min_failed = _next_watermark(signals, failed, max_seen, min_failed)
+            n_signals += len(signals)
+            n_new += _count_new(signals, state.watermark)
+            n_failed += len(failed)
+            if should_stop is not None and should_stop():
+                logger.info('Stopping after %d signals, the crawl is not complete.', n_signals)
+                complete = False
+                break
+
+    # Only the watermark (moved forward) and t_updated are written, the
+    # heartbeat of the daemon and the watermark of a concurrent run that got
+    # further are left as they are.
+    watermark = min_failed if min_failed is not None else max_seen
+    sync_state = SyncState.objects.filter(pk=state.pk)
+    moved = complete and watermark is not None and sync_state.filter(
+        Q(watermark=None) | Q(watermark__lt=watermark)).update(
+            watermark=watermark, t_updated=timezone.now())
+    if not moved:
+        sync_state.update(t_updated=timezone.now())
+    state.refresh_from_db(fields=['watermark', 't_updated'])
+
+    summary = {
+        'signals': n_signals, 'new': n_new, 'failed': n_failed, 'watermark': state.watermark}
+    seconds = time.monotonic() - started
+    logger.info(
+        'Handled %d signals (%d new, %d failed) in %.1f seconds.',
+        n_signals, n_new, n_failed, seconds,
+        extra=dict(summary, sync=state.name, seconds=seconds, complete=complete))
+    return summary
+
+
+def _next_interval(interval, n_new, min_interval, max_interval):
+    """
+    Poll again soon while new signals keep arriving, back off (doubling) when idle.
+    """
+    if n_new:
+        return min_interval
+    return min(max(interval, min_interval) * 2, max_interval)
+
+
+def _heartbeat(shard):
+    """
+    Record that the daemon (for a shard) is alive.
+    """
+    name = _sync_name(shard)
+    if not SyncState.objects.filter(name=name).update(heartbeat_at=timezone.now()):
+        SyncState.objects.create(name=name, heartbeat_at=timezone.now())
+
+
+def _clear_heartbeat(shard):
+    """
+    Record that the daemon (for a shard) was stopped on purpose.
+    """
+    SyncState.objects.filter(name=_sync_name(shard)).update(heartbeat_at=None)
+
+
+def run_daemon(should_stop, enqueue=False, shard=None,
+               min_interval=DAEMON_MIN_INTERVAL, max_interval=DAEMON_MAX_INTERVAL,
+               heartbeat_interval=DAEMON_HEARTBEAT_INTERVAL, wait=time.sleep):
+    """
+    Handle signals until should_stop() is true, polling at an adaptive interval.
+
+    The access token, the HTTP session for the Signals API (and the database
+    connection and the clients of the handlers) are kept between runs. Runs
+    are incremental, after a failed run the daemon backs off and the
+    database connection is set up again. should_stop is also checked after
+    each page and while waiting, the page in flight is finished (and its
+    outcomes saved) before the daemon stops. A heartbeat is written to the
+    SyncState of the shard at least every heartbeat_interval seconds, it is
+    cleared when the daemon stops. Returns the number of runs.
+    """
+    token_manager = _get_token_manager()
+    last_beat = [None]
+
+    def beat():
+        now = time.monotonic()
+        if last_beat[0] is None or now - last_beat[0] >= heartbeat_interval:
+            _heartbeat(shard)
+            last_beat[0] = now
+
+    def stop_after_page():
+        beat()
+        return should_stop()
+
+    n_runs = 0
+    interval = min_interval
+    with _get_session_with_retries(pool_size=SIGNALS_FETCH_CONCURRENCY) as session:
+        while not should_stop():
+            beat()
+            try:
+                summary = handle_signals(
+                    enqueue=enqueue, shard=shard, should_stop=stop_after_page,
+                    token_manager=token_manager, session=session)
+            except Exception:
+                logger.exception('Handling signals failed, retrying later.')
+                connections.close_all()  # reconnect in the next run
+                summary = {'new': 0}
+            n_runs += 1
+
+            interval = _next_interval(interval, summary['new'], min_interval, max_interval)
+            logger.debug(
+                '%d new signals, polling again in %.0f seconds.', summary['new'], interval)
+            deadline = time.monotonic() + interval
+            while not should_stop():
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                wait(min(remaining, heartbeat_interval, 1.0))
+                beat()
+
+    _clear_heartbeat(shard)
+    logger.info('Daemon stopped after %d runs.', n_runs)
+    return n_runs
+
+
+def _handle_shard(shard, options):
+    """
+    Run handle_signals for one shard in a worker process, return (summary, error).
+    """
+    started = time.monotonic()
+    try:
+        summary = handle_signals(shard=shard, **options)
+        error = None
+    except Exception as e:
+        logger.exception('Shard %d/%d failed.', shard[0] + 1, shard[1])
+        summary = {}
+        error = '{}: {}'.format(e.__class__.__name__, e)
+    finally:
+        connections.close_all()
+        for handler in logging.getLogger().handlers:
+            handler.flush()  # the pool stops this process without exiting it
+    summary['seconds'] = time.monotonic() - started
+    return summary, error
+
+
+def handle_signals_in_shards(n_shards, **options):
+    """
+    Run handle_signals for each of n shards in its own (forked) process.
+
+    Returns a list with a (summary, error) tuple per shard, error is None or a
+    description of the exception the shard stopped with.
+
+    Note: database connections are closed before forking, the worker
+    processes open their own.
+    """
+    connections.close_all()
+    context = multiprocessing.get_context('fork')
+    with context.Pool(n_shards) as pool:
+        results = [
+            pool.apply_async(_handle_shard, ((index, n_shards), options))
+            for index in range(n_shards)
+        ]
+        return [result.get() for result in results]
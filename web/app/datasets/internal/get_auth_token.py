@@ -1,10 +1,24 @@
 # utf-8
 import requests
 import os
+import json
+import time
+import base64
 import random
 import string
+import logging
+import tempfile
+import threading
 from urllib.parse import urlparse, parse_qsl
 
+from datasets import metrics
+
+logger = logging.getLogger(__name__)
+
+# Lifetime assumed for tokens that do not state when they expire (seconds).
+DEFAULT_TOKEN_LIFETIME = 3600
+
+
 class GetAccessToken():
     """
         Get an header authentication item for access token
@@ -17,8 +31,12 @@ class GetAccessToken():
             accessToken = getToken.getAccessToken()
             requests.get(url, headers= accessToken)
     """
-    def getAccessToken(self, email, password, acceptance):
+    def getToken(self, email, password, acceptance):
+        """
+        Log in, return a tuple of the access token and its lifetime in seconds.
 
+        Note: (None, None) is returned if logging in failed.
+        """
         def randomword(length):
             letters = string.ascii_lowercase
             return ''.join(random.choice(letters) for i in range(length))
@@ -26,7 +44,9 @@ class GetAccessToken():
         state = randomword(10)
         scopes = ['SIG/ALL']
         acc_prefix = 'acc.' if acceptance else ''
-        authzUrl = f'https://{acc_prefix}api.data.amsterdam.nl/oauth2/authorize'
+        # SIGNALS_AUTHORIZE_URL points to another OAuth server (e.g. for load tests)
+        authzUrl = os.getenv('SIGNALS_AUTHORIZE_URL') or \
+            f'https://{acc_prefix}api.data.amsterdam.nl/oauth2/authorize'
         params = {
             'idp_id' : 'datapunt',
             'response_type' : 'token',
@@ -40,7 +60,7 @@ class GetAccessToken():
         if response.status_code == 303:
             location = response.headers["Location"]
         else:
-            return {}
+            return None, None
 
         data = {
             'type':'employee_plus',
@@ -52,17 +72,173 @@ class GetAccessToken():
         if response.status_code == 303:
             location = response.headers["Location"]
         else:
-            return {}
+            return None, None
 
         response = requests.get(location, allow_redirects=False)
         if response.status_code == 303:
             returnedUrl = response.headers["Location"]
         else:
-            return {}
+            return None, None
 
         # Get grantToken from parameter aselect_credentials in session URL
         parsed = urlparse(returnedUrl)
         fragment = parse_qsl(parsed.fragment)
         access_token = fragment[0][1]
-        os.environ["ACCESS_TOKEN"] = access_token
+
+        try:
+            expires_in = int(dict(fragment)['expires_in'])
+        except KeyError:
+            expires_in = _get_jwt_lifetime(access_token)
+        except ValueError:
+            logger.warning('Invalid expires_in %r in the login response.',
+                           dict(fragment)['expires_in'])
+            expires_in = _get_jwt_lifetime(access_token)
+        return access_token, expires_in
+
+    def getAccessToken(self, email, password, acceptance):
+        access_token, _ = self.getToken(email, password, acceptance)
+        if not access_token:
+            return {}
         return {"Authorization": 'Bearer ' + access_token}
+
+
+def _get_jwt_lifetime(access_token):
+    """
+    Get the remaining lifetime (in seconds) from the exp claim of a JWT.
+
+    Note: the token is not verified, this is only used to schedule a refresh.
+    None is returned if there is no exp claim, or if it has passed already
+    (e.g. because the clocks differ).
+    """
+    try:
+        payload = access_token.split('.')[1]
+        payload += '=' * (-len(payload) % 4)
+        claims = json.loads(base64.urlsafe_b64decode(payload).decode('utf-8'))
+        lifetime = int(claims['exp'] - time.time())
+    except (IndexError, KeyError, TypeError, ValueError):
+        return None
+    return lifetime if lifetime > 0 else None
+
+
+class AccessTokenManager():
+    """
+    Keep an access token for the internal API's, only log in when needed.
+
+    The token and its expiry are kept in memory and, if a cache file is given,
+    on disk so that later runs can reuse them. A new token is requested when
+    the current one expires within refresh_margin seconds (or within half its
+    lifetime, for tokens that live shorter than twice the margin), or after it
+    was invalidated (e.g. because the API answered 403).
+
+    Usage:
+        token_manager = AccessTokenManager(email, password, acceptance)
+        requests.get(url, headers=token_manager.get_headers())
+    """
+    def __init__(self, email, password, acceptance, cache_file=None, refresh_margin=300):
+        self.email = email
+        self.password = password
+        self.acceptance = acceptance
+        self.cache_file = cache_file
+        self.refresh_margin = refresh_margin
+
+        self._access_token = None
+        self._expires_at = None
+        self._lifetime = None
+        self._lock = threading.Lock()
+
+        self._load()
+
+    def _cache_key(self):
+        return '{}:{}'.format(self.email, 'acc' if self.acceptance else 'prod')
+
+    def _load(self):
+        if not self.cache_file or not os.path.exists(self.cache_file):
+            return
+        try:
+            with open(self.cache_file, 'r') as f:
+                cached = json.load(f)
+        except (OSError, ValueError):
+            logger.warning('Cannot read access token cache %s.', self.cache_file)
+            return
+
+        if cached.get('key') == self._cache_key():
+            self._access_token = cached.get('access_token')
+            self._expires_at = cached.get('expires_at')
+            self._lifetime = cached.get('lifetime')
+
+    def _store(self):
+        if not self.cache_file:
+            return
+        cached = {
+            'key': self._cache_key(),
+            'access_token': self._access_token,
+            'expires_at': self._expires_at,
+            'lifetime': self._lifetime,
+        }
+        # Written to a temporary file that replaces the cache file, so that
+        # runs side by side never read a partly written cache.
+        directory = os.path.dirname(os.path.abspath(self.cache_file))
+        try:
+            fd, path = tempfile.mkstemp(dir=directory, prefix='.token-')  # mode 0o600
+            try:
+                with os.fdopen(fd, 'w') as f:
+                    json.dump(cached, f)
+                os.replace(path, self.cache_file)
+            except BaseException:
+                os.unlink(path)
+                raise
+        except OSError:
+            logger.warning('Cannot write access token cache %s.', self.cache_file)
+
+    def _is_fresh(self):
+        if self._access_token is None or self._expires_at is None:
+            return False
+        margin = self.refresh_margin
+        if self._lifetime:
+            margin = min(margin, self._lifetime / 2)
+        return self._expires_at - margin > time.time()
+
+    def refresh(self):
+        """
+        Log in again, return whether that was successful.
+        """
+        logger.debug('Requesting a new access token.')
+        with metrics.TOKEN_FETCH_SECONDS.time():
+            access_token, expires_in = GetAccessToken().getToken(
+                self.email, self.password, self.acceptance)
+        if not access_token:
+            self._access_token, self._expires_at, self._lifetime = None, None, None
+            return False
+
+        if expires_in is None or expires_in <= 0:
+            expires_in = DEFAULT_TOKEN_LIFETIME
+        self._access_token = access_token
+        self._expires_at = time.time() + expires_in
+        self._lifetime = expires_in
+        self._store()
+        return True
+
+    def invalidate(self, access_token=None):
+        """
+        Drop the current access token (next call to get_headers logs in again).
+
+        Note: with the access_token that was refused, it is only dropped if it
+        is still the current one, so that a token another thread got in the
+        meantime is kept.
+        """
+        with self._lock:
+            if access_token is not None and access_token != self._access_token:
+                return
+            self._access_token, self._expires_at, self._lifetime = None, None, None
+            self._store()
+
+    def get_headers(self):
+        """
+        Get the authorization headers, an empty dict if logging in failed.
+        """
+        with self._lock:
+            if not self._is_fresh():
+                self.refresh()
+            if not self._access_token:
+                return {}
+            return {'Authorization': 'Bearer ' + self._access_token}
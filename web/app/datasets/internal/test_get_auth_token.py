@@ -0,0 +1,195 @@
+import os
+import json
+import time
+import base64
+import tempfile
+from unittest import mock
+from unittest.mock import patch
+
+from django.test import TestCase
+
+from datasets.internal import get_auth_token
+from datasets.internal.get_auth_token import AccessTokenManager, GetAccessToken
+
+
+def _redirect(location):
+    response = mock.MagicMock()
+    response.status_code = 303
+    response.headers = {'Location': location}
+    return response
+
+
+def _jwt(claims):
+    payload = base64.urlsafe_b64encode(json.dumps(claims).encode('utf-8'))
+    return 'header.{}.signature'.format(payload.decode('ascii').rstrip('='))
+
+
+class TestGetAccessToken(TestCase):
+    @patch('requests.post')
+    @patch('requests.get')
+    def test_token_and_lifetime(self, patched_get, patched_post):
+        patched_get.side_effect = [
+            _redirect('https://login'),
+            _redirect('https://data.amsterdam.nl/#access_token=TOKEN&expires_in=1800&state=x'),
+        ]
+        patched_post.return_value = _redirect('https://callback')
+
+        self.assertEqual(GetAccessToken().getToken('email', 'password', True), ('TOKEN', 1800))
+
+    @patch('requests.post')
+    @patch('requests.get')
+    def test_invalid_lifetime(self, patched_get, patched_post):
+        patched_get.side_effect = [
+            _redirect('https://login'),
+            _redirect('https://data.amsterdam.nl/#access_token=TOKEN&expires_in=soon&state=x'),
+        ]
+        patched_post.return_value = _redirect('https://callback')
+
+        self.assertEqual(GetAccessToken().getToken('email', 'password', True), ('TOKEN', None))
+
+    @patch('requests.get')
+    def test_login_fails(self, patched_get):
+        patched_get.return_value = mock.MagicMock(status_code=500)
+
+        self.assertEqual(GetAccessToken().getToken('email', 'password', True), (None, None))
+        self.assertEqual(GetAccessToken().getAccessToken('email', 'password', True), {})
+
+    @patch('requests.post')
+    @patch('requests.get')
+    def test_does_not_touch_environment(self, patched_get, patched_post):
+        patched_get.side_effect = [
+            _redirect('https://login'),
+            _redirect('https://data.amsterdam.nl/#access_token=TOKEN'),
+        ]
+        patched_post.return_value = _redirect('https://callback')
+
+        with patch.dict('os.environ', {}, clear=True):
+            headers = GetAccessToken().getAccessToken('email', 'password', True)
+            self.assertNotIn('ACCESS_TOKEN', os.environ)
+        self.assertEqual(headers, {'Authorization': 'Bearer TOKEN'})
+
+    def test_jwt_lifetime(self):
+        token = _jwt({'exp': time.time() + 600})
+        self.assertAlmostEqual(get_auth_token._get_jwt_lifetime(token), 600, delta=2)
+        self.assertIsNone(get_auth_token._get_jwt_lifetime('not a jwt'))
+        self.assertIsNone(get_auth_token._get_jwt_lifetime(_jwt({'exp': time.time() - 600})))
+
+
+class TestAccessTokenManager(TestCase):
+    @patch.object(GetAccessToken, 'getToken', return_value=('TOKEN', 3600))
+    def test_token_is_reused(self, patched_get_token):
+        token_manager = AccessTokenManager('email', 'password', True)
+
+        self.assertEqual(token_manager.get_headers(), {'Authorization': 'Bearer TOKEN'})
+        self.assertEqual(token_manager.get_headers(), {'Authorization': 'Bearer TOKEN'})
+        self.assertEqual(patched_get_token.call_count, 1)
+
+    @patch.object(GetAccessToken, 'getToken', return_value=('TOKEN', 600))
+    def test_refresh_before_expiry(self, patched_get_token):
+        token_manager = AccessTokenManager('email', 'password', True, refresh_margin=120)
+
+        token_manager.get_headers()
+        with patch('time.time', return_value=time.time() + 470):
+            token_manager.get_headers()
+        self.assertEqual(patched_get_token.call_count, 1)
+        with patch('time.time', return_value=time.time() + 490):
+            token_manager.get_headers()
+        self.assertEqual(patched_get_token.call_count, 2)
+
+    @patch.object(GetAccessToken, 'getToken', return_value=('TOKEN', 60))
+    def test_short_lifetime(self, patched_get_token):
+        # the margin is shortened to half the lifetime, so the token is reused
+        token_manager = AccessTokenManager('email', 'password', True, refresh_margin=300)
+
+        token_manager.get_headers()
+        token_manager.get_headers()
+        self.assertEqual(patched_get_token.call_count, 1)
+        with patch('time.time', return_value=time.time() + 31):
+            token_manager.get_headers()
+        self.assertEqual(patched_get_token.call_count, 2)
+
+    @patch.object(GetAccessToken, 'getToken', return_value=('TOKEN', None))
+    def test_default_lifetime(self, patched_get_token):
+        token_manager = AccessTokenManager('email', 'password', True)
+
+        token_manager.get_headers()
+        self.assertAlmostEqual(
+            token_manager._expires_at,
+            time.time() + get_auth_token.DEFAULT_TOKEN_LIFETIME,
+            delta=2
+        )
+        token_manager.get_headers()
+        self.assertEqual(patched_get_token.call_count, 1)
+
+    @patch.object(GetAccessToken, 'getToken', return_value=('TOKEN', 0))
+    def test_no_lifetime(self, patched_get_token):
+        token_manager = AccessTokenManager('email', 'password', True)
+
+        token_manager.get_headers()
+        token_manager.get_headers()
+        self.assertEqual(patched_get_token.call_count, 1)
+
+    @patch.object(GetAccessToken, 'getToken', return_value=('TOKEN', 3600))
+    def test_invalidate(self, patched_get_token):
+        token_manager = AccessTokenManager('email', 'password', True)
+
+        token_manager.get_headers()
+        token_manager.invalidate()
+        token_manager.get_headers()
+        self.assertEqual(patched_get_token.call_count, 2)
+
+    @patch.object(GetAccessToken, 'getToken', side_effect=[('OLD', 3600), ('NEW', 3600)])
+    def test_invalidate_refused_token(self, patched_get_token):
+        token_manager = AccessTokenManager('email', 'password', True)
+        token_manager.get_headers()
+        token_manager.invalidate('OLD')
+        self.assertEqual(token_manager.get_headers(), {'Authorization': 'Bearer NEW'})
+
+        # another thread was refused with the old token, the new one is kept
+        token_manager.invalidate('OLD')
+        self.assertEqual(token_manager.get_headers(), {'Authorization': 'Bearer NEW'})
+        self.assertEqual(patched_get_token.call_count, 2)
+
+    @patch.object(GetAccessToken, 'getToken', return_value=(None, None))
+    def test_login_fails(self, patched_get_token):
+        token_manager = AccessTokenManager('email', 'password', True)
+        self.assertEqual(token_manager.get_headers(), {})
+
+    @patch.object(GetAccessToken, 'getToken', return_value=('TOKEN', 3600))
+    def test_cache_file(self, patched_get_token):
+        with tempfile.TemporaryDirectory() as directory:
+            cache_file = os.path.join(directory, 'token.json')
+
+            AccessTokenManager('email', 'password', True, cache_file=cache_file).get_headers()
+            self.assertEqual(os.stat(cache_file).st_mode & 0o777, 0o600)
+
+            # a later run reuses the token
+            token_manager = AccessTokenManager('email', 'password', True, cache_file=cache_file)
+            self.assertEqual(token_manager.get_headers(), {'Authorization': 'Bearer TOKEN'})
+            self.assertEqual(patched_get_token.call_count, 1)
+
+            # but not for another account
+            token_manager = AccessTokenManager('other', 'password', True, cache_file=cache_file)
+            token_manager.get_headers()
+            self.assertEqual(patched_get_token.call_count, 2)
+
+    @patch.object(GetAccessToken, 'getToken', return_value=('TOKEN', 3600))
+    def test_cache_file_replaced(self, patched_get_token):
+        with tempfile.TemporaryDirectory() as directory:
+            cache_file = os.path.join(directory, 'token.json')
+            with open(cache_file, 'w') as f:
+                f.write('{"key": "old"}')
+
+            with patch('json.dump', side_effect=OSError('Disk full')):
+                AccessTokenManager('email', 'password', True, cache_file=cache_file).get_headers()
+
+            # the old cache is left as it was, without temporary files
+            self.assertEqual(os.listdir(directory), ['token.json'])
+            with open(cache_file) as f:
+                self.assertEqual(f.read(), '{"key": "old"}')
+
+            AccessTokenManager('email', 'password', True, cache_file=cache_file).get_headers()
+            self.assertEqual(os.listdir(directory), ['token.json'])
+            self.assertEqual(os.stat(cache_file).st_mode & 0o777, 0o600)
+            with open(cache_file) as f:
+                self.assertEqual(json.load(f)['access_token'], 'TOKEN')
@@ -0,0 +1,344 @@
+"""
+Load test the export pipeline against local stand-ins for the external services.
+
+Three HTTP servers are started on localhost:
+- an OAuth server that does the redirects GetAccessToken goes through,
+- a Signals API that serves any number of synthetic signals (based on the
+  auth_signal.json fixture) in pages of a configurable size,
+- a Sigmax SOAP endpoint with configurable latency and error rate.
+
+A complete handle_signals run is done against these (with a Sigmax handler
+for every signal) and reported on: throughput, latency of sending a signal
+and memory use. The signals are stored in the configured database with ids
+starting with "loadtest-", these are removed again unless asked otherwise.
+"""
+import os
+import json
+import time
+import calendar
+import random
+import logging
+import resource
+import threading
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+from urllib.parse import parse_qsl, urlencode, urlparse
+
+from django.conf import settings
+
+from datasets import handle_signals as pipeline
+from datasets.external import base
+from datasets.external.sigmax import SigmaxClient, SigmaxHandler
+from datasets.models import MessageLog, SyncState
+
+logger = logging.getLogger(__name__)
+
+SIGNAL_ID_PREFIX = 'loadtest-'
+SYNC_NAME = 'load-test'
+ACCESS_TOKEN = 'loadtest-access-token'
+
+_SIGMAX_OK = (
+    b'<?xml version="1.0" encoding="UTF-8"?>'
+    b'<soap:Envelope xmlns:soap="http://schemas.xmlsoap.org/soap/envelope/"><soap:Body>'
+    b'<StUF:Bv03Bericht xmlns:StUF="http://www.egem.nl/StUF/StUF0301"><StUF:stuurgegevens>'
+    b'<StUF:berichtcode>Bv03</StUF:berichtcode></StUF:stuurgegevens></StUF:Bv03Bericht>'
+    b'</soap:Body></soap:Envelope>'
+)
+_SIGMAX_FAULT = (
+    b'<?xml version="1.0" encoding="UTF-8"?>'
+    b'<soap:Envelope xmlns:soap="http://schemas.xmlsoap.org/soap/envelope/"><soap:Body>'
+    b'<soap:Fault><faultcode>soap:Server</faultcode>'
+    b'<faultstring>Load test error</faultstring></soap:Fault>'
+    b'</soap:Body></soap:Envelope>'
+)
+
+
+class _ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class _StandInHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'  # keep connections open, like the real services
+    # Send each response in one go, small separate writes of headers and body
+    # would add delayed ACK waits (tens of milliseconds) to every request.
+    wbufsize = 64 * 1024
+    disable_nagle_algorithm = True
+
+    def log_message(self, format, *args):
+        pass  # one line per request would drown the report
+
+    def _respond(self, status, body=b'', content_type='text/plain', headers=None):
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _read_body(self):
+        return self.rfile.read(int(self.headers.get('Content-Length', 0)))
+
+
+class OAuthStandIn(_StandInHandler):
+    """
+    The authorize, log in and callback redirects that GetAccessToken expects.
+    """
+    def do_GET(self):
+        url = urlparse(self.path)
+        query = dict(parse_qsl(url.query))
+        if url.path == '/oauth2/authorize':
+            location = '/login?' + urlencode({
+                'redirect_uri': query.get('redirect_uri', ''), 'state': query.get('state', '')})
+            self._respond(303, headers={'Location': self.server.url + location})
+        elif url.path == '/callback':
+            fragment = urlencode([
+                ('access_token', ACCESS_TOKEN),
+                ('token_type', 'bearer'),
+                ('expires_in', '36000'),
+                ('state', query.get('state', '')),
+            ])
+            self._respond(303, headers={'Location': query['redirect_uri'] + '#' + fragment})
+        else:
+            self._respond(404)
+
+    def do_POST(self):
+        url = urlparse(self.path)
+        self._read_body()
+        if url.path == '/login':
+            self._respond(303, headers={'Location': self.server.url + '/callback?' + url.query})
+        else:
+            self._respond(404)
+
+
+class SignalsAPIStandIn(_StandInHandler):
+    """
+    Paginated /signals/auth/signal/ with synthetic signals, generated per page.
+    """
+    def do_GET(self):
+        url = urlparse(self.path)
+        if url.path != '/signals/auth/signal/':
+            return self._respond(404)
+        if self.headers.get('Authorization') != 'Bearer ' + ACCESS_TOKEN:
+            return self._respond(403)
+
+        query = dict(parse_qsl(url.query))
+        page = int(query.get('page', 1))
+        page_size = int(query.get('page_size', self.server.page_size))
+        start = (page - 1) * page_size
+        end = min(start + page_size, self.server.n_signals)
+
+        next_page = None
+        if end < self.server.n_signals:
+            next_page = '{}{}?{}'.format(self.server.url, url.path, urlencode(
+                {'page': page + 1, 'page_size': page_size}))
+
+        body = json.dumps({
+            '_links': {
+                'self': {'href': self.server.url + self.path},
+                'next': {'href': next_page},
+                'previous': {'href': None},
+            },
+            'count': self.server.n_signals,
+            'results': [self.server.make_signal(i) for i in range(start, end)],
+        }).encode('utf-8')
+        self.server.pages_served += 1
+        self._respond(200, body, content_type='application/json')
+
+
+class SigmaxStandIn(_StandInHandler):
+    """
+    SOAP endpoint that answers after some latency, failing at the error rate.
+    """
+    def do_POST(self):
+        self._read_body()
+        server = self.server
+        delay = server.latency
+        if server.latency_jitter:
+            delay += random.expovariate(1 / server.latency_jitter)
+        time.sleep(delay)
+
+        with server.lock:
+            server.requests_received += 1
+        if random.random() < server.error_rate:
+            self._respond(500, _SIGMAX_FAULT, content_type='text/xml; charset=UTF-8')
+        else:
+            self._respond(200, _SIGMAX_OK, content_type='text/xml; charset=UTF-8')
+
+
+@contextmanager
+def _serve(handler_class, **attributes):
+    """
+    Run a stand-in server on a free localhost port while in the with block.
+    """
+    server = _ThreadingHTTPServer(('127.0.0.1', 0), handler_class)
+    server.url = 'http://127.0.0.1:{}'.format(server.server_port)
+    server.lock = threading.Lock()
+    for name, value in attributes.items():
+        setattr(server, name, value)
+
+    thread = threading.Thread(
+        target=server.serve_forever, kwargs={'poll_interval': 0.05}, name='stand-in', daemon=True)
+    thread.start()
+    try:
+        yield server
+    finally:
+        server.shutdown()
+        server.server_close()
+        thread.join()
+
+
+@contextmanager
+def _override(obj, **attributes):
+    """
+    Set attributes (module globals) while in the with block.
+    """
+    originals = {name: getattr(obj, name) for name in attributes}
+    for name, value in attributes.items():
+        setattr(obj, name, value)
+    try:
+        yield
+    finally:
+        for name, value in originals.items():
+            setattr(obj, name, value)
+
+
+@contextmanager
+def _environment(**variables):
+    originals = {name: os.environ.get(name) for name in variables}
+    os.environ.update(variables)
+    try:
+        yield
+    finally:
+        for name, value in originals.items():
+            if value is None:
+                del os.environ[name]
+            else:
+                os.environ[name] = value
+
+
+def _signal_factory():
+    """
+    Get a function that makes the i-th synthetic signal.
+
+    Only top-level fields differ between signals, nested parts are shared so
+    that pages of signals are cheap to generate.
+    """
+    fixture_file = os.path.join(
+        settings.FIXTURES_DIR, 'datasets', 'internal', 'auth_signal.json')
+    with open(fixture_file, 'r') as f:
+        template = json.load(f)['results'][0]
+    start = calendar.timegm((2018, 6, 1, 0, 0, 0))
+
+    def make_signal(i):
+        timestamp = time.strftime('%Y-%m-%dT%H:%M:%S+00:00', time.gmtime(start + i))
+        signal = dict(template)
+        signal['id'] = i
+        signal['signal_id'] = '{}{:09d}'.format(SIGNAL_ID_PREFIX, i)
+        signal['text'] = 'Load test signal {}'.format(i)
+        signal['created_at'] = timestamp
+        signal['updated_at'] = timestamp
+        return signal
+
+    return make_signal
+
+
+def _percentile(sorted_values, fraction):
+    if not sorted_values:
+        return None
+    index = min(int(fraction * len(sorted_values)), len(sorted_values) - 1)
+    return sorted_values[index]
+
+
+def _peak_rss_mb():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024  # kB on Linux
+
+
+def _cleanup():
+    MessageLog.objects.filter(signal_id__startswith=SIGNAL_ID_PREFIX).delete()
+    SyncState.objects.filter(name=SYNC_NAME).delete()
+
+
+def run_load_test(n_signals, page_size=100, latency=0.05, latency_jitter=0.0,
+                  error_rate=0.0, concurrency=None, rate_limit=None, keep=False):
+    """
+    Run handle_signals against the stand-ins, return a report (dictionary).
+
+    Latencies are in seconds. Concurrency and rate_limit default to the
+    settings of the Sigmax handler, a rate_limit of 0 turns rate limiting off.
+    """
+    latencies = []
+
+    class LoadTestSigmaxHandler(SigmaxHandler):
+        max_concurrency = concurrency or SigmaxHandler.max_concurrency
+
+        def __init__(self):
+            super().__init__()
+            self._client = SigmaxClient(pool_size=self.max_concurrency)
+
+        def can_handle(self, signal):
+            return True
+
+        def handle(self, signal):
+            started = time.perf_counter()
+            try:
+                return super().handle(signal)
+            finally:
+                latencies.append(time.perf_counter() - started)
+
+    if rate_limit is not None:
+        LoadTestSigmaxHandler.rate_limit = rate_limit or None
+        LoadTestSigmaxHandler.rate_burst = rate_limit or None
+
+    registered = [type(handler) for handler in base._HANDLERS.values()]
+    _cleanup()
+    rss_before = _peak_rss_mb()
+
+    with _serve(OAuthStandIn) as oauth, \
+            _serve(SignalsAPIStandIn, n_signals=n_signals, page_size=page_size,
+                   make_signal=_signal_factory(), pages_served=0) as signals_api, \
+            _serve(SigmaxStandIn, latency=latency, latency_jitter=latency_jitter,
+                   error_rate=error_rate, requests_received=0) as sigmax, \
+            _environment(SIGNALS_AUTHORIZE_URL=oauth.url + '/oauth2/authorize',
+                         SIGMAX_SERVER=sigmax.url + '/', SIGMAX_AUTH_TOKEN='loadtest'), \
+            _override(pipeline, SIGNALS_API_BASE=signals_api.url, SYNC_NAME=SYNC_NAME,
+                      SIGNALS_TOKEN_CACHE_FILE=None):
+        base.reset_handlers()
+        base.register_handler(LoadTestSigmaxHandler)
+        try:
+            started = time.perf_counter()
+            pipeline.handle_signals(full=True)
+            elapsed = time.perf_counter() - started
+        finally:
+            base.reset_handlers()
+            for handler in registered:
+                base.register_handler(handler)
+
+        entries = MessageLog.objects.filter(signal_id__startswith=SIGNAL_ID_PREFIX)
+        n_sent = entries.filter(is_sent=True).count()
+        n_logged = entries.count()
+        pages_served = signals_api.pages_served
+        sigmax_requests = sigmax.requests_received
+
+    if not keep:
+        _cleanup()
+
+    latencies.sort()
+    return {
+        'signals': n_signals,
+        'pages': pages_served,
+        'sent': n_sent,
+        'failed': n_logged - n_sent,
+        'not_attempted': n_signals - len(latencies),
+        'sigmax_requests': sigmax_requests,
+        'seconds': elapsed,
+        'signals_per_second': n_signals / elapsed if elapsed else None,
+        'sent_per_second': n_sent / elapsed if elapsed else None,
+        'latency_p50': _percentile(latencies, 0.5),
+        'latency_p95': _percentile(latencies, 0.95),
+        'latency_p99': _percentile(latencies, 0.99),
+        'latency_max': latencies[-1] if latencies else None,
+        'peak_rss_mb': _peak_rss_mb(),
+        'peak_rss_growth_mb': _peak_rss_mb() - rss_before,
+    }
@@ -0,0 +1,48 @@
+"""
+Send signals from the outbox to the external APIs, run as many as needed.
+"""
+import signal
+
+from django.core.management.base import BaseCommand
+
+from datasets.outbox import run_worker
+
+
+class Command(BaseCommand):
+    help = 'Send signals queued in the outbox to external APIs.'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--batch-size', type=int, default=100,
+            help='Number of signals claimed at a time.'
+        )
+        parser.add_argument(
+            '--idle-sleep', type=float, default=5.0,
+            help='Seconds to wait before checking an empty outbox again.'
+        )
+        parser.add_argument(
+            '--once', action='store_true',
+            help='Stop when no signal in the outbox is due.'
+        )
+
+    def handle(self, *args, **options):
+        stopping = []
+
+        def stop(signum, frame):
+            stopping.append(signum)  # finish the current batch, then stop
+
+        previous = {
+            signum: signal.signal(signum, stop) for signum in (signal.SIGTERM, signal.SIGINT)
+        }
+        try:
+            n_processed = run_worker(
+                batch_size=options['batch_size'],
+                idle_sleep=options['idle_sleep'],
+                once=options['once'],
+                should_stop=lambda: bool(stopping)
+            )
+        finally:
+            for signum, handler in previous.items():
+                signal.signal(signum, handler)
+
+        self.stdout.write('Processed {} signals.'.format(n_processed))
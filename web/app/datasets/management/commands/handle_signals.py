@@ -5,14 +5,120 @@
 Download datasets from objectstore, save them in local directory.
 """
 import os
+import signal
 
 from django.core.management.base import BaseCommand, CommandError
 
-from datasets.handle_signals import handle_signals
+from datasets.handle_signals import (
+    handle_signals, handle_signals_in_shards, parse_shard, run_daemon
+)
 
 
 class Command(BaseCommand):
     help = 'Retrieve signals from signal API and send messages if needed.'
 
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--full',
+            action='store_true',
+            help='Crawl all signals instead of only those updated since the last run.'
+        )
+        parser.add_argument(
+            '--enqueue',
+            action='store_true',
+            help='Add the signals to the outbox for the export workers instead of sending them.'
+        )
+        parser.add_argument(
+            '--fetch-concurrency',
+            type=int,
+            default=None,
+            help='Pages fetched at a time during a full crawl (default SIGNALS_FETCH_CONCURRENCY).'
+        )
+        parser.add_argument(
+            '--shard',
+            default=None,
+            help='Only handle the signals in shard i of n (given as i/n, i from 1 to n).'
+        )
+        parser.add_argument(
+            '--shards',
+            type=int,
+            default=None,
+            help='With --local: number of shards, each handled by a worker process.'
+        )
+        parser.add_argument(
+            '--local',
+            action='store_true',
+            help='Fork a worker process per shard (see --shards) and wait for all of them.'
+        )
+        parser.add_argument(
+            '--daemon',
+            action='store_true',
+            help='Keep running, poll for updated signals until stopped (SIGTERM or SIGINT).'
+        )
+
     def handle(self, *args, **options):
-        handle_signals()
+        if options['fetch_concurrency'] is not None and not options['full']:
+            raise CommandError('--fetch-concurrency only applies to a full crawl, add --full.')
+
+        kwargs = {
+            'full': options['full'],
+            'enqueue': options['enqueue'],
+            'fetch_concurrency': options['fetch_concurrency'],
+        }
+        if options['local'] or options['shards'] is not None:
+            if not options['local'] or not options['shards'] or options['shard']:
+                raise CommandError('Use --shards n together with --local (and without --shard).')
+            self._handle_locally(options['shards'], kwargs)
+            return
+
+        shard = None
+        if options['shard']:
+            try:
+                shard = parse_shard(options['shard'])
+            except ValueError as e:
+                raise CommandError(str(e))
+
+        if options['daemon']:
+            if options['full']:
+                raise CommandError('A daemon only does incremental runs, drop --full.')
+            self._run_daemon(shard, options['enqueue'])
+            return
+        handle_signals(shard=shard, **kwargs)
+
+    def _run_daemon(self, shard, enqueue):
+        stopping = []
+
+        def stop(signum, frame):
+            stopping.append(signum)  # finish the page in flight, then stop
+
+        previous = {
+            signum: signal.signal(signum, stop) for signum in (signal.SIGTERM, signal.SIGINT)
+        }
+        try:
+            n_runs = run_daemon(lambda: bool(stopping), enqueue=enqueue, shard=shard)
+        finally:
+            for signum, handler in previous.items():
+                signal.signal(signum, handler)
+
+        self.stdout.write('Stopped after {} runs.'.format(n_runs))
+
+    def _handle_locally(self, n_shards, kwargs):
+        results = handle_signals_in_shards(n_shards, **kwargs)
+
+        n_errors = 0
+        for number, (summary, error) in enumerate(results, 1):
+            if error:
+                n_errors += 1
+                self.stdout.write('Shard {}/{}: failed after {:.1f} s: {}'.format(
+                    number, n_shards, summary['seconds'], error))
+            else:
+                self.stdout.write('Shard {}/{}: {} signals, {} not sent, {:.1f} s'.format(
+                    number, n_shards, summary['signals'], summary['failed'], summary['seconds']))
+
+        done = [summary for summary, error in results if not error]
+        self.stdout.write('Total: {} signals, {} not sent, {} of {} shards completed'.format(
+            sum(summary['signals'] for summary in done),
+            sum(summary['failed'] for summary in done),
+            len(done), n_shards))
+        if n_errors:
+            raise CommandError('{} of {} shards failed.'.format(n_errors, n_shards))
@@ -0,0 +1,77 @@
+"""
+Run handle_signals against local stand-ins for OAuth, the Signals API and Sigmax.
+"""
+import logging
+
+from django.core.management.base import BaseCommand
+
+from datasets.loadtest import run_load_test
+
+
+def _format_ms(seconds):
+    return '-' if seconds is None else '{:.1f} ms'.format(seconds * 1000)
+
+
+class Command(BaseCommand):
+    help = 'Load test sending signals, using local stand-ins for the external services.'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--signals', type=int, default=10000,
+            help='Number of synthetic signals served by the Signals API stand-in.'
+        )
+        parser.add_argument(
+            '--page-size', type=int, default=100,
+            help='Number of signals per page.'
+        )
+        parser.add_argument(
+            '--sigmax-latency', type=float, default=50,
+            help='Time Sigmax takes to answer, in milliseconds.'
+        )
+        parser.add_argument(
+            '--sigmax-jitter', type=float, default=0,
+            help='Mean of an exponentially distributed extra delay, in milliseconds.'
+        )
+        parser.add_argument(
+            '--error-rate', type=float, default=0.0,
+            help='Fraction of the messages Sigmax answers with an error.'
+        )
+        parser.add_argument(
+            '--concurrency', type=int, default=None,
+            help='Messages in flight to Sigmax (default SIGMAX_MAX_CONCURRENCY).'
+        )
+        parser.add_argument(
+            '--rate-limit', type=float, default=None,
+            help='Messages per second to Sigmax (default SIGMAX_RATE_LIMIT, 0 for no limit).'
+        )
+        parser.add_argument(
+            '--keep', action='store_true',
+            help='Keep the load test signals in the message log.'
+        )
+
+    def handle(self, *args, **options):
+        if options['verbosity'] < 2:
+            logging.getLogger('datasets').setLevel(logging.WARNING)
+
+        report = run_load_test(
+            n_signals=options['signals'],
+            page_size=options['page_size'],
+            latency=options['sigmax_latency'] / 1000,
+            latency_jitter=options['sigmax_jitter'] / 1000,
+            error_rate=options['error_rate'],
+            concurrency=options['concurrency'],
+            rate_limit=options['rate_limit'],
+            keep=options['keep'],
+        )
+
+        self.stdout.write('Signals:            {signals} in {pages} pages'.format(**report))
+        self.stdout.write('Sent / failed:      {sent} / {failed} ({not_attempted} not attempted)'.format(
+            **report))
+        self.stdout.write('Duration:           {:.1f} s'.format(report['seconds']))
+        self.stdout.write('Throughput:         {:.1f} signals/s, {:.1f} sent/s'.format(
+            report['signals_per_second'] or 0, report['sent_per_second'] or 0))
+        self.stdout.write('Sending latency:    p50 {}, p95 {}, p99 {}, max {}'.format(
+            _format_ms(report['latency_p50']), _format_ms(report['latency_p95']),
+            _format_ms(report['latency_p99']), _format_ms(report['latency_max'])))
+        self.stdout.write('Peak memory (RSS):  {:.0f} MB (+{:.0f} MB during the run)'.format(
+            report['peak_rss_mb'], report['peak_rss_growth_mb']))
@@ -0,0 +1,110 @@
+"""
+Prometheus metrics for the export pipeline, exposed on /status/metrics.
+
+The pipeline runs both as management commands (handle_signals, export_worker)
+and inside the web workers. To see the metrics of all of these processes,
+point the prometheus_multiproc_dir environment variable (lowercase, the only
+name prometheus_client 0.3 looks at) of every process to the same empty,
+writable directory: each process then writes its metrics there and the
+metrics view adds them up. Without it the view only shows the metrics of the
+web worker that answers the scrape.
+
+The backlog of unsent signals is counted in the database when scraped, not
+kept by any of the processes.
+"""
+import os
+
+from prometheus_client import (
+    CONTENT_TYPE_LATEST, REGISTRY, CollectorRegistry, Counter, Histogram,
+    generate_latest
+)
+from prometheus_client.core import GaugeMetricFamily
+
+# prometheus_client only writes the metrics to files when this is set
+MULTIPROC_DIR = os.getenv('prometheus_multiproc_dir')
+
+# Latencies range from microseconds (routing) to tens of seconds (slow APIs).
+_BUCKETS = (
+    .0001, .0005, .001, .005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10, 30, 60
+)
+
+SIGNALS_FETCHED = Counter(
+    'signals_export_signals_fetched_total',
+    'Signals fetched from the Signals API.')
+PAGE_DRIFT = Counter(
+    'signals_export_page_drift_total',
+    'Parallel crawls that fell back to following next links because pages shifted.')
+SIGNALS_SKIPPED = Counter(
+    'signals_export_signals_skipped_total',
+    'Signals that were not sent because they were sent before.',
+    ['handler'])
+SIGNALS_SENT = Counter(
+    'signals_export_signals_sent_total',
+    'Signals sent to an external API.',
+    ['handler'])
+SIGNALS_FAILED = Counter(
+    'signals_export_signals_failed_total',
+    'Signals that could not be sent to an external API.',
+    ['handler'])
+
+SIGNALS_PARKED = Counter(
+    'signals_export_signals_parked_total',
+    'Signals that were rejected by an external API and will not be sent again.',
+    ['handler'])
+PAGE_FETCH_SECONDS = Histogram(
+    'signals_export_page_fetch_seconds',
+    'Time taken to fetch a page of signals from the Signals API.',
+    buckets=_BUCKETS)
+TOKEN_FETCH_SECONDS = Histogram(
+    'signals_export_token_fetch_seconds',
+    'Time taken to log in for an access token.',
+    buckets=_BUCKETS)
+ROUTING_SECONDS = Histogram(
+    'signals_export_routing_seconds',
+    'Time spent in get_handler per page of signals.',
+    buckets=_BUCKETS)
+MESSAGE_GENERATION_SECONDS = Histogram(
+    'signals_export_message_generation_seconds',
+    'Time taken to generate the message for an external API.',
+    ['handler'], buckets=_BUCKETS)
+HANDLE_SECONDS = Histogram(
+    'signals_export_handle_seconds',
+    'Time taken by handler.handle (sending a signal to an external API).',
+    ['handler'], buckets=_BUCKETS)
+
+
+class BacklogCollector():
+    """
+    Count the MessageLog entries still to be sent when metrics are scraped.
+
+    Parked entries are not sent again, they are not part of the backlog.
+    """
+    def collect(self):
+        from datasets.models import MessageLog
+
+        backlog = GaugeMetricFamily(
+            'signals_export_backlog',
+            'Signals in the message log that were not sent (yet), except parked ones.')
+        backlog.add_metric(
+            [], MessageLog.objects.filter(is_sent=False, is_parked=False).count())
+        yield backlog
+
+
+_BACKLOG_REGISTRY = CollectorRegistry()
+_BACKLOG_REGISTRY.register(BacklogCollector())
+
+
+def render_metrics():
+    """
+    Get the metrics in the Prometheus text format, return (content, content type).
+    """
+    if MULTIPROC_DIR:
+        from prometheus_client import multiprocess
+
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry, path=MULTIPROC_DIR)
+    else:
+        registry = REGISTRY
+
+    content = generate_latest(registry) + generate_latest(_BACKLOG_REGISTRY)
+    return content, CONTENT_TYPE_LATEST
@@ -0,0 +1,20 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('datasets', '0002_syncstate'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Outbox',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('signal_id', models.CharField(max_length=255)),
+                ('payload', models.TextField()),
+                ('t_entered', models.DateTimeField()),
+            ],
+        ),
+    ]
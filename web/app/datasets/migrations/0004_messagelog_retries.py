@@ -0,0 +1,26 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('datasets', '0003_outbox'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='messagelog',
+            name='attempts',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='messagelog',
+            name='last_error',
+            field=models.CharField(blank=True, max_length=255),
+        ),
+        migrations.AddField(
+            model_name='messagelog',
+            name='next_attempt_at',
+            field=models.DateTimeField(null=True),
+        ),
+    ]
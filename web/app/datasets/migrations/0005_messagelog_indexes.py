@@ -0,0 +1,31 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('datasets', '0004_messagelog_retries'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='messagelog',
+            name='handler_name',
+            field=models.CharField(blank=True, db_index=True, max_length=255),
+        ),
+        migrations.AlterField(
+            model_name='messagelog',
+            name='is_sent',
+            field=models.BooleanField(db_index=True, default=False),
+        ),
+        migrations.AlterField(
+            model_name='messagelog',
+            name='t_entered',
+            field=models.DateTimeField(db_index=True),
+        ),
+        migrations.AlterField(
+            model_name='messagelog',
+            name='t_sent',
+            field=models.DateTimeField(db_index=True, null=True),
+        ),
+    ]
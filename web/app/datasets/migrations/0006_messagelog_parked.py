@@ -0,0 +1,21 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('datasets', '0005_messagelog_indexes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='messagelog',
+            name='is_parked',
+            field=models.BooleanField(db_index=True, default=False),
+        ),
+        migrations.AddField(
+            model_name='messagelog',
+            name='fault_code',
+            field=models.CharField(blank=True, max_length=255),
+        ),
+    ]
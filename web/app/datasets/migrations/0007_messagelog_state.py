@@ -0,0 +1,34 @@
+from django.db import migrations, models
+
+
+def set_state(apps, schema_editor):
+    MessageLog = apps.get_model('datasets', 'MessageLog')
+    MessageLog.objects.filter(is_sent=True).update(state='sent')
+    MessageLog.objects.filter(is_sent=False, is_parked=True).update(state='parked')
+    MessageLog.objects.filter(is_sent=False, is_parked=False, attempts__gt=0).update(state='failed')
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('datasets', '0006_messagelog_parked'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='messagelog',
+            name='state',
+            field=models.CharField(choices=[('pending', 'Pending'), ('claimed', 'Claimed'), ('sent', 'Sent'), ('failed', 'Failed'), ('parked', 'Parked')], db_index=True, default='pending', max_length=16),
+        ),
+        migrations.AddField(
+            model_name='messagelog',
+            name='claimed_by',
+            field=models.CharField(blank=True, max_length=255),
+        ),
+        migrations.AddField(
+            model_name='messagelog',
+            name='lease_expires_at',
+            field=models.DateTimeField(null=True),
+        ),
+        migrations.RunPython(set_state, migrations.RunPython.noop),
+    ]
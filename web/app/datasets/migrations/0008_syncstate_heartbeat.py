@@ -0,0 +1,16 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('datasets', '0007_messagelog_state'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='syncstate',
+            name='heartbeat_at',
+            field=models.DateTimeField(null=True),
+        ),
+    ]
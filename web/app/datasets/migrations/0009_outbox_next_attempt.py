@@ -0,0 +1,16 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('datasets', '0008_syncstate_heartbeat'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='outbox',
+            name='next_attempt_at',
+            field=models.DateTimeField(db_index=True, null=True),
+        ),
+    ]
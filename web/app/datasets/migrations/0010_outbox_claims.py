@@ -0,0 +1,21 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('datasets', '0009_outbox_next_attempt'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='outbox',
+            name='claimed_by',
+            field=models.CharField(blank=True, max_length=255),
+        ),
+        migrations.AddField(
+            model_name='outbox',
+            name='lease_expires_at',
+            field=models.DateTimeField(null=True),
+        ),
+    ]
@@ -0,0 +1,27 @@
+from django.db import migrations, models
+from django.db.models import Count, Min
+
+
+def remove_duplicates(apps, schema_editor):
+    Outbox = apps.get_model('datasets', 'Outbox')
+    duplicates = Outbox.objects.values('signal_id').annotate(
+        n=Count('id'), first_id=Min('id')).filter(n__gt=1)
+    for duplicate in duplicates:
+        Outbox.objects.filter(
+            signal_id=duplicate['signal_id']).exclude(id=duplicate['first_id']).delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('datasets', '0010_outbox_claims'),
+    ]
+
+    operations = [
+        migrations.RunPython(remove_duplicates, migrations.RunPython.noop),
+        migrations.AlterField(
+            model_name='outbox',
+            name='signal_id',
+            field=models.CharField(max_length=255, unique=True),
+        ),
+    ]
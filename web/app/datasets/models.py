@@ -2,9 +2,69 @@ from django.db import models
 
 
 class MessageLog(models.Model):
+    """
+    What happened to a signal: claimed by a runner, then sent, failed or parked.
+
+    A runner claims an entry (state claimed, with its id in claimed_by) until
+    lease_expires_at, after which another runner may take it over. is_sent
+    and is_parked follow the state.
+    """
+    PENDING = 'pending'
+    CLAIMED = 'claimed'
+    SENT = 'sent'
+    FAILED = 'failed'
+    PARKED = 'parked'
+    STATES = (
+        (PENDING, 'Pending'),
+        (CLAIMED, 'Claimed'),
+        (SENT, 'Sent'),
+        (FAILED, 'Failed'),
+        (PARKED, 'Parked'),
+    )
+
     signal_id = models.CharField(max_length=255, unique=True)
-    t_entered = models.DateTimeField()
-    t_sent = models.DateTimeField(null=True)
-    handler_name = models.CharField(max_length=255, blank=True)
+    t_entered = models.DateTimeField(db_index=True)
+    t_sent = models.DateTimeField(null=True, db_index=True)
+    handler_name = models.CharField(max_length=255, blank=True, db_index=True)
     status = models.CharField(max_length=255, blank=True)
-    is_sent = models.BooleanField(default=False)
+    is_sent = models.BooleanField(default=False, db_index=True)
+    attempts = models.IntegerField(default=0)
+    last_error = models.CharField(max_length=255, blank=True)
+    next_attempt_at = models.DateTimeField(null=True)
+    # rejected by the external API, not sent again
+    is_parked = models.BooleanField(default=False, db_index=True)
+    fault_code = models.CharField(max_length=255, blank=True)
+    state = models.CharField(max_length=16, choices=STATES, default=PENDING, db_index=True)
+    claimed_by = models.CharField(max_length=255, blank=True)
+    lease_expires_at = models.DateTimeField(null=True)
+
+
+class SyncState(models.Model):
+    """
+    Progress of a synchronization with the Signals API.
+
+    The watermark is the updated_at timestamp up to which all signals were
+    handled successfully, later runs only request signals from that point on.
+    """
+    name = models.CharField(max_length=255, unique=True)
+    watermark = models.DateTimeField(null=True)
+    t_updated = models.DateTimeField(null=True)
+    # last sign of life of handle_signals --daemon
+    heartbeat_at = models.DateTimeField(null=True)
+
+
+class Outbox(models.Model):
+    """
+    Signal waiting to be sent by one of the export workers.
+
+    Signals stay in the outbox until they are sent or parked, a signal that
+    could not be sent is tried again from next_attempt_at on. A worker claims
+    signals (claimed_by) until lease_expires_at, after that (the worker died)
+    another worker may claim them.
+    """
+    signal_id = models.CharField(max_length=255, unique=True)
+    payload = models.TextField()  # the signal as JSON
+    t_entered = models.DateTimeField()
+    next_attempt_at = models.DateTimeField(null=True, db_index=True)
+    claimed_by = models.CharField(max_length=255, blank=True)
+    lease_expires_at = models.DateTimeField(null=True)
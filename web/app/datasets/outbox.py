@@ -0,0 +1,173 @@
+"""
+Outbox of signals that still need to be sent, processed by export workers.
+
+Ingestion (handle_signals --enqueue) only writes signals to the outbox table.
+Any number of export workers (manage.py export_worker, on one or more nodes)
+claim batches of signals from the outbox, send them through the registered
+API handlers and record the results in the MessageLog. Claiming uses
+SELECT ... FOR UPDATE SKIP LOCKED, so workers never claim the same rows and
+no broker other than Postgres is needed. Claims are leases: the claiming
+transaction is committed before sending, so no locks or transaction are held
+while the external APIs are called, and the signals of a worker that died
+are claimed again when the lease expires. Signals stay in the outbox until
+they are sent or parked, so ingestion may move its watermark past them.
+"""
+import json
+import time
+import logging
+import datetime
+
+from django.db import IntegrityError, transaction
+from django.db.models import Case, DateTimeField, Q, Value, When
+from django.utils import timezone
+
+from datasets.models import MessageLog, Outbox
+from datasets.handle_signals import (
+    RETRY_BASE_DELAY, SIGNALS_CLAIM_LEASE, _call_external_apis, _worker_id
+)
+
+logger = logging.getLogger(__name__)
+
+
+def _insert_items(items):
+    """
+    Insert outbox items, return those that were queued by someone else first.
+
+    The signal_id is unique, signals queued concurrently (a crawl and the
+    ingest endpoint) are inserted once.
+    """
+    try:
+        with transaction.atomic():
+            Outbox.objects.bulk_create(items)
+        return []
+    except IntegrityError:
+        pass
+
+    taken = []
+    for item in items:
+        try:
+            with transaction.atomic():
+                item.save(force_insert=True)
+        except IntegrityError:
+            taken.append(item)
+    return taken
+
+
+def enqueue_signals(signals):
+    """
+    Add signals to the outbox, skip those that were sent, parked or are queued already.
+
+    Returns the number of signals that were added.
+    """
+    signal_ids = [str(signal['signal_id']) for signal in signals]
+    if not signal_ids:
+        return 0
+
+    skip = set(MessageLog.objects.filter(
+        Q(is_sent=True) | Q(is_parked=True), signal_id__in=signal_ids
+    ).values_list('signal_id', flat=True))
+    skip.update(Outbox.objects.filter(
+        signal_id__in=signal_ids).values_list('signal_id', flat=True))
+
+    now = timezone.now()
+    items = []
+    for signal_id, signal in zip(signal_ids, signals):
+        if signal_id in skip:
+            continue
+        skip.add(signal_id)
+        items.append(Outbox(signal_id=signal_id, payload=json.dumps(signal), t_entered=now))
+
+    return len(items) - len(_insert_items(items))
+
+
+def _claim_items(batch_size, worker_id, now):
+    """
+    Claim up to batch_size due signals that are not claimed (or the lease expired).
+    """
+    due = Q(next_attempt_at__isnull=True) | Q(next_attempt_at__lte=now)
+    free = Q(lease_expires_at__isnull=True) | Q(lease_expires_at__lte=now)
+    with transaction.atomic():
+        items = list(
+            Outbox.objects.select_for_update(skip_locked=True).filter(
+                due, free).order_by('id')[:batch_size])
+        if items:
+            Outbox.objects.filter(id__in=[item.id for item in items]).update(
+                claimed_by=worker_id, lease_expires_at=now + SIGNALS_CLAIM_LEASE)
+    return items
+
+
+def _acknowledge(items, worker_id, now):
+    """
+    Remove the items whose signal was sent or parked, reschedule the others.
+
+    An item is tried again when its MessageLog entry is due again (see
+    handle_signals._next_attempt_at), or after RETRY_BASE_DELAY seconds when
+    sending did not get that far (an exception, an open circuit breaker or
+    the entry claimed by another runner). Items that another worker claimed
+    in the meantime (the lease expired) are only removed, not rescheduled.
+    """
+    entries = MessageLog.objects.in_bulk(
+        [item.signal_id for item in items], field_name='signal_id')
+    fallback = now + datetime.timedelta(seconds=RETRY_BASE_DELAY)
+
+    done, retry = [], {}  # item ids, item id -> next attempt
+    for item in items:
+        entry = entries.get(item.signal_id)
+        if entry is not None and (entry.is_sent or entry.is_parked):
+            done.append(item.id)
+        elif entry is not None and entry.next_attempt_at is not None and \
+                entry.next_attempt_at > now:
+            retry[item.id] = entry.next_attempt_at
+        else:
+            retry[item.id] = fallback
+
+    with transaction.atomic():
+        Outbox.objects.filter(id__in=done).delete()
+        if retry:
+            Outbox.objects.filter(id__in=list(retry), claimed_by=worker_id).update(
+                claimed_by='', lease_expires_at=None, next_attempt_at=Case(
+                    *[When(id=item_id, then=Value(next_attempt_at))
+                      for item_id, next_attempt_at in retry.items()],
+                    output_field=DateTimeField()))
+
+
+def process_outbox(batch_size=100):
+    """
+    Claim a batch of signals from the outbox, send them and record the results.
+
+    Only signals that are due are claimed (see _claim_items), the claim is
+    committed before the signals are sent. Afterwards the signals that were
+    sent or parked are removed from the outbox, the others are rescheduled
+    (see _acknowledge). Returns the number of signals that were claimed.
+    """
+    worker_id = _worker_id()
+    items = _claim_items(batch_size, worker_id, timezone.now())
+    if not items:
+        return 0
+
+    signals = [json.loads(item.payload) for item in items]
+    try:
+        _call_external_apis(signals)
+    except Exception:
+        logger.exception('Sending a batch of %d signals failed.', len(items))
+
+    _acknowledge(items, worker_id, timezone.now())
+    return len(items)
+
+
+def run_worker(batch_size=100, idle_sleep=5.0, once=False, should_stop=lambda: False):
+    """
+    Process the outbox until no signal is due (once) or until should_stop() is true.
+    """
+    n_processed = 0
+    while not should_stop():
+        n_claimed = process_outbox(batch_size)
+        n_processed += n_claimed
+        if n_claimed:
+            logger.debug('Processed %d signals from the outbox.', n_claimed)
+            continue
+        if once:
+            break
+        time.sleep(idle_sleep)
+
+    return n_processed
@@ -1,12 +1,22 @@
 import os
 import json
+import random
+import threading
+import time
 import datetime
 import copy
+from io import StringIO
+from collections import OrderedDict
 from unittest import mock
 from unittest.mock import patch
+from urllib.parse import parse_qsl, urlparse
 
 from django.conf import settings
-from django.test import TestCase
+from django.db import connection
+from django.core.management import call_command
+from django.core.management.base import CommandError
+from django.test import SimpleTestCase, TestCase
+from django.test.utils import CaptureQueriesContext
 from django.utils import timezone
 from django.test.utils import override_settings
 from jsonschema.exceptions import ValidationError
@@ -14,8 +24,10 @@ import pytz
 import requests
 
 from datasets import handle_signals
-from datasets.models import MessageLog
-from datasets.external.base import reset_handlers
+from datasets.models import MessageLog, SyncState
+from datasets.external import base
+from datasets.external.base import reset_handlers, register_handler, BaseAPIHandler
+from datasets.internal.get_auth_token import AccessTokenManager
 
 
 # -- test _get_session_with_retries --
@@ -73,6 +85,412 @@ class TestCallExternalApis(TestCase):
             MessageLog.objects.filter(handler_name='local-log-only').count(), 2)
         # Note: this test assumes that the LogOnlyHandler fallback is present.
 
+    def test_signal_with_integer_id(self):
+        handle_signals._call_external_apis([{'signal_id': 1}, {'signal_id': 5}])
+
+        self.assertEquals(MessageLog.objects.count(), 2)
+        self.assertEquals(MessageLog.objects.get(signal_id='1').handler_name, 'some-handler')
+        self.assertTrue(MessageLog.objects.get(signal_id='5').is_sent)
+
+    def test_duplicate_signals_in_page(self):
+        signals = [{'signal_id': '7'}, {'signal_id': '7'}]
+
+        handle_signals._call_external_apis(signals)
+        self.assertEquals(MessageLog.objects.filter(signal_id='7').count(), 1)
+
+    def test_unsent_entry_is_updated(self):
+        MessageLog.objects.create(signal_id='2', t_entered=timezone.now())
+
+        handle_signals._call_external_apis(SIGNAL_PLACEHOLDERS)
+        entry = MessageLog.objects.get(signal_id='2')
+        self.assertTrue(entry.is_sent)
+        self.assertEquals(entry.handler_name, 'local-log-only')
+        self.assertEquals(entry.status, 'Only logged')
+
+    def test_handler_exception_is_recorded(self):
+        register_handler(FailOnFourHandler)
+
+        failed = handle_signals._call_external_apis(SIGNAL_PLACEHOLDERS)
+
+        self.assertEquals(failed, {'4'})
+        self.assertEquals(MessageLog.objects.count(), 3)
+        self.assertTrue(MessageLog.objects.get(signal_id='2').is_sent)
+        entry = MessageLog.objects.get(signal_id='4')
+        self.assertFalse(entry.is_sent)
+        self.assertEquals(entry.attempts, 1)
+        self.assertEquals(entry.last_error, 'RuntimeError')
+        self.assertEquals(entry.status, 'External API broke down.')
+        self.assertGreater(entry.next_attempt_at, timezone.now())
+
+    def test_failed_signal_is_retried_when_due(self):
+        register_handler(FailOnFourHandler)
+        handle_signals._call_external_apis(SIGNAL_PLACEHOLDERS)
+
+        # not due yet, skipped
+        failed = handle_signals._call_external_apis(SIGNAL_PLACEHOLDERS)
+        self.assertEquals(failed, {'4'})
+        self.assertEquals(MessageLog.objects.get(signal_id='4').attempts, 1)
+
+        MessageLog.objects.filter(signal_id='4').update(
+            next_attempt_at=timezone.now() - datetime.timedelta(seconds=1))
+        with patch.object(FailOnFourHandler, 'handle', return_value=(True, 'Sent')):
+            failed = handle_signals._call_external_apis(SIGNAL_PLACEHOLDERS)
+
+        self.assertEquals(failed, set())
+        entry = MessageLog.objects.get(signal_id='4')
+        self.assertTrue(entry.is_sent)
+        self.assertEquals(entry.attempts, 2)
+        self.assertEquals(entry.last_error, '')
+        self.assertIsNone(entry.next_attempt_at)
+
+    def test_reported_failure_is_recorded(self):
+        register_handler(FailOnFourHandler)
+
+        with patch.object(FailOnFourHandler, 'handle', return_value=(False, 'Server said no')):
+            handle_signals._call_external_apis([{'signal_id': '9'}])
+
+        entry = MessageLog.objects.get(signal_id='9')
+        self.assertEquals(entry.last_error, 'Server said no')
+        self.assertIsNotNone(entry.next_attempt_at)
+
+    def test_permanent_failure_is_parked(self):
+        register_handler(FailOnFourHandler)
+        rejected = base.HandlerResult(
+            False, 'HTTP 500 StUF058: Zaak bestaat al', permanent=True, fault_code='StUF058')
+
+        with patch.object(FailOnFourHandler, 'handle', return_value=rejected) as handle:
+            failed = handle_signals._call_external_apis([{'signal_id': '9'}])
+            self.assertEquals(failed, set())  # not retried, the watermark may move on
+
+            entry = MessageLog.objects.get(signal_id='9')
+            self.assertTrue(entry.is_parked)
+            self.assertFalse(entry.is_sent)
+            self.assertEquals(entry.fault_code, 'StUF058')
+            self.assertIsNone(entry.next_attempt_at)
+
+            handle_signals._call_external_apis([{'signal_id': '9'}])
+            self.assertEquals(handle.call_count, 1)
+
+        # rejections do not open the circuit breaker
+        self.assertFalse(base.get_circuit_breaker('fail-on-four').is_open)
+
+    def test_parked_after_max_attempts(self):
+        register_handler(FailOnFourHandler)
+        MessageLog.objects.create(
+            signal_id='4', t_entered=timezone.now(),
+            attempts=handle_signals.RETRY_MAX_ATTEMPTS - 1, state=MessageLog.FAILED)
+
+        with self.assertLogs('datasets.handle_signals', 'WARNING') as logs:
+            failed = handle_signals._call_external_apis([{'signal_id': '4'}])
+
+        self.assertEquals(failed, set())  # no longer holds back the watermark
+        entry = MessageLog.objects.get(signal_id='4')
+        self.assertEquals(entry.state, MessageLog.PARKED)
+        self.assertTrue(entry.is_parked)
+        self.assertEquals(entry.attempts, handle_signals.RETRY_MAX_ATTEMPTS)
+        self.assertEquals(entry.status, 'External API broke down.')
+        self.assertIsNone(entry.next_attempt_at)
+        self.assertIn('Giving up on signal 4 after', logs.output[-1])
+
+    def test_circuit_breaker_stops_sending(self):
+        register_handler(FailOnFourHandler)
+        signals = [{'signal_id': str(i)} for i in range(10, 20)]
+
+        with patch.object(FailOnFourHandler, 'handle', return_value=(False, 'Error')) as handle:
+            failed = handle_signals._call_external_apis(signals)
+
+        threshold = base.CIRCUIT_BREAKER_THRESHOLD
+        self.assertEquals(handle.call_count, threshold)
+        self.assertEquals(failed, set(s['signal_id'] for s in signals))
+        entries = MessageLog.objects.filter(signal_id__in=failed)
+        self.assertEquals(entries.filter(attempts=1).count(), threshold)
+        self.assertEquals(entries.filter(attempts=0).count(), 10 - threshold)
+
+    def test_queries_per_page_do_not_depend_on_page_size(self):
+        def count_queries(signals):
+            with CaptureQueriesContext(connection) as context:
+                handle_signals._call_external_apis(signals)
+            return len(context.captured_queries)
+
+        small_page = [{'signal_id': 'small-{}'.format(i)} for i in range(2)]
+        large_page = [{'signal_id': 'large-{}'.format(i)} for i in range(100)]
+
+        self.assertEquals(count_queries(small_page), count_queries(large_page))
+        # second time around all signals are sent, so only a lookup is needed
+        self.assertEquals(count_queries(large_page), 1)
+
+
+class CountingHandler(BaseAPIHandler):
+    name = 'counting'
+    sent = []
+
+    def handle(self, signal):
+        self.sent.append(signal['signal_id'])
+        return True, 'Sent'
+
+    def can_handle(self, signal):
+        return True
+
+
+class TestClaims(TestCase):
+    def setUp(self):
+        reset_handlers()
+        register_handler(CountingHandler)
+        CountingHandler.sent = []
+        self.now = timezone.now()
+
+    def _claimed_elsewhere(self, signal_id, lease_expires_at):
+        return MessageLog.objects.create(
+            signal_id=signal_id, t_entered=self.now, state=MessageLog.CLAIMED,
+            claimed_by='other-host:1', lease_expires_at=lease_expires_at)
+
+    def test_states(self):
+        register_handler(FailOnFourHandler)
+        handle_signals._call_external_apis([{'signal_id': '3'}, {'signal_id': '4'}])
+
+        sent = MessageLog.objects.get(signal_id='3')
+        self.assertEquals((sent.state, sent.is_sent), (MessageLog.SENT, True))
+        failed = MessageLog.objects.get(signal_id='4')
+        self.assertEquals((failed.state, failed.is_sent), (MessageLog.FAILED, False))
+        for entry in [sent, failed]:
+            self.assertEquals(entry.claimed_by, '')
+            self.assertIsNone(entry.lease_expires_at)
+
+    def test_claimed_by_another_runner(self):
+        self._claimed_elsewhere('1', self.now + datetime.timedelta(minutes=5))
+
+        failed = handle_signals._call_external_apis([{'signal_id': '1'}, {'signal_id': '2'}])
+
+        self.assertEquals(CountingHandler.sent, ['2'])
+        self.assertEquals(failed, {'1'})
+        entry = MessageLog.objects.get(signal_id='1')
+        self.assertEquals((entry.state, entry.claimed_by), (MessageLog.CLAIMED, 'other-host:1'))
+
+    def test_expired_lease_is_taken_over(self):
+        self._claimed_elsewhere('1', self.now - datetime.timedelta(seconds=1))
+
+        failed = handle_signals._call_external_apis([{'signal_id': '1'}])
+
+        self.assertEquals(CountingHandler.sent, ['1'])
+        self.assertEquals(failed, set())
+        self.assertEquals(MessageLog.objects.get(signal_id='1').state, MessageLog.SENT)
+
+    def test_inserted_by_another_runner(self):
+        # another runner inserts (and claims) the entry after we looked it up
+        signals = [{'signal_id': '1'}, {'signal_id': '2'}]
+        original_in_bulk = MessageLog.objects.in_bulk
+
+        def in_bulk(*args, **kwargs):
+            entries = original_in_bulk(*args, **kwargs)
+            self._claimed_elsewhere('1', self.now + datetime.timedelta(minutes=5))
+            return entries
+
+        with patch.object(MessageLog.objects, 'in_bulk', side_effect=in_bulk):
+            failed = handle_signals._call_external_apis(signals)
+
+        self.assertEquals(CountingHandler.sent, ['2'])
+        self.assertEquals(failed, {'1'})
+        self.assertEquals(MessageLog.objects.get(signal_id='2').state, MessageLog.SENT)
+
+    def test_claim_lost_while_sending(self):
+        def handle(signal):
+            # the lease expired and another runner took the entry over
+            MessageLog.objects.filter(signal_id=signal['signal_id']).update(claimed_by='other-host:1')
+            return True, 'Sent'
+
+        with patch.object(CountingHandler, 'handle', side_effect=handle):
+            with self.assertLogs('datasets.handle_signals', 'WARNING'):
+                handle_signals._call_external_apis([{'signal_id': '1'}])
+
+        entry = MessageLog.objects.get(signal_id='1')
+        self.assertEquals((entry.state, entry.claimed_by), (MessageLog.CLAIMED, 'other-host:1'))
+
+    def test_claims_renewed_while_sending(self):
+        lease = datetime.timedelta(seconds=0.3)
+        unexpired = []
+
+        def handle(signal):
+            time.sleep(0.2)  # the page takes longer than the lease
+            unexpired.append(MessageLog.objects.filter(
+                state=MessageLog.CLAIMED, lease_expires_at__gt=timezone.now()).count())
+            return True, 'Sent'
+
+        with patch.object(handle_signals, 'SIGNALS_CLAIM_LEASE', lease), \
+                patch.object(CountingHandler, 'handle', side_effect=handle):
+            handle_signals._call_external_apis([{'signal_id': str(i)} for i in range(3)])
+
+        self.assertEquals(unexpired, [3, 3, 3])
+        self.assertEquals(MessageLog.objects.filter(state=MessageLog.SENT).count(), 3)
+
+    def test_outcomes_saved_while_sending(self):
+        saved = []
+
+        def handle(signal):
+            saved.append(MessageLog.objects.filter(state=MessageLog.SENT).count())
+            if signal['signal_id'] == '3':
+                raise KeyboardInterrupt  # the run is killed
+            return True, 'Sent'
+
+        with patch.object(handle_signals, 'SIGNALS_SAVE_INTERVAL', 0), \
+                patch.object(CountingHandler, 'handle', side_effect=handle):
+            with self.assertRaises(KeyboardInterrupt):
+                handle_signals._call_external_apis([{'signal_id': str(i)} for i in range(4)])
+
+        # the outcomes of earlier signals were saved before the next ones were sent
+        self.assertEquals(saved, [0, 0, 1, 2])
+        self.assertEquals(
+            dict(MessageLog.objects.values_list('signal_id', 'state')),
+            {'0': MessageLog.SENT, '1': MessageLog.SENT, '2': MessageLog.SENT,
+             '3': MessageLog.PENDING})
+
+    def test_claim_released_when_not_sent(self):
+        breaker = base.get_circuit_breaker(CountingHandler.name)
+        for i in range(breaker.failure_threshold):
+            breaker.record_failure()
+
+        failed = handle_signals._call_external_apis([{'signal_id': '1'}])
+
+        self.assertEquals(failed, {'1'})
+        entry = MessageLog.objects.get(signal_id='1')
+        self.assertEquals((entry.state, entry.claimed_by, entry.attempts), (MessageLog.PENDING, '', 0))
+
+
+class TestBulkUpdateEntries(TestCase):
+    def test_batches(self):
+        for i in range(5):
+            MessageLog.objects.create(signal_id=str(i), t_entered=timezone.now())
+        entries = list(MessageLog.objects.order_by('signal_id'))
+        for entry in entries:
+            entry.status = 'status {}'.format(entry.signal_id)
+
+        with CaptureQueriesContext(connection) as context:
+            handle_signals._bulk_update_entries(entries, ['status'], batch_size=2)
+
+        self.assertEquals(len(context.captured_queries), 3)
+        self.assertEquals(
+            list(MessageLog.objects.order_by('signal_id').values_list('status', flat=True)),
+            ['status {}'.format(i) for i in range(5)])
+
+    def test_many_entries(self):
+        MessageLog.objects.bulk_create([
+            MessageLog(signal_id=str(i), t_entered=timezone.now()) for i in range(1000)])
+        entries = list(MessageLog.objects.all())
+        for entry in entries:
+            entry.is_sent = True
+
+        handle_signals._bulk_update_entries(entries, handle_signals._OUTCOME_FIELDS)
+
+        self.assertEquals(MessageLog.objects.filter(is_sent=True).count(), 1000)
+
+
+class TestNextAttemptAt(TestCase):
+    def test_backoff(self):
+        now = timezone.now()
+        for attempts in range(1, 20):
+            delay = min(
+                handle_signals.RETRY_BASE_DELAY * 2 ** (attempts - 1),
+                handle_signals.RETRY_MAX_DELAY)
+            next_attempt_at = handle_signals._next_attempt_at(attempts, now)
+
+            self.assertGreaterEqual(next_attempt_at, now + datetime.timedelta(seconds=delay / 2))
+            self.assertLessEqual(next_attempt_at, now + datetime.timedelta(seconds=delay))
+
+
+class TestConcurrentDispatch(TestCase):
+    def setUp(self):
+        reset_handlers()
+        register_handler(SlowConcurrentHandler)
+        SlowConcurrentHandler.in_flight = 0
+        SlowConcurrentHandler.max_in_flight = 0
+        SlowConcurrentHandler.handled = []
+
+    def test_concurrency_limit(self):
+        signals = [{'signal_id': str(i)} for i in range(10)]
+
+        handle_signals._call_external_apis(signals)
+
+        self.assertEquals(
+            MessageLog.objects.filter(is_sent=True, handler_name='slow').count(), 10)
+        self.assertEquals(sorted(SlowConcurrentHandler.handled), sorted(s['signal_id'] for s in signals))
+        self.assertLessEqual(SlowConcurrentHandler.max_in_flight, SlowConcurrentHandler.max_concurrency)
+        self.assertGreater(SlowConcurrentHandler.max_in_flight, 1)
+
+    def test_sent_only_once(self):
+        signals = [{'signal_id': str(i % 3)} for i in range(9)]
+
+        handle_signals._call_external_apis(signals)
+        handle_signals._call_external_apis(signals)
+
+        self.assertEquals(len(SlowConcurrentHandler.handled), 3)
+        self.assertEquals(MessageLog.objects.filter(is_sent=True).count(), 3)
+
+    def test_handler_exception_is_recorded(self):
+        signals = [{'signal_id': str(i)} for i in range(4)] + [{'signal_id': 'broken'}]
+
+        failed = handle_signals._call_external_apis(signals)
+
+        self.assertEquals(failed, {'broken'})
+        self.assertEquals(MessageLog.objects.filter(is_sent=True).count(), 4)
+        self.assertEquals(MessageLog.objects.get(signal_id='broken').last_error, 'RuntimeError')
+
+    @patch('datasets.handle_signals._send')
+    def test_completed_results_saved_when_sending_raises(self, patched_send):
+        def send(handler, signal):
+            time.sleep(0.05)
+            if signal['signal_id'] == 'broken':
+                raise RuntimeError('Bug in the dispatcher.')
+            return base.HandlerResult(True, 'Sent'), ''
+        patched_send.side_effect = send
+        signals = [{'signal_id': 'broken'}] + [{'signal_id': str(i)} for i in range(4)]
+
+        with self.assertRaises(RuntimeError):
+            handle_signals._call_external_apis(signals)
+
+        self.assertEquals(MessageLog.objects.count(), 5)
+        self.assertEquals(
+            MessageLog.objects.filter(is_sent=True).count(),
+            patched_send.call_count - 1)
+        self.assertFalse(MessageLog.objects.get(signal_id='broken').is_sent)
+
+
+class SlowConcurrentHandler(BaseAPIHandler):
+    name = 'slow'
+    max_concurrency = 3
+
+    in_flight = 0
+    max_in_flight = 0
+    handled = []
+    _lock = threading.Lock()
+
+    def handle(self, signal):
+        cls = self.__class__
+        with cls._lock:
+            cls.in_flight += 1
+            cls.max_in_flight = max(cls.max_in_flight, cls.in_flight)
+        time.sleep(0.05)
+        with cls._lock:
+            cls.in_flight -= 1
+        if signal['signal_id'] == 'broken':
+            raise RuntimeError('External API broke down.')
+        with cls._lock:
+            cls.handled.append(signal['signal_id'])
+        return True, 'Sent'
+
+    def can_handle(self, signal):
+        return True
+
+
+class FailOnFourHandler(BaseAPIHandler):
+    name = 'fail-on-four'
+
+    def handle(self, signal):
+        if signal['signal_id'] == '4':
+            raise RuntimeError('External API broke down.')
+        return True, 'Sent'
+
+    def can_handle(self, signal):
+        return True
+
 
 # -- test _validate_signal_api_data --
 
@@ -160,6 +578,301 @@ class TestBatchSignals(TestCase):
         self.assertEquals(patched_get.call_count, 2)
         self.assertEquals(patched_json.json.call_count, 2)
 
+    @patch('requests.Session.get')
+    def test_retry_after_403(self, patched_get):
+        refused = mock.MagicMock(status_code=403)
+        page = mock.MagicMock(status_code=200)
+        page.json.return_value = _TWO_PAGES[1]
+        patched_get.side_effect = [refused, page]
+
+        token_manager = mock.MagicMock(spec=AccessTokenManager)
+        token_manager.get_headers.side_effect = [
+            {'Authorization': 'Bearer OLD'}, {'Authorization': 'Bearer NEW'}]
+
+        pages = list(handle_signals._batch_signals(token_manager))
+
+        self.assertEquals(len(pages), 1)
+        # only the refused token is dropped
+        token_manager.invalidate.assert_called_once_with('OLD')
+        self.assertEquals(patched_get.call_args[1]['headers'], {'Authorization': 'Bearer NEW'})
+
+    @patch('requests.Session.get')
+    def test_403_twice(self, patched_get):
+        patched_get.return_value = mock.MagicMock(status_code=403)
+
+        token_manager = mock.MagicMock(spec=AccessTokenManager)
+        token_manager.get_headers.return_value = {'Authorization': 'DOES NOT MATTER'}
+
+        with self.assertRaises(Exception):
+            list(handle_signals._batch_signals(token_manager))
+        self.assertEquals(patched_get.call_count, 2)
+
+    @patch('requests.Session.get')
+    def test_since(self, patched_get):
+        patched_json = mock.MagicMock()
+        patched_json.json = mock.MagicMock()
+        patched_json.json.return_value = _TWO_PAGES[0]
+
+        patched_get.return_value = patched_json
+        since = datetime.datetime(2018, 7, 1, 12, 0, tzinfo=pytz.utc)
+        for page in handle_signals._batch_signals('NO MATTER', since=since):
+            patched_json.json.return_value = _TWO_PAGES[1]  # simulate the second page
+
+        first_params = patched_get.call_args_list[0][1]['params']
+        self.assertEquals(first_params, {'updated_at__gte': '2018-07-01T12:00:00+00:00'})
+        # the next page link already includes the query parameters
+        self.assertEquals(patched_get.call_args_list[1][1]['params'], None)
+
+
+# -- test streaming pages --
+
+def _chunked(data, size):
+    body = json.dumps(data, ensure_ascii=False).encode('utf-8')
+    return [body[i:i + size] for i in range(0, len(body), size)]
+
+
+_STREAMED_SIGNALS = [
+    {'signal_id': '1', 'text': 'Escaped "quotes", a \\ and a ]}', 'id': 12345},
+    {'signal_id': '2', 'text': 'Straat één €', 'id': 678},
+]
+
+
+class TestPageStream(TestCase):
+    def _decode(self, chunks):
+        page = handle_signals._PageStream(chunks)
+        return list(page.signals()), page.fields
+
+    def test_links_before_and_after_results(self):
+        links = {'next': {'href': 'https://example.com/?page=2'}}
+        for data in [
+                OrderedDict([('_links', links), ('count', 2), ('results', _STREAMED_SIGNALS)]),
+                OrderedDict([('results', _STREAMED_SIGNALS), ('count', 2), ('_links', links)])]:
+            signals, fields = self._decode(_chunked(data, 1000))
+            self.assertEquals(signals, _STREAMED_SIGNALS)
+            self.assertEquals(fields, {'_links': links, 'count': 2})
+
+    def test_chunk_boundaries(self):
+        data = {'count': 12345, 'results': _STREAMED_SIGNALS, '_links': {'next': {'href': None}}}
+        # every chunk size splits strings, numbers and multi-byte characters somewhere
+        for size in range(1, 20):
+            signals, fields = self._decode(_chunked(data, size))
+            self.assertEquals(signals, _STREAMED_SIGNALS)
+            self.assertEquals(fields['count'], 12345)
+
+    def test_empty(self):
+        self.assertEquals(self._decode([b'{}']), ([], {}))
+        self.assertEquals(self._decode([b' {"results": [ ], "count": 0} ']), ([], {'count': 0}))
+
+    def test_invalid(self):
+        for body in [b'', b'[]', b'{"results": [{"signal_id": "1"}', b'{"results": [1 2]}']:
+            with self.assertRaises(ValueError):
+                self._decode([body])
+
+
+class TestBatchSignalsStreaming(TestCase):
+    def _response(self, data):
+        response = mock.MagicMock(status_code=200)
+        response.iter_content.return_value = _chunked(data, 7)
+        return response
+
+    @patch('datasets.handle_signals.SIGNALS_STREAM_BATCH_SIZE', 2)
+    @patch('datasets.handle_signals.SIGNALS_STREAM_PAGES', True)
+    @patch('datasets.handle_signals.SIGNALS_PAGE_SIZE', '1000')
+    @patch('requests.Session.get')
+    def test_batches(self, patched_get):
+        first = [{'signal_id': str(i)} for i in range(5)]
+        responses = [
+            self._response(OrderedDict([
+                ('results', first), ('_links', {'next': {'href': 'https://example.com/?page=2'}})])),
+            self._response(OrderedDict([
+                ('_links', {'next': {'href': None}}), ('results', [{'signal_id': '5'}])])),
+        ]
+        patched_get.side_effect = responses
+
+        batches = list(handle_signals._batch_signals('NO MATTER'))
+
+        self.assertEquals([len(batch) for batch in batches], [2, 2, 1, 1])
+        self.assertEquals(batches[0] + batches[1] + batches[2], first)
+        self.assertEquals(patched_get.call_args_list[0][1]['params'], {'page_size': '1000'})
+        self.assertTrue(patched_get.call_args_list[0][1]['stream'])
+        self.assertEquals(patched_get.call_args_list[1][0][0], 'https://example.com/?page=2')
+        self.assertEquals(patched_get.call_args_list[1][1]['params'], None)
+        for response in responses:
+            self.assertTrue(response.close.called)
+
+
+# -- test fetching pages in parallel --
+
+class FakeSignalsAPI():
+    """
+    Pages of numbered signals, served (with random delays) by a patched Session.get.
+    """
+    base = 'https://example.com/signals/auth/signal/'
+
+    def __init__(self, n_signals, page_size):
+        self.n_signals = n_signals
+        self.page_size = page_size
+        self.requested = []
+        self.lock = threading.Lock()
+
+    def page(self, number):
+        start = (number - 1) * self.page_size
+        end = min(start + self.page_size, self.n_signals)
+        next_page = None
+        if end < self.n_signals:
+            next_page = '{}?page={}&page_size={}'.format(self.base, number + 1, self.page_size)
+        return {
+            '_links': {'next': {'href': next_page}},
+            'count': self.n_signals,
+            'results': [{'signal_id': str(i)} for i in range(start, end)],
+        }
+
+    def get(self, url, headers=None, params=None, stream=False):
+        with self.lock:
+            self.requested.append(url)
+        query = dict(parse_qsl(urlparse(url).query))
+        time.sleep(random.random() * 0.01)
+        response = mock.MagicMock(status_code=200)
+        response.json.return_value = self.page(int(query.get('page', 1)))
+        return response
+
+
+class TestFetchPagesInParallel(TestCase):
+    def _signal_ids(self, api, concurrency=4):
+        with patch('requests.Session.get', side_effect=api.get), \
+                patch('datasets.handle_signals.SIGNALS_API_BASE', 'https://example.com'):
+            pages = handle_signals._batch_signals('NO MATTER', concurrency=concurrency)
+            return [signal['signal_id'] for page in pages for signal in page]
+
+    def test_pages_in_order(self):
+        api = FakeSignalsAPI(n_signals=95, page_size=10)
+        self.assertEquals(self._signal_ids(api), [str(i) for i in range(95)])
+        self.assertEquals(len(api.requested), 10)
+        self.assertEquals(len(set(api.requested)), 10)
+
+    def test_single_page(self):
+        api = FakeSignalsAPI(n_signals=5, page_size=10)
+        self.assertEquals(self._signal_ids(api), [str(i) for i in range(5)])
+        self.assertEquals(len(api.requested), 1)
+
+    def test_drift(self):
+        api = FakeSignalsAPI(n_signals=50, page_size=10)
+        page = api.page
+
+        def shifted_page(number):
+            if number >= 3:  # two signals were added before page 3 was fetched
+                api.n_signals = 52
+            return page(number)
+
+        api.page = shifted_page
+        with self.assertLogs('datasets.handle_signals', 'WARNING'):
+            signal_ids = self._signal_ids(api)
+
+        # the pages from the shifted one on are fetched by following the next links
+        self.assertEquals(signal_ids, [str(i) for i in range(52)])
+
+    def test_cursor_pagination(self):
+        api = FakeSignalsAPI(n_signals=30, page_size=10)
+        page = api.page
+
+        def cursor_page(number):
+            data = page(number)
+            if data['_links']['next']['href']:
+                data['_links']['next']['href'] = data['_links']['next']['href'].replace('page=', 'p=')
+            return data
+
+        def get(url, **kwargs):
+            return FakeSignalsAPI.get(api, url.replace('p=', 'page='), **kwargs)
+
+        api.page = cursor_page
+        api.get = get
+        self.assertEquals(self._signal_ids(api), [str(i) for i in range(30)])
+
+    def test_stops_when_consumer_stops(self):
+        n_threads = threading.active_count()
+        api = FakeSignalsAPI(n_signals=1000, page_size=10)
+        with patch('requests.Session.get', side_effect=api.get):
+            pages = handle_signals._batch_signals('NO MATTER', concurrency=4)
+            next(pages)
+            next(pages)
+            pages.close()
+
+        self.assertEquals(threading.active_count(), n_threads)
+        self.assertLessEqual(len(api.requested), 1 + 1 + 4)
+
+
+# -- test _prefetch_pages --
+
+class CountingPages():
+    """Iterable over numbered pages that keeps track of the fetched pages."""
+    def __init__(self, n_pages, fail_at=None):
+        self.n_pages = n_pages
+        self.fail_at = fail_at
+        self.fetched = 0
+
+    def __iter__(self):
+        for i in range(self.n_pages):
+            if i == self.fail_at:
+                raise requests.ConnectionError('Network is down.')
+            self.fetched += 1
+            yield [{'signal_id': str(i)}]
+
+
+class TestPrefetchPages(TestCase):
+    def test_order_is_kept(self):
+        pages = list(handle_signals._prefetch_pages(iter(CountingPages(10)), 2))
+        self.assertEquals(pages, [[{'signal_id': str(i)}] for i in range(10)])
+
+    def test_no_prefetching(self):
+        pages = list(handle_signals._prefetch_pages(iter(CountingPages(3)), 0))
+        self.assertEquals(len(pages), 3)
+
+    def test_backpressure(self):
+        counting = CountingPages(20)
+        pages = handle_signals._prefetch_pages(iter(counting), 2)
+
+        next(pages)
+        time.sleep(0.2)
+        # consumed 1 page, 2 waiting in the queue, 1 waiting to be put in the queue
+        self.assertLessEqual(counting.fetched, 4)
+        pages.close()
+
+    def test_fetched_pages_before_failure_are_kept(self):
+        counting = CountingPages(10, fail_at=3)
+        received = []
+
+        with self.assertRaises(requests.ConnectionError):
+            for page in handle_signals._prefetch_pages(iter(counting), 2):
+                received.append(page)
+
+        self.assertEquals(len(received), 3)
+
+    def test_fetcher_stops_when_consumer_stops(self):
+        n_threads = threading.active_count()
+        counting = CountingPages(100)
+        pages = handle_signals._prefetch_pages(iter(counting), 2)
+
+        next(pages)
+        pages.close()
+
+        self.assertEquals(threading.active_count(), n_threads)
+        self.assertLess(counting.fetched, 100)
+
+    @patch('datasets.handle_signals._call_external_apis')
+    @patch('datasets.handle_signals._batch_signals')
+    @patch('datasets.internal.get_auth_token.GetAccessToken.getToken',
+           return_value=('DOES NOT MATTER', 3600))
+    def test_fetcher_stops_when_sending_fails(
+            self, patched_get_access_token, patched_batch, patched_call):
+        n_threads = threading.active_count()
+        patched_batch.return_value = iter(CountingPages(100))
+        patched_call.side_effect = RuntimeError('Cannot send.')
+
+        with self.assertRaises(RuntimeError):
+            handle_signals.handle_signals()
+
+        self.assertEquals(threading.active_count(), n_threads)
+
 
 # -- test handle_signals --
 
@@ -168,9 +881,9 @@ class TestHandleSignals(TestCase):
         reset_handlers()
 
     @patch('datasets.handle_signals._batch_signals')
-    @patch('datasets.internal.get_auth_token.GetAccessToken.getAccessToken')
+    @patch('datasets.internal.get_auth_token.GetAccessToken.getToken',
+           return_value=('DOES NOT MATTER', 3600))
     def test_handle_signals(self, patched_get_access_token, patched_batch):
-        patched_get_access_token.return_value = {'Authorization', 'DOES NOT MATTER'}
         patched_batch.return_value = [[{'signal_id': 1}, {'signal_id': 2}], [{'signal_id': 3}]]
 
         handle_signals.handle_signals()
@@ -180,3 +893,309 @@ class TestHandleSignals(TestCase):
 
         self.assertEquals(
             MessageLog.objects.filter(handler_name='local-log-only').count(), 3)
+
+
+def _timestamped(signal_id, updated_at):
+    return {'signal_id': signal_id, 'updated_at': updated_at}
+
+
+class TestIncrementalSync(TestCase):
+    def setUp(self):
+        reset_handlers()
+
+    @patch('datasets.handle_signals._batch_signals')
+    @patch('datasets.internal.get_auth_token.GetAccessToken.getToken',
+           return_value=('DOES NOT MATTER', 3600))
+    def test_first_run_is_complete_crawl(self, patched_get_access_token, patched_batch):
+        patched_batch.return_value = [
+            [_timestamped('1', '2018-07-01T10:00:00Z'), _timestamped('2', '2018-07-03T10:00:00Z')],
+            [_timestamped('3', '2018-07-02T10:00:00Z')],
+        ]
+
+        handle_signals.handle_signals()
+
+        self.assertEquals(patched_batch.call_args[1]['since'], None)
+        state = SyncState.objects.get(name=handle_signals.SYNC_NAME)
+        self.assertEquals(state.watermark, datetime.datetime(2018, 7, 3, 10, 0, tzinfo=pytz.utc))
+
+    @patch('datasets.handle_signals._batch_signals')
+    @patch('datasets.internal.get_auth_token.GetAccessToken.getToken',
+           return_value=('DOES NOT MATTER', 3600))
+    def test_incremental_run(self, patched_get_access_token, patched_batch):
+        watermark = datetime.datetime(2018, 7, 3, 10, 0, tzinfo=pytz.utc)
+        SyncState.objects.create(name=handle_signals.SYNC_NAME, watermark=watermark)
+        patched_batch.return_value = []
+
+        handle_signals.handle_signals()
+
+        self.assertEquals(
+            patched_batch.call_args[1]['since'],
+            watermark - handle_signals.SIGNALS_SYNC_OVERLAP)
+        # nothing new was seen, watermark stays where it was
+        state = SyncState.objects.get(name=handle_signals.SYNC_NAME)
+        self.assertEquals(state.watermark, watermark)
+
+    @patch('datasets.handle_signals._batch_signals')
+    @patch('datasets.internal.get_auth_token.GetAccessToken.getToken',
+           return_value=('DOES NOT MATTER', 3600))
+    def test_full_run(self, patched_get_access_token, patched_batch):
+        watermark = datetime.datetime(2018, 7, 3, 10, 0, tzinfo=pytz.utc)
+        SyncState.objects.create(name=handle_signals.SYNC_NAME, watermark=watermark)
+        patched_batch.return_value = []
+
+        handle_signals.handle_signals(full=True)
+
+        self.assertEquals(patched_batch.call_args[1]['since'], None)
+
+    @patch('datasets.handle_signals._batch_signals')
+    @patch('datasets.internal.get_auth_token.GetAccessToken.getToken',
+           return_value=('DOES NOT MATTER', 3600))
+    def test_watermark_stops_at_failed_signal(self, patched_get_access_token, patched_batch):
+        register_handler(FailOnFourHandler)
+        patched_batch.return_value = [[
+            _timestamped('1', '2018-07-01T10:00:00Z'),
+            _timestamped('2', '2018-07-03T10:00:00Z'),
+        ]]
+
+        with patch.object(FailOnFourHandler, 'handle', side_effect=[(True, 'Sent'), (False, 'Error')]):
+            handle_signals.handle_signals()
+
+        state = SyncState.objects.get(name=handle_signals.SYNC_NAME)
+        self.assertEquals(state.watermark, datetime.datetime(2018, 7, 3, 10, 0, tzinfo=pytz.utc))
+
+        patched_batch.return_value = [[
+            _timestamped('3', '2018-07-04T10:00:00Z'),
+            _timestamped('4', '2018-07-05T10:00:00Z'),
+        ]]
+        with patch.object(FailOnFourHandler, 'handle', side_effect=[(False, 'Error'), (True, 'Sent')]):
+            handle_signals.handle_signals()
+
+        state = SyncState.objects.get(name=handle_signals.SYNC_NAME)
+        self.assertEquals(state.watermark, datetime.datetime(2018, 7, 4, 10, 0, tzinfo=pytz.utc))
+
+    @patch('datasets.handle_signals._batch_signals')
+    @patch('datasets.internal.get_auth_token.GetAccessToken.getToken',
+           return_value=('DOES NOT MATTER', 3600))
+    def test_watermark_kept_on_failed_crawl(self, patched_get_access_token, patched_batch):
+        def pages(access_token, since=None):
+            yield [_timestamped('1', '2018-07-01T10:00:00Z')]
+            raise Exception('Wrong or expired access token, cannot access data.')
+        patched_batch.side_effect = pages
+
+        with self.assertRaises(Exception):
+            handle_signals.handle_signals()
+
+        self.assertFalse(SyncState.objects.filter(watermark__isnull=False).exists())
+
+    @patch('datasets.handle_signals.SIGNALS_PREFETCH_PAGES', 0)  # same thread
+    @patch('datasets.handle_signals._batch_signals')
+    @patch('datasets.internal.get_auth_token.GetAccessToken.getToken',
+           return_value=('DOES NOT MATTER', 3600))
+    def test_only_watermark_saved(self, patched_get_access_token, patched_batch):
+        newer = datetime.datetime(2018, 7, 5, 10, 0, tzinfo=pytz.utc)
+
+        def pages(token_manager, since=None, **kwargs):
+            # meanwhile the daemon writes a heartbeat and a concurrent run
+            # moves the watermark further
+            SyncState.objects.filter(name=handle_signals.SYNC_NAME).update(
+                heartbeat_at=timezone.now(), watermark=newer)
+            yield [_timestamped('1', '2018-07-03T10:00:00Z')]
+        patched_batch.side_effect = pages
+        SyncState.objects.create(name=handle_signals.SYNC_NAME)
+
+        summary = handle_signals.handle_signals()
+
+        state = SyncState.objects.get(name=handle_signals.SYNC_NAME)
+        self.assertIsNotNone(state.heartbeat_at)
+        self.assertEquals(state.watermark, newer)
+        self.assertEquals(summary['watermark'], newer)
+        self.assertIsNotNone(state.t_updated)
+
+
+# -- test sharding --
+
+class TestSharding(TestCase):
+    def setUp(self):
+        reset_handlers()
+
+    def test_parse_shard(self):
+        self.assertEquals(handle_signals.parse_shard('1/4'), (0, 4))
+        self.assertEquals(handle_signals.parse_shard('4/4'), (3, 4))
+        for value in ['0/4', '5/4', '1/0', '1', 'a/b', '1/2/3']:
+            with self.assertRaises(ValueError):
+                handle_signals.parse_shard(value)
+
+    def test_every_signal_in_one_shard(self):
+        signals = [{'signal_id': str(i)} for i in range(1000)]
+        sizes = []
+        for index in range(4):
+            in_shard = [s for s in signals if handle_signals._in_shard(s, (index, 4))]
+            sizes.append(len(in_shard))
+        self.assertEquals(sum(sizes), 1000)
+        self.assertGreater(min(sizes), 200)
+
+        # stable between processes and runs (unlike hash())
+        self.assertTrue(handle_signals._in_shard({'signal_id': 12345}, (0, 4)))
+        self.assertTrue(handle_signals._in_shard({'signal_id': 'abc'}, (2, 4)))
+
+    @patch('datasets.handle_signals._batch_signals')
+    @patch('datasets.internal.get_auth_token.GetAccessToken.getToken',
+           return_value=('DOES NOT MATTER', 3600))
+    def test_handle_shard(self, patched_get_access_token, patched_batch):
+        signals = [_timestamped(str(i), '2018-07-01T10:00:00Z') for i in range(20)]
+        patched_batch.return_value = [signals[:10], signals[10:]]
+        expected = sorted(s['signal_id'] for s in signals if handle_signals._in_shard(s, (1, 3)))
+
+        summary = handle_signals.handle_signals(shard=(1, 3))
+
+        self.assertEquals(summary['signals'], len(expected))
+        self.assertEquals(summary['failed'], 0)
+        self.assertEquals(
+            sorted(MessageLog.objects.values_list('signal_id', flat=True)), expected)
+        self.assertTrue(SyncState.objects.filter(name=handle_signals.SYNC_NAME + ':2/3').exists())
+        self.assertFalse(SyncState.objects.filter(name=handle_signals.SYNC_NAME).exists())
+
+
+def _summarize_shard(shard=None, **options):
+    if shard[0] == 2:
+        raise RuntimeError('Shard broke down.')
+    return {'signals': shard[0] * 10, 'failed': 1, 'watermark': None, 'options': options}
+
+
+class TestHandleSignalsInShards(SimpleTestCase):
+    @patch('datasets.handle_signals.handle_signals', side_effect=_summarize_shard)
+    def test_shards_are_run_in_processes(self, patched_handle_signals):
+        results = handle_signals.handle_signals_in_shards(3, full=True)
+
+        self.assertEquals(len(results), 3)
+        self.assertEquals([summary.get('signals') for summary, error in results], [0, 10, None])
+        self.assertEquals(results[0][0]['options'], {'full': True})
+        self.assertIsNone(results[0][1])
+        self.assertEquals(results[2][1], 'RuntimeError: Shard broke down.')
+        # the work was done in the worker processes
+        self.assertEquals(patched_handle_signals.call_count, 0)
+
+    @patch('datasets.management.commands.handle_signals.handle_signals_in_shards')
+    def test_command(self, patched_in_shards):
+        patched_in_shards.return_value = [
+            ({'signals': 5, 'failed': 1, 'seconds': 2.0}, None),
+            ({'seconds': 1.0}, 'RuntimeError: Shard broke down.'),
+        ]
+        out = StringIO()
+
+        with self.assertRaises(CommandError):
+            call_command('handle_signals', '--shards', '2', '--local', stdout=out)
+
+        self.assertEquals(patched_in_shards.call_args[0], (2,))
+        self.assertIn('Shard 1/2: 5 signals, 1 not sent', out.getvalue())
+        self.assertIn('Shard 2/2: failed', out.getvalue())
+        self.assertIn('Total: 5 signals, 1 not sent, 1 of 2 shards completed', out.getvalue())
+
+    @patch('datasets.management.commands.handle_signals.handle_signals')
+    def test_command_fetch_concurrency(self, patched_handle_signals):
+        call_command('handle_signals', '--full', '--fetch-concurrency', '4')
+
+        self.assertEquals(patched_handle_signals.call_args[1]['fetch_concurrency'], 4)
+
+    def test_command_options(self):
+        for args in [['--shards', '2'], ['--local'], ['--shard', '5/4'],
+                     ['--shards', '2', '--local', '--shard', '1/2'],
+                     ['--fetch-concurrency', '4'], ['--daemon', '--fetch-concurrency', '4']]:
+            with self.assertRaises(CommandError):
+                call_command('handle_signals', *args)
+
+
+# -- test daemon mode --
+
+class FakeClock():
+    def __init__(self):
+        self.now = 1000.0
+
+    def monotonic(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.now += seconds
+
+
+class TestDaemon(TestCase):
+    def setUp(self):
+        reset_handlers()
+        self.clock = FakeClock()
+        patcher = patch('time.monotonic', self.clock.monotonic)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_next_interval(self):
+        self.assertEquals(handle_signals._next_interval(80, 3, 5, 300), 5)
+        self.assertEquals(handle_signals._next_interval(5, 0, 5, 300), 10)
+        self.assertEquals(handle_signals._next_interval(200, 0, 5, 300), 300)
+        self.assertEquals(handle_signals._next_interval(0, 0, 5, 300), 10)
+
+    @patch('datasets.handle_signals.handle_signals')
+    def test_adaptive_polling(self, patched_handle_signals):
+        runs = []
+
+        def run(**kwargs):
+            runs.append((self.clock.now, kwargs))
+            if len(runs) == 4:
+                raise requests.ConnectionError('Signals API is down.')
+            return {'new': 3 if len(runs) in (1, 5) else 0}
+
+        patched_handle_signals.side_effect = run
+        n_runs = handle_signals.run_daemon(
+            lambda: len(runs) >= 6, min_interval=5, max_interval=30, wait=self.clock.sleep)
+
+        self.assertEquals(n_runs, 6)
+        intervals = [round(b[0] - a[0]) for a, b in zip(runs, runs[1:])]
+        self.assertEquals(intervals, [5, 10, 20, 30, 5])
+        # the token and HTTP session are kept between runs
+        self.assertEquals(len(set(id(kwargs['token_manager']) for _, kwargs in runs)), 1)
+        self.assertEquals(len(set(id(kwargs['session']) for _, kwargs in runs)), 1)
+        # stopped on purpose, the heartbeat is cleared
+        self.assertIsNone(SyncState.objects.get(name=handle_signals.SYNC_NAME).heartbeat_at)
+
+    @patch('datasets.handle_signals.handle_signals', return_value={'new': 0})
+    def test_heartbeat_while_idle(self, patched_handle_signals):
+        beats = []
+        with patch('datasets.handle_signals._heartbeat', side_effect=beats.append):
+            handle_signals.run_daemon(
+                lambda: self.clock.now > 1000 + 250, shard=(0, 2), min_interval=300,
+                max_interval=300, heartbeat_interval=60, wait=self.clock.sleep)
+
+        self.assertEquals(patched_handle_signals.call_count, 1)
+        self.assertGreaterEqual(len(beats), 5)
+        self.assertEquals(set(beats), {(0, 2)})
+
+    @patch('datasets.handle_signals.handle_signals', return_value={'new': 0})
+    def test_heartbeat_while_running(self, patched_handle_signals):
+        heartbeats = []
+
+        def should_stop():
+            heartbeats.append(SyncState.objects.filter(
+                name='signals-api:1/2').values_list('heartbeat_at', flat=True).first())
+            return len(heartbeats) > 3
+
+        handle_signals.run_daemon(should_stop, shard=(0, 2), wait=self.clock.sleep)
+
+        self.assertIsNone(heartbeats[0])  # not started yet
+        self.assertTrue(all(heartbeats[1:]))
+        self.assertIsNone(SyncState.objects.get(name='signals-api:1/2').heartbeat_at)
+
+    @patch('datasets.handle_signals._batch_signals')
+    @patch('datasets.internal.get_auth_token.GetAccessToken.getToken',
+           return_value=('DOES NOT MATTER', 3600))
+    def test_stop_after_page(self, patched_get_access_token, patched_batch):
+        watermark = datetime.datetime(2018, 7, 1, 0, 0, tzinfo=pytz.utc)
+        SyncState.objects.create(name=handle_signals.SYNC_NAME, watermark=watermark)
+        patched_batch.return_value = [
+            [_timestamped('1', '2018-07-02T10:00:00Z'), _timestamped('2', '2018-06-30T10:00:00Z')],
+            [_timestamped('3', '2018-07-03T10:00:00Z')],
+        ]
+
+        summary = handle_signals.handle_signals(should_stop=lambda: True)
+
+        self.assertEquals((summary['signals'], summary['new']), (2, 1))
+        self.assertEquals(MessageLog.objects.count(), 2)
+        # the crawl was not complete, the watermark stays
+        self.assertEquals(SyncState.objects.get(name=handle_signals.SYNC_NAME).watermark, watermark)
@@ -0,0 +1,69 @@
+import os
+from io import StringIO
+from unittest import mock
+
+from django.core.management import call_command
+from django.test import TestCase
+
+from datasets import loadtest
+from datasets.external import base
+from datasets.internal.get_auth_token import GetAccessToken
+from datasets.models import MessageLog, SyncState
+
+
+class TestStandIns(TestCase):
+    def test_oauth(self):
+        with loadtest._serve(loadtest.OAuthStandIn) as oauth:
+            with mock.patch.dict(
+                    'os.environ', {'SIGNALS_AUTHORIZE_URL': oauth.url + '/oauth2/authorize'}):
+                token, expires_in = GetAccessToken().getToken('user@example.com', 'secret', True)
+
+        self.assertEqual(token, loadtest.ACCESS_TOKEN)
+        self.assertEqual(expires_in, 36000)
+
+    def test_signals_api(self):
+        make_signal = loadtest._signal_factory()
+        signal = make_signal(12)
+
+        self.assertEqual(signal['signal_id'], 'loadtest-000000012')
+        self.assertEqual(signal['updated_at'], '2018-06-01T00:00:12+00:00')
+        self.assertIn('location', signal)
+
+
+class TestRunLoadTest(TestCase):
+    def test_run(self):
+        SyncState.objects.create(name='signals-api')
+        registered = list(base._HANDLERS)
+
+        report = loadtest.run_load_test(250, page_size=100, latency=0, rate_limit=0)
+
+        self.assertEqual(report['signals'], 250)
+        self.assertEqual(report['pages'], 3)
+        self.assertEqual(report['sent'], 250)
+        self.assertEqual(report['sigmax_requests'], 250)
+        self.assertIsNotNone(report['latency_p99'])
+        # nothing is left behind
+        self.assertEqual(MessageLog.objects.count(), 0)
+        self.assertEqual(list(SyncState.objects.values_list('name', flat=True)), ['signals-api'])
+        self.assertEqual(list(base._HANDLERS), registered)
+        self.assertNotIn('SIGMAX_SERVER', os.environ)
+
+    def test_errors(self):
+        report = loadtest.run_load_test(
+            50, latency=0, error_rate=1, concurrency=1, rate_limit=0, keep=True)
+
+        self.assertEqual(report['sent'], 0)
+        self.assertEqual(report['failed'], 50)
+        # the circuit breaker stops sending after a few failures
+        self.assertEqual(report['sigmax_requests'], base.CIRCUIT_BREAKER_THRESHOLD)
+        self.assertEqual(report['not_attempted'], 50 - base.CIRCUIT_BREAKER_THRESHOLD)
+        self.assertEqual(MessageLog.objects.count(), 50)
+
+    def test_command(self):
+        out = StringIO()
+
+        call_command(
+            'load_test', signals=20, page_size=10, sigmax_latency=0, rate_limit=0, stdout=out)
+
+        self.assertIn('Signals:            20 in 2 pages', out.getvalue())
+        self.assertIn('Sent / failed:      20 / 0', out.getvalue())
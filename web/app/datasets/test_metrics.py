@@ -0,0 +1,105 @@
+import tempfile
+from unittest import mock
+
+from django.test import TestCase
+from django.utils import timezone
+from prometheus_client import REGISTRY
+
+from datasets import handle_signals, metrics
+from datasets.external.base import BaseAPIHandler, register_handler, reset_handlers
+from datasets.models import MessageLog
+
+
+def _sample(name, **labels):
+    return REGISTRY.get_sample_value(name, labels) or 0
+
+
+class FailingHandler(BaseAPIHandler):
+    name = 'metrics-failing'
+
+    def handle(self, signal):
+        return False, 'Error'
+
+    def can_handle(self, signal):
+        return signal['signal_id'] == 'fails'
+
+
+class TestPipelineMetrics(TestCase):
+    def setUp(self):
+        reset_handlers()
+        register_handler(FailingHandler)
+
+    def tearDown(self):
+        reset_handlers()
+
+    def test_counters(self):
+        MessageLog.objects.create(
+            signal_id='old', t_entered=timezone.now(), handler_name='local-log-only',
+            is_sent=True)
+        before = {
+            'sent': _sample('signals_export_signals_sent_total', handler='local-log-only'),
+            'skipped': _sample('signals_export_signals_skipped_total', handler='local-log-only'),
+            'failed': _sample('signals_export_signals_failed_total', handler='metrics-failing'),
+            'handled': _sample('signals_export_handle_seconds_count', handler='local-log-only'),
+            'routed': _sample('signals_export_routing_seconds_count'),
+        }
+
+        handle_signals._call_external_apis(
+            [{'signal_id': 'new-1'}, {'signal_id': 'new-2'}, {'signal_id': 'old'},
+             {'signal_id': 'fails'}])
+
+        self.assertEqual(
+            _sample('signals_export_signals_sent_total', handler='local-log-only'),
+            before['sent'] + 2)
+        self.assertEqual(
+            _sample('signals_export_signals_skipped_total', handler='local-log-only'),
+            before['skipped'] + 1)
+        self.assertEqual(
+            _sample('signals_export_signals_failed_total', handler='metrics-failing'),
+            before['failed'] + 1)
+        self.assertEqual(
+            _sample('signals_export_handle_seconds_count', handler='local-log-only'),
+            before['handled'] + 2)
+        self.assertEqual(_sample('signals_export_routing_seconds_count'), before['routed'] + 1)
+
+    @mock.patch('datasets.handle_signals.SIGNALS_API_BASE', 'https://signals.test')
+    @mock.patch('datasets.handle_signals._get_page')
+    def test_page_fetches(self, patched_get_page):
+        patched_get_page.return_value.json.return_value = {
+            '_links': {'next': {'href': None}},
+            'results': [{'signal_id': '1'}, {'signal_id': '2'}],
+        }
+        fetched = _sample('signals_export_signals_fetched_total')
+        pages = _sample('signals_export_page_fetch_seconds_count')
+
+        list(handle_signals._batch_signals({'Authorization': 'Bearer token'}))
+
+        self.assertEqual(_sample('signals_export_signals_fetched_total'), fetched + 2)
+        self.assertEqual(_sample('signals_export_page_fetch_seconds_count'), pages + 1)
+
+
+class TestMetricsView(TestCase):
+    def test_metrics(self):
+        MessageLog.objects.create(signal_id='1', t_entered=timezone.now())
+        MessageLog.objects.create(signal_id='2', t_entered=timezone.now(), is_sent=True)
+        MessageLog.objects.create(signal_id='3', t_entered=timezone.now(), is_parked=True)
+
+        response = self.client.get('/status/metrics')
+
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response['Content-Type'].startswith('text/plain'))
+        content = response.content.decode('utf-8')
+        self.assertIn('signals_export_backlog 1.0', content)
+        self.assertIn('signals_export_page_fetch_seconds', content)
+        self.assertIn('signals_export_signals_sent_total', content)
+
+    def test_multiprocess(self):
+        with tempfile.TemporaryDirectory() as directory:
+            with mock.patch.object(metrics, 'MULTIPROC_DIR', directory):
+                content, _ = metrics.render_metrics()
+
+        # nothing was written to the directory, only the backlog is known
+        self.assertEqual(
+            [line for line in content.decode('utf-8').splitlines()
+             if not line.startswith('#')],
+            ['signals_export_backlog 0.0'])
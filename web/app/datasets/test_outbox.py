@@ -0,0 +1,197 @@
+import json
+import datetime
+from io import StringIO
+from unittest.mock import patch
+
+from django.core.management import call_command
+from django.db import transaction
+from django.test import TestCase, TransactionTestCase
+from django.utils import timezone
+
+from datasets import handle_signals, outbox
+from datasets.models import MessageLog, Outbox
+from datasets.external.base import BaseAPIHandler, HandlerResult, register_handler, reset_handlers
+
+
+class FailOnThreeHandler(BaseAPIHandler):
+    name = 'fail-on-three'
+
+    def can_handle(self, signal):
+        return signal['signal_id'] == '3'
+
+    def handle(self, signal):
+        return False, 'Server said no'
+
+
+class TestEnqueueSignals(TestCase):
+    def setUp(self):
+        MessageLog.objects.create(signal_id='1', t_entered=timezone.now(), is_sent=True)
+        MessageLog.objects.create(signal_id='2', t_entered=timezone.now(), is_sent=False)
+        Outbox.objects.create(signal_id='3', payload='{"signal_id": "3"}', t_entered=timezone.now())
+        MessageLog.objects.create(signal_id='6', t_entered=timezone.now(), is_parked=True)
+
+    def test_enqueue(self):
+        signals = [{'signal_id': str(i), 'text': 'signal {}'.format(i)} for i in range(1, 7)]
+
+        n_added = outbox.enqueue_signals(signals + signals)
+
+        self.assertEqual(n_added, 3)
+        self.assertEqual(
+            sorted(Outbox.objects.values_list('signal_id', flat=True)), ['2', '3', '4', '5'])
+        item = Outbox.objects.get(signal_id='4')
+        self.assertEqual(json.loads(item.payload), signals[3])
+
+    def test_enqueue_nothing(self):
+        self.assertEqual(outbox.enqueue_signals([]), 0)
+
+    def test_queued_concurrently(self):
+        # queued by another process after this one checked the outbox
+        def insert_items(items):
+            Outbox.objects.create(signal_id='4', payload='{}', t_entered=timezone.now())
+            return insert(items)
+
+        insert = outbox._insert_items
+        signals = [{'signal_id': '4'}, {'signal_id': '5'}]
+        with patch('datasets.outbox._insert_items', side_effect=insert_items):
+            n_added = outbox.enqueue_signals(signals)
+
+        self.assertEqual(n_added, 1)
+        self.assertEqual(Outbox.objects.filter(signal_id='4').count(), 1)
+        self.assertEqual(Outbox.objects.get(signal_id='4').payload, '{}')
+        self.assertEqual(Outbox.objects.filter(signal_id='5').count(), 1)
+
+
+class TestProcessOutbox(TestCase):
+    def setUp(self):
+        reset_handlers()
+        outbox.enqueue_signals([{'signal_id': str(i)} for i in range(5)])
+
+    def test_process(self):
+        self.assertEqual(outbox.process_outbox(batch_size=3), 3)
+        self.assertEqual(Outbox.objects.count(), 2)
+        self.assertEqual(MessageLog.objects.filter(is_sent=True).count(), 3)
+
+        self.assertEqual(outbox.process_outbox(batch_size=3), 2)
+        self.assertEqual(outbox.process_outbox(batch_size=3), 0)
+        self.assertEqual(MessageLog.objects.filter(is_sent=True).count(), 5)
+
+    def test_claim_skips_locked_rows(self):
+        with patch('datasets.models.Outbox.objects.select_for_update',
+                   wraps=Outbox.objects.select_for_update) as select_for_update:
+            outbox.process_outbox()
+
+        select_for_update.assert_called_once_with(skip_locked=True)
+
+    @patch('datasets.outbox._call_external_apis', side_effect=RuntimeError('Cannot send.'))
+    def test_failed_batch_is_kept(self, patched_call):
+        self.assertEqual(outbox.process_outbox(), 5)
+
+        self.assertEqual(Outbox.objects.count(), 5)
+        for item in Outbox.objects.all():
+            self.assertGreater(item.next_attempt_at, timezone.now())
+        self.assertEqual(outbox.process_outbox(), 0)  # not due yet
+
+    def test_failed_signal_is_retried_when_due(self):
+        register_handler(FailOnThreeHandler)
+
+        self.assertEqual(outbox.process_outbox(), 5)
+        item = Outbox.objects.get()
+        self.assertEqual(item.signal_id, '3')
+        self.assertEqual(
+            item.next_attempt_at, MessageLog.objects.get(signal_id='3').next_attempt_at)
+        self.assertEqual(outbox.process_outbox(), 0)
+
+        past = timezone.now() - datetime.timedelta(seconds=1)
+        Outbox.objects.update(next_attempt_at=past)
+        MessageLog.objects.update(next_attempt_at=past)
+        with patch.object(FailOnThreeHandler, 'handle', return_value=(True, 'Sent')):
+            self.assertEqual(outbox.process_outbox(), 1)
+
+        self.assertEqual(Outbox.objects.count(), 0)
+        self.assertTrue(MessageLog.objects.get(signal_id='3').is_sent)
+
+    def test_parked_signal_is_removed(self):
+        register_handler(FailOnThreeHandler)
+        rejected = HandlerResult(False, 'HTTP 500 StUF058', permanent=True, fault_code='StUF058')
+
+        with patch.object(FailOnThreeHandler, 'handle', return_value=rejected):
+            self.assertEqual(outbox.process_outbox(), 5)
+
+        self.assertEqual(Outbox.objects.count(), 0)
+        self.assertTrue(MessageLog.objects.get(signal_id='3').is_parked)
+
+    def test_claimed_items_are_skipped(self):
+        lease_expires_at = timezone.now() + datetime.timedelta(minutes=5)
+        Outbox.objects.filter(signal_id__in=['0', '1']).update(
+            claimed_by='other-host:1', lease_expires_at=lease_expires_at)
+
+        self.assertEqual(outbox.process_outbox(), 3)
+        self.assertEqual(
+            sorted(Outbox.objects.values_list('signal_id', flat=True)), ['0', '1'])
+
+    def test_expired_claims_are_taken_over(self):
+        Outbox.objects.update(
+            claimed_by='dead-host:1', lease_expires_at=timezone.now() - datetime.timedelta(1))
+
+        self.assertEqual(outbox.process_outbox(), 5)
+        self.assertEqual(Outbox.objects.count(), 0)
+
+    def test_run_worker_once(self):
+        self.assertEqual(outbox.run_worker(batch_size=2, once=True), 5)
+
+    def test_run_worker_stops(self):
+        self.assertEqual(outbox.run_worker(should_stop=lambda: True), 0)
+        self.assertEqual(Outbox.objects.count(), 5)
+
+    def test_command(self):
+        out = StringIO()
+        call_command('export_worker', '--once', stdout=out)
+
+        self.assertIn('Processed 5 signals.', out.getvalue())
+        self.assertEqual(Outbox.objects.count(), 0)
+
+
+class TestProcessOutboxTransactions(TransactionTestCase):
+    def setUp(self):
+        reset_handlers()
+        outbox.enqueue_signals([{'signal_id': str(i)} for i in range(3)])
+
+    def test_sent_outside_transaction(self):
+        def call_external_apis(signals):
+            # the claim is committed, no transaction (and no row locks) while sending
+            self.assertFalse(transaction.get_connection().in_atomic_block)
+            self.assertEqual(
+                Outbox.objects.filter(claimed_by=handle_signals._worker_id()).count(), 3)
+            return handle_signals._call_external_apis(signals)
+
+        with patch('datasets.outbox._call_external_apis', side_effect=call_external_apis):
+            self.assertEqual(outbox.process_outbox(), 3)
+
+        self.assertEqual(Outbox.objects.count(), 0)
+        self.assertEqual(MessageLog.objects.filter(is_sent=True).count(), 3)
+
+    @patch('datasets.outbox._call_external_apis', side_effect=KeyboardInterrupt)
+    def test_claims_kept_when_the_worker_stops(self, patched_call):
+        with self.assertRaises(KeyboardInterrupt):
+            outbox.process_outbox()
+
+        # the rows are claimed by another worker again after the lease expires
+        for item in Outbox.objects.all():
+            self.assertEqual(item.claimed_by, handle_signals._worker_id())
+            self.assertGreater(item.lease_expires_at, timezone.now())
+
+
+class TestHandleSignalsEnqueue(TestCase):
+    def setUp(self):
+        reset_handlers()
+
+    @patch('datasets.handle_signals._batch_signals')
+    @patch('datasets.internal.get_auth_token.GetAccessToken.getToken',
+           return_value=('DOES NOT MATTER', 3600))
+    def test_enqueue(self, patched_get_access_token, patched_batch):
+        patched_batch.return_value = [[{'signal_id': 1}, {'signal_id': 2}], [{'signal_id': 3}]]
+
+        handle_signals.handle_signals(enqueue=True)
+
+        self.assertEqual(Outbox.objects.count(), 3)
+        self.assertEqual(MessageLog.objects.count(), 0)
@@ -0,0 +1,66 @@
+from datetime import timedelta
+
+from django.core.exceptions import ImproperlyConfigured
+from django.test import TestCase, override_settings
+from django.utils import timezone
+
+from datasets.models import MessageLog, SyncState
+
+
+class DaemonHealthTestCase(TestCase):
+    url = "/status/daemon"
+
+    def test_no_daemon_running(self):
+        SyncState.objects.create(name="signals-api")
+
+        response = self.client.get(self.url)
+        self.assertEqual(response.status_code, 200)
+        self.assertIn(b"No daemon running", response.content)
+
+    def test_stopped_daemon_not_checked(self):
+        # e.g. after going from two shards to one, the old daemons were stopped
+        SyncState.objects.create(name="signals-api", heartbeat_at=timezone.now())
+        SyncState.objects.create(name="signals-api:1/2", heartbeat_at=None)
+        SyncState.objects.create(name="signals-api:2/2", heartbeat_at=None)
+
+        response = self.client.get(self.url)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotIn(b"1/2", response.content)
+
+    def test_alive(self):
+        SyncState.objects.create(name="signals-api", heartbeat_at=timezone.now())
+
+        response = self.client.get(self.url)
+        self.assertEqual(response.status_code, 200)
+        self.assertIn(b"signals-api: last heartbeat 0 seconds ago", response.content)
+
+    def test_stale(self):
+        SyncState.objects.create(name="signals-api:1/2", heartbeat_at=timezone.now())
+        SyncState.objects.create(
+            name="signals-api:2/2", heartbeat_at=timezone.now() - timedelta(hours=1))
+
+        response = self.client.get(self.url)
+        self.assertEqual(response.status_code, 500)
+        self.assertIn(b"signals-api:2/2: last heartbeat 3600 seconds ago", response.content)
+
+
+class CheckDataTestCase(TestCase):
+    url = "/status/data"
+
+    def test_data_ok(self):
+        for signal_id in ["1", "2"]:
+            MessageLog.objects.create(signal_id=signal_id, t_entered=timezone.now())
+
+        response = self.client.get(self.url)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.content, b"Data OK 2 MessageLog")
+
+    def test_too_few_items(self):
+        response = self.client.get(self.url)
+        self.assertEqual(response.status_code, 500)
+
+    @override_settings(HEALTH_MODEL="datasets.DoesNotExist")
+    def test_misconfigured_model(self):
+        # only raised when checking, importing the views does not need the model
+        with self.assertRaises(ImproperlyConfigured):
+            self.client.get(self.url)
@@ -2,4 +2,9 @@ from django.urls import path
 
 from . import views
 
-urlpatterns = [path("health", views.health), path("data", views.check_data)]
+urlpatterns = [
+    path("health", views.health),
+    path("data", views.check_data),
+    path("metrics", views.metrics),
+    path("daemon", views.daemon),
+]
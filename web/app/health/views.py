@@ -1,9 +1,13 @@
+import os
 import logging
 
 from django.conf import settings
 from django.core.exceptions import ImproperlyConfigured
 from django.db import connection
+from django.utils import timezone
 
+from datasets.metrics import render_metrics
+from datasets.models import SyncState
 from signalsexport.env_vars import required_env_vars_are_present
 
 try:
@@ -16,18 +20,25 @@ except ImportError:
 
 from django.http import HttpResponse
 
-try:
-    print('Grabbing', settings.HEALTH_MODEL)
-    model = get_model(settings.HEALTH_MODEL)
-except:  # noqa E722
-    raise ImproperlyConfigured(
-        "settings.HEALTH_MODEL {} doesn't resolve to "
-        "a useable model".format(settings.HEALTH_MODEL)
-    )
+
+def _get_model():
+    """
+    Resolve settings.HEALTH_MODEL when checking, not when this module is imported.
+    """
+    try:
+        return get_model(settings.HEALTH_MODEL)
+    except:  # noqa E722
+        raise ImproperlyConfigured(
+            "settings.HEALTH_MODEL {} doesn't resolve to "
+            "a useable model".format(settings.HEALTH_MODEL)
+        )
 
 
 log = logging.getLogger(__name__)
 
+# handle_signals --daemon is considered dead when its heartbeat is older
+DAEMON_HEARTBEAT_TIMEOUT = float(os.getenv('DAEMON_HEARTBEAT_TIMEOUT', 300))
+
 
 def health(request):
     # check database
@@ -45,7 +56,7 @@ def health(request):
     healthy, error_msg = required_env_vars_are_present()
     if healthy:
         msg = "Service misconfigured: not all required env variables are set"
-        log.exception('{}\n{}'.format(msg, error_msg))
+        log.exception('%s\n%s', msg, error_msg)
         return HttpResponse(msg, content_type="text/plain", status=500)
 
     return HttpResponse(
@@ -53,7 +64,7 @@ def health(request):
 
 
 def check_data(request):
-
+    model = _get_model()
     count = model.objects.count()
     if count < 2:
         return HttpResponse(
@@ -64,3 +75,37 @@ def check_data(request):
     return HttpResponse(
         f"Data OK {count} {model.__name__}",
         content_type="text/plain", status=200)
+
+
+def metrics(request):
+    content, content_type = render_metrics()
+    return HttpResponse(content, content_type=content_type, status=200)
+
+
+def daemon(request):
+    """
+    Check that handle_signals --daemon (each shard of it) is alive.
+
+    A daemon clears its heartbeat when it is stopped on purpose, only the
+    daemons that are still running (or died) are checked.
+    """
+    heartbeats = list(SyncState.objects.exclude(
+        heartbeat_at=None).values_list('name', 'heartbeat_at'))
+    if not heartbeats:
+        return HttpResponse(
+            "No daemon running", content_type="text/plain", status=200)
+
+    now = timezone.now()
+    lines = []
+    stale = False
+    for name, heartbeat_at in sorted(heartbeats):
+        age = (now - heartbeat_at).total_seconds()
+        stale = stale or age > DAEMON_HEARTBEAT_TIMEOUT
+        lines.append("{}: last heartbeat {:.0f} seconds ago".format(name, age))
+
+    if stale:
+        return HttpResponse(
+            "Daemon heartbeat too old\n" + "\n".join(lines),
+            content_type="text/plain", status=500)
+    return HttpResponse(
+        "Daemon OK\n" + "\n".join(lines), content_type="text/plain", status=200)
@@ -13,8 +13,6 @@ import logging
 from django.conf import settings
 
 # -- setup logging --
-LOG_FORMAT = '%(asctime)-15s - %(name)s - %(message)s'
-logging.basicConfig(format=LOG_FORMAT, level=logging.DEBUG)
 logger = logging.getLogger(__name__)
 
 # For each supported API, credentials (or other settings from environment
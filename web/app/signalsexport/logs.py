@@ -0,0 +1,102 @@
+"""
+Log handler and formatter used by LOGGING (see settings_common).
+
+QueueingHandler hands log records to a thread that formats and writes them,
+so that the threads sending signals do not wait for log output. Only the
+(%-style) arguments are merged into the message before it is handed over,
+messages longer than max_length are truncated. JSONFormatter writes a record
+as one line of JSON, including the extra fields (signal_id, handler,
+seconds ...) passed to the logging call.
+"""
+import os
+import json
+import logging
+import datetime
+from logging.handlers import QueueHandler, QueueListener
+from queue import Queue
+
+# Every LogRecord has these attributes, the others were passed as extra
+_RECORD_ATTRIBUTES = set(vars(logging.LogRecord('', 0, '', 0, '', (), None))) | {'message'}
+
+
+def truncate(text, max_length):
+    """
+    Shorten text to max_length characters, noting how many were left out.
+    """
+    if max_length and len(text) > max_length:
+        return '{} ... ({} more characters)'.format(text[:max_length], len(text) - max_length)
+    return text
+
+
+class JSONFormatter(logging.Formatter):
+    """
+    Format a record as a JSON object, on one line.
+    """
+    def format(self, record):
+        data = {
+            'time': datetime.datetime.utcfromtimestamp(record.created).isoformat() + 'Z',
+            'level': record.levelname,
+            'logger': record.name,
+            'thread': record.threadName,
+            'message': record.getMessage(),
+        }
+        for name, value in vars(record).items():
+            if name not in _RECORD_ATTRIBUTES:
+                data[name] = value
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            data['exception'] = record.exc_text
+        return json.dumps(data, default=str)
+
+
+class QueueingHandler(QueueHandler):
+    """
+    Write log records to a stream (stderr by default) from a separate thread.
+
+    The thread is started on first use, and again in a forked process (which
+    does not inherit it). Messages longer than max_length characters are
+    truncated.
+
+    Note: the formatter set on this handler is used by the thread, flush
+    waits until the records logged so far have been written.
+    """
+    def __init__(self, stream=None, max_length=None):
+        super().__init__(None)
+        self.target = logging.StreamHandler(stream)
+        self.max_length = max_length
+        self.listener = None
+        self._pid = None
+
+    def setFormatter(self, fmt):
+        self.target.setFormatter(fmt)
+
+    def _is_running(self):
+        return self.listener is not None and self._pid == os.getpid()
+
+    def prepare(self, record):
+        # Only merge the arguments into the message and shorten it, the
+        # record is not pickled so formatting it can be left to the thread.
+        record.msg = truncate(record.getMessage(), self.max_length)
+        record.args = None
+        return record
+
+    def enqueue(self, record):
+        if not self._is_running():  # not started yet, or in a forked process
+            self.queue = Queue()
+            self.listener = QueueListener(self.queue, self.target)
+            self.listener.start()
+            self._pid = os.getpid()
+        self.queue.put_nowait(record)
+
+    def flush(self):
+        if self._is_running():
+            self.queue.join()
+        self.target.flush()
+
+    def close(self):
+        if self._is_running():
+            self.listener.stop()  # writes the records still in the queue
+        self.listener = None
+        self.target.close()
+        super().close()
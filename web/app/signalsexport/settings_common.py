@@ -81,6 +81,14 @@ STATIC_URL = '/signals_export/static/'
 
 STATIC_ROOT = os.path.abspath(os.path.join(BASE_DIR, '..', 'static'))
 
+# -- Logging --
+# Log records are written by a separate thread (signalsexport.logs), as JSON
+# unless LOG_JSON is 0 (the default when running locally).
+LOG_LEVEL = os.getenv('LOG_LEVEL', 'DEBUG' if DEBUG else 'INFO')
+LOG_JSON = os.getenv('LOG_JSON', '0' if DEBUG else '1') == '1'
+# Longer messages are truncated
+LOG_MAX_MESSAGE_LENGTH = int(os.getenv('LOG_MAX_MESSAGE_LENGTH', 2000))
+
 LOGGING = {
     'version': 1,
     'disable_existing_loggers': False,
@@ -89,18 +97,22 @@ LOGGING = {
         'console': {
             'format': '%(asctime)s - %(name)s - %(levelname)s - %(message)s',
         },
+        'json': {
+            '()': 'signalsexport.logs.JSONFormatter',
+        },
     },
 
     'handlers': {
         'console': {
             'level': 'DEBUG',
-            'class': 'logging.StreamHandler',
-            'formatter': 'console',
+            'class': 'signalsexport.logs.QueueingHandler',
+            'formatter': 'json' if LOG_JSON else 'console',
+            'max_length': LOG_MAX_MESSAGE_LENGTH,
         },
     },
 
     'root': {
-        'level': 'DEBUG',
+        'level': LOG_LEVEL,
         'handlers': ['console'],
     },
 
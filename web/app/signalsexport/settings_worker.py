@@ -0,0 +1,27 @@
+"""
+Settings for the handle_signals and export_worker management commands.
+
+Fetching and sending signals only needs the datasets app and the database.
+The web API apps (REST framework, Swagger, CORS, the debug toolbar) and
+GeoDjango are left out, also from the URLs (the system checks run before
+every command import them), which saves their imports on every invocation.
+None of the models has a geometry field, so the plain PostgreSQL backend is
+used instead of PostGIS. Run the commands with:
+
+    DJANGO_SETTINGS_MODULE=signalsexport.settings_worker python manage.py handle_signals
+"""
+from signalsexport.settings import *  # noqa F403
+from signalsexport.settings import DATABASES
+
+INSTALLED_APPS = [
+    'datasets',
+]
+
+MIDDLEWARE = []
+
+ROOT_URLCONF = 'signalsexport.urls_worker'
+
+DATABASES = {
+    alias: dict(database, ENGINE='django.db.backends.postgresql')
+    for alias, database in DATABASES.items()
+}
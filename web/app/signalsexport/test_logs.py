@@ -0,0 +1,107 @@
+import io
+import json
+import logging
+import threading
+
+from django.test import SimpleTestCase
+
+from signalsexport.logs import JSONFormatter, QueueingHandler, truncate
+
+
+def _record(msg, args=(), exc_info=None, **extra):
+    record = logging.LogRecord('datasets.test', logging.INFO, __file__, 1, msg, args, exc_info)
+    record.__dict__.update(extra)
+    return record
+
+
+class TestTruncate(SimpleTestCase):
+    def test_short(self):
+        self.assertEquals(truncate('abc', 3), 'abc')
+        self.assertEquals(truncate('abc', None), 'abc')
+
+    def test_long(self):
+        self.assertEquals(truncate('abcdef', 2), 'ab ... (4 more characters)')
+
+
+class TestJSONFormatter(SimpleTestCase):
+    def test_extra_fields(self):
+        record = _record('Sent %s', ('S1',), signal_id='S1', handler='sigmax', seconds=0.25)
+        data = json.loads(JSONFormatter().format(record))
+
+        self.assertEquals(data['message'], 'Sent S1')
+        self.assertEquals(data['level'], 'INFO')
+        self.assertEquals(data['logger'], 'datasets.test')
+        self.assertEquals(data['signal_id'], 'S1')
+        self.assertEquals(data['handler'], 'sigmax')
+        self.assertEquals(data['seconds'], 0.25)
+        self.assertNotIn('args', data)
+
+    def test_exception(self):
+        try:
+            raise ValueError('Bad signal')
+        except ValueError as e:
+            record = _record('Failed', exc_info=(ValueError, e, e.__traceback__))
+        data = json.loads(JSONFormatter().format(record))
+
+        self.assertIn('ValueError: Bad signal', data['exception'])
+
+    def test_not_serializable(self):
+        record = _record('Done', watermark=object())
+        data = json.loads(JSONFormatter().format(record))
+
+        self.assertIn('object', data['watermark'])
+
+
+class WritingThreadFormatter(logging.Formatter):
+    def format(self, record):
+        return '{}|{}'.format(threading.current_thread().name, super().format(record))
+
+
+class TestQueueingHandler(SimpleTestCase):
+    def setUp(self):
+        self.stream = io.StringIO()
+        self.handler = QueueingHandler(self.stream, max_length=20)
+        self.handler.setFormatter(WritingThreadFormatter())
+        self.addCleanup(self.handler.close)
+
+    def test_written_by_listener_thread(self):
+        self.handler.handle(_record('Handled %d signals', (100,)))
+        self.handler.flush()
+
+        thread_name, message = self.stream.getvalue().strip().split('|')
+        self.assertEquals(message, 'Handled 100 signals')
+        self.assertNotEqual(thread_name, threading.current_thread().name)
+
+    def test_arguments_merged_when_logged(self):
+        signals = ['S1']
+        self.handler.handle(_record('Signals %s', (signals,)))
+        signals.append('S2')  # changed before the record is written
+        self.handler.flush()
+
+        self.assertIn("Signals ['S1']", self.stream.getvalue())
+
+    def test_truncated(self):
+        self.handler.handle(_record('x' * 100))
+        self.handler.flush()
+
+        self.assertIn('x' * 20 + ' ... (80 more characters)', self.stream.getvalue())
+
+    def test_restarted_after_fork(self):
+        self.handler.handle(_record('before'))
+        listener = self.handler.listener
+        self.handler._pid = -1  # as if this were a forked process
+
+        self.handler.handle(_record('after'))
+        self.handler.flush()
+
+        self.assertIsNot(self.handler.listener, listener)
+        self.assertIn('after', self.stream.getvalue())
+        listener.stop()
+
+    def test_close_writes_queued_records(self):
+        for i in range(100):
+            self.handler.handle(_record('record %d', (i,)))
+        self.handler.close()
+
+        self.assertEquals(len(self.stream.getvalue().splitlines()), 100)
+        self.assertIsNone(self.handler.listener)
@@ -0,0 +1,7 @@
+"""
+URLs for the worker settings (settings_worker): none.
+
+Django's system checks (run before every management command) import the
+ROOT_URLCONF, the web API's urls would import the apps the workers leave out.
+"""
+urlpatterns = []
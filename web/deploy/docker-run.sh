@@ -7,6 +7,12 @@ set -x
 # # collect static files
 # yes yes | python manage.py collectstatic
 
+# start with empty metrics files (see datasets/metrics.py)
+if [ -n "${prometheus_multiproc_dir:-}" ]; then
+    mkdir -p "$prometheus_multiproc_dir"
+    rm -f "$prometheus_multiproc_dir"/*.db
+fi
+
 # run uwsgi
 cd /app/
 exec uwsgi